@@ -0,0 +1,288 @@
+"""
+This module contains functions for building many systems from one
+manifest, such as ligand or mutant variants of the same receptor. Each
+system is built by a DabbleBuilder in its own worker process, so each
+has its own VMD state and temporary directory.
+
+Author: Robin Betz
+
+Copyright (C) 2015 Robin Betz
+
+This program is free software; you can redistribute it and/or modify it under
+the terms of the GNU Lesser General Public License as published by the Free
+Software Foundation; either version 2 of the License, or (at your option) any
+later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place - Suite 330
+Boston, MA 02111-1307, USA.
+"""
+
+from __future__ import print_function
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+
+# pylint: disable=import-error, unused-import
+import vmd
+import molecule
+# pylint: enable=import-error, unused-import
+
+from Dabble import fileutils
+from Dabble.builder import DabbleBuilder, get_membrane_filename
+from Dabble.molbuffer import MoleculeBuffer
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Options every system in a manifest must specify
+_REQUIRED = ('solute_filename', 'output_filename')
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                              MODULE FUNCTIONS                               #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def read_manifest(filename, types=None):
+    """
+    Reads the systems to build from a manifest file. A csv manifest has
+    a header row of option names and one system per row, with empty
+    cells left at their default. A json manifest is a list of option
+    dictionaries, one per system.
+
+    Args:
+      filename (str): Manifest file, ending in .csv or .json
+      types (dict str -> callable): Converters for csv values, by option
+        name. Options without a converter are kept as strings.
+
+    Returns:
+      (list of dict) options for each system
+
+    Raises:
+      ValueError if the manifest format is unsupported or a system is
+        missing a required option
+    """
+    if filename.endswith('.json'):
+        with open(filename) as fileh:
+            systems = json.load(fileh)
+    elif filename.endswith('.csv'):
+        if types is None:
+            types = {}
+        systems = []
+        with open(filename) as fileh:
+            for row in csv.DictReader(fileh):
+                systems.append(dict((key.strip(),
+                                     types.get(key.strip(), str)(value.strip()))
+                                    for key, value in row.items()
+                                    if value is not None and value.strip()))
+    else:
+        raise ValueError("Manifest '%s' must be a csv or json file" % filename)
+
+    for i, system in enumerate(systems):
+        missing = [opt for opt in _REQUIRED if not system.get(opt)]
+        if missing:
+            raise ValueError("System %d in manifest '%s' is missing: %s"
+                             % (i+1, filename, ", ".join(missing)))
+    return systems
+
+#==========================================================================
+
+def option_types(parser):
+    """
+    Gets converters for manifest values from a command line parser, so
+    manifest options are interpreted like their command line versions.
+
+    Args:
+      parser (argparse.ArgumentParser): Parser for dabble options
+
+    Returns:
+      (dict str -> callable) converter for each option, by name
+    """
+    types = {}
+    # pylint: disable=protected-access
+    for action in parser._actions:
+        if isinstance(action, argparse._AppendAction):
+            types[action.dest] = lambda value: value.split(';')
+        elif isinstance(action, argparse._StoreTrueAction):
+            types[action.dest] = _parse_bool
+        elif action.type is not None:
+            types[action.dest] = action.type
+    return types
+
+#==========================================================================
+
+def build_batch(systems, defaults, tmp_dir, processes=None):
+    """
+    Builds several systems in parallel. Each system is built in its
+    own worker process and temporary directory, with the output of
+    each build written to a log file there. A failed build doesn't
+    stop the others.
+
+    Args:
+      systems (list of dict): Options for each system, overriding the
+        defaults
+      defaults (dict): Options shared by all systems
+      tmp_dir (str): Directory for shared files and for the temporary
+        directory of each system
+      processes (int): Number of builds to run at once, or None for
+        one per CPU
+
+    Returns:
+      (list of tuple) output filename and error message of each system,
+        in manifest order. The error is None if the build succeeded.
+    """
+    jobs = []
+    for i, system in enumerate(systems):
+        opts = dict(defaults)
+        opts.update(system)
+        if not system.get('tmp_dir'):
+            opts['tmp_dir'] = os.path.join(tmp_dir, "system_%d" % i)
+        if not os.path.isdir(opts['tmp_dir']):
+            os.makedirs(opts['tmp_dir'])
+        jobs.append(opts)
+
+    share_inputs(jobs, os.path.join(tmp_dir, 'shared'))
+
+    # A fresh worker for each build, so VMD state is never reused
+    pool = multiprocessing.Pool(processes=processes, maxtasksperchild=1)
+    results = []
+    try:
+        for output, error in pool.imap(_build_system, jobs, chunksize=1):
+            if error is None:
+                print("Built %s" % output)
+            else:
+                print("Failed to build %s:\n%s" % (output, error))
+            results.append((output, error))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+#==========================================================================
+
+def share_inputs(jobs, shared_dir):
+    """
+    Does the work common to several builds once, before they are handed
+    to workers. Each distinct solvent system is loaded only once, and
+    saved in a form workers can load without parsing it again. Builds
+    also share a patch cache, so solvent tiled to the same size by one
+    worker is reused by the others, and the topologies needed to write
+    psf or prmtop files are parsed into the matcher cache.
+
+    Args:
+      jobs (list of dict): Options for each build, modified in place
+      shared_dir (str): Directory to save shared files in
+    """
+    if not os.path.isdir(shared_dir):
+        os.makedirs(shared_dir)
+
+    converted = {}
+    for opts in jobs:
+        membrane = get_membrane_filename(opts.get('membrane_system'))
+        if membrane not in converted:
+            # Name by content so a resumed batch sees the same file
+            digest = fileutils.hash_file(membrane)
+            converted[membrane] = os.path.join(shared_dir,
+                                               "solvent_%s.npz" % digest)
+            if not os.path.isfile(converted[membrane]):
+                molid = fileutils.load_solute(membrane, tmp_dir=shared_dir)
+                MoleculeBuffer.from_molid(molid).save(converted[membrane])
+                molecule.delete(molid)
+        opts['membrane_system'] = converted[membrane]
+
+        if not opts.get('patch_cache'):
+            opts['patch_cache'] = os.path.join(shared_dir, 'patch_cache')
+
+    _cache_matchers(jobs)
+
+#==========================================================================
+
+def _cache_matchers(jobs):
+    """
+    Parses each distinct set of topologies used by builds writing psf or
+    prmtop files, saving them to the matcher cache so workers load the
+    parsed topologies instead of all parsing them at once. Builds with
+    invalid output options are skipped, and fail in their worker.
+
+    Args:
+      jobs (list of dict): Options for each build
+    """
+    topologies = set()
+    for opts in jobs:
+        forcefield = opts.get('forcefield') or 'charmm'
+        try:
+            out_fmt = fileutils.check_out_type(opts['output_filename'],
+                                               forcefield,
+                                               opts.get('hmassrepartition'))
+        except (ValueError, NotImplementedError):
+            continue
+        if out_fmt not in ('charmm', 'amber'):
+            continue
+        tops = tuple(fileutils.get_extra_files(opts)[0])
+        topologies.add(('amber' if out_fmt == 'amber' and
+                        forcefield == 'amber' else 'charmm', tops))
+
+    if not topologies:
+        return
+
+    # The parameterization stack is slow to import, so only load it
+    # if some build needs it
+    from Dabble.param import AmberMatcher, CharmmMatcher, amber, charmm
+    for kind, tops in sorted(topologies):
+        print("Parsing %s topologies for the batch" % kind)
+        if kind == 'amber':
+            AmberMatcher.cached(amber.get_topologies(list(tops)))
+        else:
+            CharmmMatcher.cached(charmm.get_topologies(list(tops)))
+
+#==========================================================================
+
+def _build_system(opts):
+    """
+    Builds and writes one system. Runs in a worker process.
+
+    Args:
+      opts (dict): Options for the DabbleBuilder
+
+    Returns:
+      (str) output filename
+      (str) error message, or None on success
+    """
+    # Workers don't share a terminal nicely, so send all output, including
+    # from VMD, to a log file
+    log = open(os.path.join(opts['tmp_dir'], 'dabble_output.txt'), 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+
+    try:
+        builder = DabbleBuilder(**opts) # pylint: disable=star-args
+        builder.write()
+        error = None
+    except Exception: # pylint: disable=broad-except
+        error = traceback.format_exc()
+        print(error)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        log.close()
+    return opts['output_filename'], error
+
+#==========================================================================
+
+def _parse_bool(value):
+    """
+    Returns:
+      (bool) value of a true/false, yes/no or 1/0 string
+    """
+    return value.lower() in ('true', 'yes', '1')
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
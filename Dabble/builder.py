@@ -38,12 +38,19 @@ from atomsel import atomsel
 
 from Dabble import fileutils
 from Dabble import molutils
+from Dabble.checkpoint import Checkpointer, STAGES
+from Dabble.clashes import ClashDetector
+from Dabble.profiling import StageProfiler
+from Dabble.molbuffer import MoleculeBuffer
+from Dabble.patchcache import PatchCache
+from Dabble.removal import RemovalMask
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 # Constants
 _MEMBRANE_HYDROPHOBIC_THICKNESS = 30.0
 _MEMBRANE_FULL_THICKNESS = 50.0
+_CLASH_CUTOFF = 1.75
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
@@ -61,6 +68,14 @@ class DabbleBuilder(object):
       opts (dictionary): All options passed to the system builder
       tmp_dir (str): Directory in which to save temporary files
       water_only (bool): If the solvent is just a water box
+      clashes (ClashDetector): Spatial index used to find clashing residues
+        in the combined system
+      removal (RemovalMask): Atoms remaining in the combined system
+      profiler (StageProfiler): Timings of each build stage
+      checkpoints (Checkpointer): Snapshots of the system after each stage,
+        or None if not checkpointing
+      patch_cache (PatchCache): Cache of the tiled membrane or water box,
+        or None
     """
 
     #==========================================================================
@@ -72,6 +87,8 @@ class DabbleBuilder(object):
         self.size = [0., 0., 0.]
         self.solute_sel = ""
         self.water_only = False
+        self.clashes = None
+        self.removal = None
         self._zmax = self._zmin = 0.
         if self.opts.get('tmp_dir'):
             self.tmp_dir = self.opts.get('tmp_dir')
@@ -79,6 +96,9 @@ class DabbleBuilder(object):
                 os.mkdir(self.tmp_dir)
         else:
             self.tmp_dir = tempfile.mkdtemp(prefix='dabble', dir=os.getcwd())
+        self.profiler = StageProfiler(enabled=bool(self.opts.get('profile')),
+                                      pstats_dir=self.tmp_dir
+                                      if self.opts.get('pstats') else None)
 
         # Check for default lipid membrane
         # Set some default options
@@ -89,18 +109,26 @@ class DabbleBuilder(object):
         if not 'wat_buffer' in self.opts: self.opts['wat_buffer'] = 20.0
         if not 'xy_buf' in self.opts: self.opts['xy_buf'] = 17.5
         if not 'lipid_dist' in self.opts:  self.opts['lipid_dist'] = 1.75
-        if not 'membrane_system' in self.opts:
-            self.opts['membrane_system'] =  resource_filename(__name__, \
-                    "lipid_membranes/popc.mae")
-
         # Process input arguments
-        if self.opts.get('membrane_system') == 'DEFAULT':
-            self.opts['membrane_system'] = resource_filename(__name__, \
-                    "lipid_membranes/popc.mae")
-        elif self.opts.get('membrane_system') == 'TIP3':
-            self.opts['membrane_system'] = resource_filename(__name__, \
-                    "lipid_membranes/tip3pbox.mae")
-
+        self.opts['membrane_system'] = \
+                get_membrane_filename(self.opts.get('membrane_system'))
+
+
+        # Reuse tiled solvent from previous builds, if asked
+        self.patch_cache = None
+        if self.opts.get('patch_cache'):
+            size = int(self.opts.get('patch_cache_size') or 1024)
+            self.patch_cache = PatchCache(self.opts['patch_cache'],
+                                          max_size=size*1024*1024)
+
+        # Inputs are final now, so stage checkpoints can be keyed on them.
+        # Resuming also saves checkpoints, for the stages that are redone
+        self.checkpoints = None
+        if self.opts.get('checkpoint') or self.opts.get('resume'):
+            self.checkpoints = Checkpointer(os.path.join(self.tmp_dir,
+                                                         'checkpoints'),
+                                            self.opts,
+                                            resume=self.opts.get('resume'))
 
         # Check the file output format is supported
         self.out_fmt = fileutils.check_out_type(self.opts.get('output_filename'),
@@ -116,120 +144,148 @@ class DabbleBuilder(object):
         Returns:
          (int) VMD molecule id of built system
         """
-        # Load the membrane system, check if it's water only
-        self.add_molecule(self.opts.get('membrane_system'), 'membrane')
-        if not len(atomsel(self.opts.get('lipid_sel'), molid=self.molids['membrane'])):
-            self.water_only = True
-            print("No lipid detected. Proceeding with pure liquid solvent")
-        x_mem, y_mem, z_mem = \
-                molutils.get_system_dimensions(molid=self.molids['membrane'])
-        print("Solvent patch dimensions are %.2f x %.2f x %.2f" % (x_mem,
-                                                                   y_mem,
-                                                                   z_mem))
-        # Load the solute (protein or ligand)
-        print("Loading and orienting the solute...")
-        self.add_molecule(self.opts.get('solute_filename'), 'solute')
-        self._set_solute_sel(self.molids['solute'])
-
-        # Orient the solute in the X,Y, and optionally Z directions
-        self.molids['solute'] = self._orient_solute(self.molids['solute'])
-
-        # Compute dimensions of the input system
-        print("Computing the size of the input periodic cell...")
-        dx_sol, dy_sol, dx_tm, dy_tm, dz_full = \
-                self.get_cell_size(mem_buf=self.opts.get('xy_buf'),
-                                   wat_buf=self.opts.get('wat_buffer'),
-                                   molid=self.molids['solute'])
-        if self.water_only:
-            print("\tSolute x diameter is %.2f\n"
-                  "\tSolute y diameter is %.2f\n"
-                  "\tSolute z diameter is %.2f"
-                  % (dx_sol, dy_sol, dz_full))
-        else:
-            print("\tSolute x diameter is %.2f (%.2f in TM region)\n"
-                  "\tSolute y diameter is %.2f (%.2f in TM region)\n"
-                  "\tSolute + membrane Z diameter is %.2f"
-                  % (dx_sol, dx_tm, dy_sol, dy_tm, dz_full))
-
-        # Compute dimensions of the final system
-        print("Final system will be %.2f x %.2f x %.2f"
-              % (self.size[0], self.size[1], self.size[2]))
-        print("\tX,Y solvent buffer: (%4.1f, %4.1f)" % (self.size[0] - dx_sol,
-                                                      self.size[1] - dy_sol))
-        if not self.water_only:
-            print("\tX,Y transmembrane buffer: (%4.1f, %4.1f)" % (self.size[0] - dx_tm,
-                                                                  self.size[1] - dy_tm))
-        print("\tZ solvent buffer: %4.1f" % (self.size[2]-dz_full))
-
-        # Tile the membrane/solvent
-        print("Tiling solvent...")
-        self.molids['tiled_membrane'], times = \
-                tile_membrane_patch(self.molids['membrane'],
-                                    self.size,
-                                    tmp_dir=self.tmp_dir,
-                                    allow_z_tile=self.water_only)
-        print("\tSolvent tiled %d x %d x %d times" % (times[0], times[1], times[2]))
-        # Only delete if a new molecule was created (if tiling occured)
-        if self.molids['tiled_membrane'] != self.molids['membrane']:
-            self.remove_molecule('membrane')
-
-        print("Centering solvent...")
-        self.molids['tiled_membrane'] = \
-                molutils.center_system(molid=self.molids['tiled_membrane'],
-                                       tmp_dir=self.tmp_dir, center_z=True)
-
-        # Combine tiled membrane with solute
-        print("Combining solute and tiled solvent patch...")
-        self.molids['inserted'] = \
-                molutils.combine_molecules(input_ids=[self.molids['solute'],
-                                                      self.molids['tiled_membrane']],
+        # Pick up from the last checkpoint whose inputs are unchanged
+        done = self._resume()
+
+        if 'oriented' not in done:
+            with self.profiler.stage('load_inputs', atoms=self._num_atoms):
+                # Load the membrane system, check if it's water only
+                self.add_molecule(self.opts.get('membrane_system'), 'membrane')
+                if not len(atomsel(self.opts.get('lipid_sel'), molid=self.molids['membrane'])):
+                    self.water_only = True
+                    print("No lipid detected. Proceeding with pure liquid solvent")
+                x_mem, y_mem, z_mem = \
+                        molutils.get_system_dimensions(molid=self.molids['membrane'])
+                print("Solvent patch dimensions are %.2f x %.2f x %.2f" % (x_mem,
+                                                                           y_mem,
+                                                                           z_mem))
+                # Load the solute (protein or ligand)
+                print("Loading and orienting the solute...")
+                self.add_molecule(self.opts.get('solute_filename'), 'solute')
+                self._set_solute_sel(self.molids['solute'])
+
+            with self.profiler.stage('orient_solute', atoms=self._num_atoms):
+                # Orient the solute in the X,Y, and optionally Z directions
+                self.molids['solute'] = self._orient_solute(self.molids['solute'])
+            self._checkpoint('oriented')
+
+        if 'tiled' not in done:
+            with self.profiler.stage('cell_size', atoms=self._num_atoms):
+                # Compute dimensions of the input system
+                print("Computing the size of the input periodic cell...")
+                dx_sol, dy_sol, dx_tm, dy_tm, dz_full = \
+                        self.get_cell_size(mem_buf=self.opts.get('xy_buf'),
+                                           wat_buf=self.opts.get('wat_buffer'),
+                                           molid=self.molids['solute'])
+                if self.water_only:
+                    print("\tSolute x diameter is %.2f\n"
+                          "\tSolute y diameter is %.2f\n"
+                          "\tSolute z diameter is %.2f"
+                          % (dx_sol, dy_sol, dz_full))
+                else:
+                    print("\tSolute x diameter is %.2f (%.2f in TM region)\n"
+                          "\tSolute y diameter is %.2f (%.2f in TM region)\n"
+                          "\tSolute + membrane Z diameter is %.2f"
+                          % (dx_sol, dx_tm, dy_sol, dy_tm, dz_full))
+
+                # Compute dimensions of the final system
+                print("Final system will be %.2f x %.2f x %.2f"
+                      % (self.size[0], self.size[1], self.size[2]))
+                print("\tX,Y solvent buffer: (%4.1f, %4.1f)" % (self.size[0] - dx_sol,
+                                                              self.size[1] - dy_sol))
+                if not self.water_only:
+                    print("\tX,Y transmembrane buffer: (%4.1f, %4.1f)" % (self.size[0] - dx_tm,
+                                                                          self.size[1] - dy_tm))
+                print("\tZ solvent buffer: %4.1f" % (self.size[2]-dz_full))
+
+            with self.profiler.stage('tile_solvent', atoms=self._num_atoms):
+                # Tile and center the membrane/solvent
+                print("Tiling and centering solvent...")
+                self.molids['tiled_membrane'], times = \
+                        tile_solvent_patch(self.molids['membrane'],
+                                           self.size,
+                                           allow_z_tile=self.water_only,
+                                           center_z=True,
+                                           cache=self.patch_cache,
                                            tmp_dir=self.tmp_dir)
-        self.remove_molecule('tiled_membrane')
-        self.remove_molecule('solute')
-        
-        # Add more waters if necessary
-        self.molids['combined'] = self._add_water(self.molids['inserted'])
-        self.remove_molecule('inserted')
-
-        # Remove atoms outside the final system cell, accounting for boundary
-        self._set_cell_to_square_prism(self.molids['combined'])
-        box_wat = self._trim_water(self.molids['combined'])
-
-        # Remove lipids outside the box if there are lipids
-        if not self.water_only:
-            print("\nInitial membrane composition:\n%s" %
-                  molutils.print_lipid_composition(self.opts.get('lipid_sel'),
-                                                   molid=self.molids['combined']))
-
-        # Remove atoms that clash with the solvent
-        clashes = self._remove_overlapping_residues(self.opts.get('lipid_sel'),
-                                                    self.molids['combined'],
-                                                    self.opts.get('lipid_friendly_sel'))
-
-        print("Removed %d extra atoms\n" 
-              "\t%d out of the box\n"
-              "\t%d too close to the solute" % ((box_wat+clashes), box_wat,
-                                                clashes))
-
-        # Remove extra lipids and print info about membrane
-        if not self.water_only:
-            self._remove_clashing_lipids(self.molids['combined'],
-                                         self.opts.get('lipid_sel'),
-                                         self.opts.get('lipid_friendly_sel'))
-            print("\nFinal membrane composition:\n%s" %
-                  molutils.print_lipid_composition(self.opts.get('lipid_sel'),
-                                                   self.molids['combined']))
-
-        # Calculate charge
-        print("\nSolute net charge: %+d\n"
-              "System net charge: %+d"
-              % (molutils.get_net_charge(self.solute_sel, self.molids['combined']),
-                 molutils.get_system_net_charge(self.molids['combined'])))
-
-        # Add ions as necessary
-        self.convert_ions(self.opts.get('salt_conc'),
-                          self.opts.get('cation'),
-                          self.molids['combined'])
+                print("\tSolvent tiled %d x %d x %d times" % (times[0], times[1], times[2]))
+                # Only delete if a new molecule was created (if tiling occured)
+                if self.molids['tiled_membrane'] != self.molids['membrane']:
+                    self.remove_molecule('membrane')
+            self._checkpoint('tiled')
+
+        if 'combined' not in done:
+            with self.profiler.stage('combine', atoms=self._num_atoms):
+                # Combine tiled membrane with solute
+                print("Combining solute and tiled solvent patch...")
+                self.molids['inserted'] = \
+                        molutils.combine_molecules(input_ids=[self.molids['solute'],
+                                                              self.molids['tiled_membrane']])
+                self.remove_molecule('tiled_membrane')
+                self.remove_molecule('solute')
+
+            with self.profiler.stage('add_water', atoms=self._num_atoms):
+                # Add more waters if necessary
+                self.molids['combined'] = self._add_water(self.molids['inserted'])
+                self.remove_molecule('inserted')
+                self.removal = _get_removal_mask(self.molids['combined'])
+            self._checkpoint('combined')
+
+        if 'trimmed' not in done:
+            with self.profiler.stage('trim_water', atoms=self._num_atoms):
+                # Remove atoms outside the final system cell, accounting for boundary
+                self._set_cell_to_square_prism(self.molids['combined'])
+                box_wat = self._trim_water(self.molids['combined'])
+                self._update_beta(self.molids['combined'])
+
+                # Remove lipids outside the box if there are lipids
+                if not self.water_only:
+                    print("\nInitial membrane composition:\n%s" %
+                          molutils.print_lipid_composition(self.opts.get('lipid_sel'),
+                                                           self.molids['combined'],
+                                                           self.removal.remaining))
+
+            with self.profiler.stage('remove_clashes', atoms=self._num_atoms):
+                # Index the final coordinates once for all clash checks
+                self.clashes = _get_clash_detector(self.molids['combined'])
+
+                # Remove atoms that clash with the solvent
+                clashes = self._remove_overlapping_residues(self.opts.get('lipid_sel'),
+                                                            self.molids['combined'],
+                                                            self.opts.get('lipid_friendly_sel'))
+
+                print("Removed %d extra atoms\n" 
+                      "\t%d out of the box\n"
+                      "\t%d too close to the solute" % ((box_wat+clashes), box_wat,
+                                                        clashes))
+
+            with self.profiler.stage('remove_lipid_clashes', atoms=self._num_atoms):
+                # Remove extra lipids and print info about membrane
+                if not self.water_only:
+                    self._remove_clashing_lipids(self.molids['combined'],
+                                                 self.opts.get('lipid_sel'),
+                                                 self.opts.get('lipid_friendly_sel'))
+                    self._update_beta(self.molids['combined'])
+                    print("\nFinal membrane composition:\n%s" %
+                          molutils.print_lipid_composition(self.opts.get('lipid_sel'),
+                                                           self.molids['combined'],
+                                                           self.removal.remaining))
+            self._checkpoint('trimmed')
+
+        if 'ionized' not in done:
+            with self.profiler.stage('add_ions', atoms=self._num_atoms):
+                # Calculate charge
+                self._update_beta(self.molids['combined'])
+                print("\nSolute net charge: %+d\n"
+                      "System net charge: %+d"
+                      % (molutils.get_net_charge(self.solute_sel, self.molids['combined']),
+                         molutils.get_system_net_charge(self.molids['combined'])))
+
+                # Add ions as necessary
+                self.convert_ions(self.opts.get('salt_conc'),
+                                  self.opts.get('cation'),
+                                  self.molids['combined'])
+            self._checkpoint('ionized')
 
         # System is now built
         return self.molids['combined']
@@ -247,25 +303,39 @@ class DabbleBuilder(object):
         fileutils.check_write_ok(self.opts.get('output_filename'),
                                  self.out_fmt,
                                  overwrite=self.opts.get('overwrite'))
-        final_id = self._build()
+        with self.profiler.stage('build', atoms=self._num_atoms):
+            final_id = self._build()
 
+        lipids = _selection_mask(self.opts.get('lipid_sel'), final_id)
+        waters = _selection_mask('water and element O', final_id)
         print("Writing system to %s with %d atoms comprising:\n"
               "  %d lipid molecules\n"
               "  %d water molecules\n"
               % (self.opts.get('output_filename'),
-                 molutils.num_atoms_remaining(molid=final_id),
-                 molutils.num_lipids_remaining(final_id, self.opts.get('lipid_sel')),
-                 molutils.num_waters_remaining(molid=final_id)))
-        fileutils.write_final_system(out_fmt=self.out_fmt,
-                                     out_name=self.opts.get('output_filename'),
-                                     molid=final_id, tmp_dir=self.tmp_dir,
-                                     forcefield=self.opts.get('forcefield'),
-                                     extra_topos=self.opts.get('extra_topos'),
-                                     extra_params=self.opts.get('extra_params'),
-                                     extra_streams=self.opts.get('extra_streams'),
-                                     hmassrepartition=self.opts.get('hmassrepartition'))
+                 self.removal.count(),
+                 self.removal.count_fragments(lipids),
+                 self.removal.count(waters)))
+        with self.profiler.stage('write', atoms=self._num_atoms):
+            fileutils.write_final_system(out_fmt=self.out_fmt,
+                                         out_name=self.opts.get('output_filename'),
+                                         molid=final_id, tmp_dir=self.tmp_dir,
+                                         forcefield=self.opts.get('forcefield'),
+                                         extra_topos=self.opts.get('extra_topos'),
+                                         extra_params=self.opts.get('extra_params'),
+                                         extra_streams=self.opts.get('extra_streams'),
+                                         hmassrepartition=self.opts.get('hmassrepartition'),
+                                         native_psf=self.opts.get('native_psf'),
+                                         match_processes=self.opts.get('match_processes'),
+                                         profiler=self.profiler)
         molecule.delete(final_id)
 
+        # Write out timings, if requested
+        report = self.profiler.write('.'.join(self.opts.get('output_filename')
+                                              .rsplit('.')[:-1]) + '_profile.json')
+        if report:
+            print("\nStage timings:\n%s\nWrote profile to %s"
+                  % (self.profiler.summary(), report))
+
     #==========================================================================
 
     def add_molecule(self, filename, desc):
@@ -349,10 +419,8 @@ class DabbleBuilder(object):
                pos_ions_needed, cation, neg_ions_needed))
 
         # Add the ions
-        for _ in xrange(pos_ions_needed):
-            add_salt_ion(cation, molid)
-        for _ in xrange(neg_ions_needed):
-            add_salt_ion('Cl', molid)
+        add_salt_ions([cation]*pos_ions_needed + ['Cl']*neg_ions_needed,
+                      molid, removal=self.removal)
 
         return pos_ions_needed + neg_ions_needed
 
@@ -497,6 +565,98 @@ class DabbleBuilder(object):
 
         #==========================================================================
 
+    def _remove_selection(self, sel, molid):
+        """
+        Marks all residues containing an atom in the selection for deletion.
+        IMPORTANT - atoms are not actually deleted until next call to write!
+
+        Args:
+          sel (str): VMD atom selection string to remove
+          molid (int): VMD molecule ID to consider
+
+        Returns:
+          (int): The number of atoms removed
+        """
+        return self.removal.remove_residues(_selection_mask(sel, molid))
+
+    #==========================================================================
+
+    def _checkpoint(self, stage):
+        """
+        Saves the system and builder state after a stage, if
+        checkpointing is requested
+
+        Args:
+          stage (str): Name of the stage that was completed
+        """
+        if self.checkpoints is None:
+            return
+        if self.removal is not None:
+            self._update_beta(self.molids['combined'])
+        self.checkpoints.save(stage, self.molids,
+                              state={'size': list(self.size),
+                                     'zmax': self._zmax,
+                                     'zmin': self._zmin,
+                                     'solute_sel': self.solute_sel,
+                                     'water_only': self.water_only})
+
+    #==========================================================================
+
+    def _resume(self):
+        """
+        Loads the latest valid checkpoint, if resuming is requested.
+
+        Returns:
+          (set of str) names of the stages that are already done
+        """
+        if self.checkpoints is None:
+            return set()
+        stage = self.checkpoints.latest()
+        if stage is None:
+            return set()
+
+        print("Resuming build from '%s' checkpoint" % stage)
+        self.molids, state = self.checkpoints.load(stage)
+        self.size = state['size']
+        self._zmax = state['zmax']
+        self._zmin = state['zmin']
+        self.solute_sel = state['solute_sel']
+        self.water_only = state['water_only']
+        if 'combined' in self.molids:
+            self.removal = _get_removal_mask(self.molids['combined'])
+        return set(STAGES[:STAGES.index(stage)+1])
+
+    #==========================================================================
+
+    def _num_atoms(self):
+        """
+        Counts the atoms currently in the system being built, for
+        profiling.
+
+        Returns:
+          (int) remaining atoms once the system is combined, otherwise
+            the number of atoms in all the loaded molecules
+        """
+        if self.removal is not None:
+            return self.removal.count()
+        return sum(molecule.numatoms(m) for m in set(self.molids.values())
+                   if molecule.exists(m))
+
+    #==========================================================================
+
+    def _update_beta(self, molid):
+        """
+        Copies the removal mask to the beta field, so that atoms that
+        won't be written have beta 0.
+
+        Args:
+          molid (int): VMD molecule ID to update
+        """
+        beta = self.removal.remaining.astype(float)
+        atomsel('all', molid=molid).set('beta', beta.tolist())
+
+    #==========================================================================
+
     def _set_cell_to_square_prism(self, molid):
         """
         Sets the periodic box to be a square prism of specified dimension
@@ -525,17 +685,19 @@ class DabbleBuilder(object):
         Returns:
           (int) number of atoms deleted
         """
-        return _remove_residues('(not (%s)) and noh and abs(z) > %f'
-                                % (self.solute_sel, self.size[2] / 2.0),
-                                molid=molid)
+        return self._remove_selection('(not (%s)) and noh and abs(z) > %f'
+                                      % (self.solute_sel, self.size[2] / 2.0),
+                                      molid=molid)
 
     #==========================================================================
 
     def _add_water(self, molid):
         """
         Adds water residues in the +- Z direction in the system. Used if there
-        are not enough waters in the initial membrane system. Creates a new
-        molecule with waters added.
+        are not enough waters in the initial membrane system. Water is
+        generated in memory to fill exactly the slabs needed, leaving out
+        any that would overlap the system, and then merged with the system
+        into a new molecule.
 
         Args:
             molid (int): VMD molecule id to use
@@ -560,47 +722,46 @@ class DabbleBuilder(object):
               - min(atomsel(self.solute_sel).get('z'))
 
         # Load water
-        wat_path = self.opts['membrane_system'] = resource_filename(__name__, \
-                "lipid_membranes/tip3pbox.mae")
-        self.add_molecule(wat_path, 'water')
-        to_combine = [molid]
-
-        # Handle adding water above the protein
-        # When moving add a 0.5 less so there isn't a gap
+        self.add_molecule(resource_filename(__name__,
+                                            "lipid_membranes/tip3pbox.mae"),
+                          'water')
+        system = MoleculeBuffer.from_molid(molid)
+        residues = [np.array(atomsel('all', molid=molid).get('residue'))]
+        to_combine = [system]
+        solvent_z = system.coords[~_selection_mask(self.solute_sel, molid), 2]
+
+        # Handle adding water above the protein. The slab starts 0.5 A
+        # inside the existing solvent so there isn't a gap
         if zup > 0:
             print("Adding %f A water above the solute..." % zup)
-            self.molids['wtmp'], tiletimes = tile_membrane_patch(self.molids['water'],
-                                                                 [self.size[0], self.size[1], zup],
-                                                                 self.tmp_dir, allow_z_tile=True)
-            move = max(atomsel("not (%s)" % self.solute_sel, molid=molid).get('z')) - \
-                    min(atomsel(molid=self.molids['wtmp']).get('z')) - 0.5
-            atomsel(molid=self.molids['wtmp']).moveby((0, 0, move))
-            self.molids['wats_up'] = molutils.center_system(molid=self.molids['wtmp'],
-                                                            tmp_dir=self.tmp_dir,
-                                                            center_z=False)
-            self.remove_molecule('wtmp')
-            to_combine.append(self.molids['wats_up'])
+            zmin = max(solvent_z) - 0.5
+            wats_up, wat_res = molutils.solvent_slab(self.molids['water'],
+                                                     self.size[0],
+                                                     self.size[1],
+                                                     zmin, zmin + zup + 0.5)
+            to_combine.append(wats_up)
+            residues.append(wat_res)
 
         # Handle adding water below the protein
-        # When moving add a 0.5 less so there isn't a gap
         if zdo > 0:
             print("Adding %f A water below the solute..." % zdo)
-            self.molids['wtmp'], tiletimes = \
-                    tile_membrane_patch(self.molids['water'], [self.size[0], self.size[1], zdo],
-                                        self.tmp_dir, allow_z_tile=True)
-            move = min(atomsel("not (%s)" % self.solute_sel, molid=molid).get('z')) - \
-                    max(atomsel(molid=self.molids['wtmp']).get('z')) + 0.5
-            atomsel(molid=self.molids['wtmp']).moveby((0, 0, move))
-            self.molids['wats_down'] = molutils.center_system(molid=self.molids['wtmp'],
-                                                              tmp_dir=self.tmp_dir,
-                                                              center_z=False)
-            self.remove_molecule('wtmp')
-            to_combine.append(self.molids['wats_down'])
-
-        # Combine and return a new molecule
-        newid = molutils.combine_molecules(input_ids=to_combine,
-                                           tmp_dir=self.tmp_dir)
+            zmax = min(solvent_z) + 0.5
+            wats_down, wat_res = molutils.solvent_slab(self.molids['water'],
+                                                       self.size[0],
+                                                       self.size[1],
+                                                       zmax - zdo - 0.5, zmax,
+                                                       anchor_top=True)
+            to_combine.append(wats_down)
+            residues.append(wat_res)
         self.remove_molecule('water')
+
+        # Leave out new waters that overlap anything already there, then
+        # combine everything in one step
+        combined = _combine_without_overlaps(to_combine, residues)
+        newid = combined.to_molid('dabble_combined')
+        molecule.set_top(newid)
+        molecule.delete(molid)
+        atomsel('all', molid=newid).set('beta', 1)
         return newid
 
     #==========================================================================
@@ -624,44 +785,30 @@ class DabbleBuilder(object):
         if not self.opts.get('wat_buffer'):
             raise ValueError("Water buffer undefined")
 
+        # Evaluate every box boundary on the coordinates at once
+        coords = _get_coords(molid)
+        heavy = _selection_mask('noh', molid)
+        solute = _selection_mask(self.solute_sel, molid)
+        solvent = heavy & ~solute & ~_selection_mask(self.opts['lipid_sel'],
+                                                     molid)
+
         # Remove waters in the Z direction
-        # Check if we are trimming to absolute size and set z buf if so
-        total = 0
-        zcoord = atomsel(self.solute_sel).get('z')
-        total = _remove_residues('(not (%s) and not (%s)) and noh and z > %f' % \
-                                 (self.solute_sel, self.opts['lipid_sel'],
-                                  self._zmax), molid=molid)
-        total += _remove_residues('(not (%s) and not (%s)) and noh and z < %f' %
-                                  (self.solute_sel, self.opts['lipid_sel'],
-                                   self._zmin), molid=molid)
+        outside = [solvent & (coords[:, 2] > self._zmax),
+                   solvent & (coords[:, 2] < self._zmin)]
 
         # Trim in the XY direction if it's a pure water system
         # lipid trimming is done in trim_xy_residues and takes into account
         # lipid center, etc.
         if self.water_only:
-            xcoord = atomsel(self.solute_sel).get('x')
-            buf = (self.size[0] - max(xcoord) + min(xcoord))/2.
-            total += _remove_residues('(not (%s)) and noh and x > %f' %
-                                      (self.solute_sel,
-                                       max(xcoord) + buf),
-                                       molid=molid)
-            total += _remove_residues('(not (%s)) and noh and x < %f' %
-                                      (self.solute_sel,
-                                       min(xcoord) - buf),
-                                      molid=molid)
-
-            ycoord = atomsel(self.solute_sel).get('y')
-            buf = (self.size[1] - max(ycoord) + min(ycoord))/2.
-            total += _remove_residues('(not (%s)) and noh and y > %f' %
-                                      (self.solute_sel,
-                                       max(ycoord) + buf),
-                                      molid=molid)
-            total += _remove_residues('(not (%s)) and noh and y < %f' %
-                                      (self.solute_sel,
-                                       min(ycoord) - buf),
-                                      molid=molid)
+            for dim in range(2):
+                solute_coord = coords[solute, dim]
+                buf = (self.size[dim] - max(solute_coord) + min(solute_coord))/2.
+                outside.append(heavy & ~solute &
+                               (coords[:, dim] > max(solute_coord) + buf))
+                outside.append(heavy & ~solute &
+                               (coords[:, dim] < min(solute_coord) - buf))
 
-        return total
+        return _remove_residues_in_turn(self.removal, outside)
 
     #==========================================================================
 
@@ -680,38 +827,35 @@ class DabbleBuilder(object):
           ValueError if the 'lipid' only contains hydrogens
         """
 
-        # Select residues that are outside the box
+        # Select atoms that are outside the box
         half_x_size = self.size[0] / 2.0
         half_y_size = self.size[1] / 2.0
-        box_sel_str = 'abs(x) > %f or abs(y) > %f' % (half_x_size, half_y_size)
+        coords = _get_coords(molid)
+        heavy = _selection_mask('noh', molid)
+        lipids = _selection_mask(self.opts['lipid_sel'], molid)
+        outside = (np.abs(coords[:, 0]) > half_x_size) | \
+                  (np.abs(coords[:, 1]) > half_y_size)
 
         # Identify lipids that have some part outside of the box
-        suspicious_lipid_residues = list(set(atomsel('(%s) and (%s)' % \
-               (self.opts['lipid_sel'], box_sel_str), molid=molid).get('residue')))
-        bad_lipids = []
+        suspicious = self.removal.residue_mask(lipids & outside)
+
+        # Sanity check
+        no_heavy = suspicious & ~self.removal.residue_mask(heavy)
+        if np.any(no_heavy):
+            raise ValueError("No heavy atoms found in suspicious residue %s"
+                             "Check your input file."
+                             % self.removal.residues[np.argmax(no_heavy)])
 
         # Delete lipids whose center is too far out of the box, keep others
-        for i in suspicious_lipid_residues:
-            lipid_center = atomsel('noh and residue %s' % str(i),
-                                   molid=molid).center()
-            # Sanity check
-            if not len(lipid_center):
-                raise ValueError("No heavy atoms found in suspicious residue %s"
-                                 "Check your input file." % str(i))
-
-            if abs(lipid_center[0]) > half_x_size or \
-               abs(lipid_center[1]) > half_y_size:
-                bad_lipids.append(i)
-        lipid_headgroup_sel = 'residue ' + ' '.join([str(l) for l in bad_lipids])
+        bad_lipids = suspicious & \
+                molutils.residues_centered_outside(self.removal.residues,
+                                                   coords, heavy,
+                                                   half_x_size, half_y_size)
 
         # Do the deletion
-        removal_sel_str = '(%s) or not (%s)' % (lipid_headgroup_sel,
-                                                self.opts['lipid_sel'])
-        total = _remove_residues('noh and (%s) and (%s) and not (%s)' %
-                                 (box_sel_str,
-                                  removal_sel_str,
-                                  self.solute_sel),
-                                 molid=molid)
+        solute = _selection_mask(self.solute_sel, molid)
+        total = self.removal.remove_residues(heavy & outside & ~solute &
+                                             (bad_lipids | ~lipids))
         return total
 
     #==========================================================================
@@ -738,24 +882,19 @@ class DabbleBuilder(object):
           (int) number of atoms removed due to clashes
         """
 
+        lipids = _selection_mask(lipid_sel, molid)
+        solute = _selection_mask(self.solute_sel, molid)
+
         # Select and remove solvent molecules that are clashing
-        clashing_sel = 'not (%s) and noh and not (%s) and ' \
-        '(pbwithin %f of (noh and (%s)))' % (lipid_sel,
-                                             self.solute_sel, dist,
-                                             self.solute_sel)
-        total = _remove_residues(clashing_sel, molid=molid)
+        total = self.removal.remove_residues(
+            self.clashes.atoms_near(~lipids & ~solute, solute, dist))
 
         # Select and remove lipid molecules that are clashing
+        target = solute
         if lipid_friendly_sel is not None:
-            clashing_sel_lipid = '(%s) and noh and not (%s) and ' \
-            'pbwithin %f of (noh and (%s) and not (%s))' \
-                    % (lipid_sel, self.solute_sel, dist, self.solute_sel,
-                       lipid_friendly_sel)
-        else:
-            clashing_sel_lipid = '(%s) and noh and not (%s) and ' \
-            'pbwithin %f of (noh and (%s))' % (lipid_sel, self.solute_sel,
-                                               dist, self.solute_sel)
-        total += _remove_residues(clashing_sel_lipid, molid=molid)
+            target = solute & ~_selection_mask(lipid_friendly_sel, molid)
+        total += self.removal.remove_residues(
+            self.clashes.atoms_near(lipids & ~solute, target, dist))
         return total
 
     #==========================================================================
@@ -780,23 +919,22 @@ class DabbleBuilder(object):
           (int) number of atoms removed due to sticking through rings
         """
 
-        solute_ring_sel = '(%s) and (%s)' % (self.solute_sel, ring_sel)
-        return _remove_residues('noh and (%s) and not (%s) and '
-                                'pbwithin %f of (noh and (%s))'
-                                % (lipid_sel, self.solute_sel,
-                                   dist, solute_ring_sel),
-                                molid=molid)
+        solute = _selection_mask(self.solute_sel, molid)
+        lipids = _selection_mask(lipid_sel, molid) & ~solute
+        rings = solute & _selection_mask(ring_sel, molid)
+        return self.removal.remove_residues(
+            self.clashes.atoms_near(lipids, rings, dist))
 
     #==========================================================================
 
-    def _remove_lipid_boundary_clash(self, pointy_type, ring_type, # pylint: disable=no-self-use
+    def _remove_lipid_boundary_clash(self, pointy_type, ring_type,
                                      molid, dist=1.0):
         """
         Deletes lipids that are too close to other lipids at the periodic
         boundary
 
         Args:
-    /     pointy_type (str): VMD atom selection for pointy type
+          pointy_type (str): VMD atom selection for pointy type
           ring_type (str): VMD atom selection for ring type
           molid (int): VMD molecule id to look at
           dist (float): Minimum distance between atoms, defaults to 1.0 A
@@ -804,14 +942,11 @@ class DabbleBuilder(object):
         Returns:
           (int) number of atoms removed due to boundary clash
         """
-        # TODO: arent these selections just the same?
-        sel1 = 'noh and (%s) and pbwithin %f of noh and (%s)' % (pointy_type,
-                                                                 dist,
-                                                                 ring_type)
-        sel2 = 'noh and (%s) and pbwithin %f of noh and (%s)' % (ring_type,
-                                                                 dist,
-                                                                 pointy_type)
-        return _remove_residues('(%s) or (%s)' % (sel1, sel2), molid=molid)
+        pointy = _selection_mask(pointy_type, molid)
+        ring = _selection_mask(ring_type, molid)
+        clashing = self.clashes.atoms_near(pointy, ring, dist) | \
+                   self.clashes.atoms_near(ring, pointy, dist)
+        return self.removal.remove_residues(clashing)
 
     #==========================================================================
 
@@ -920,19 +1055,12 @@ class DabbleBuilder(object):
         # Center the system according to VMD's internal metric, then
         # move the protein in the xy plane so that there is equal padding
         # on either side
-        molid = molutils.center_system(molid=molid, tmp_dir=self.opts.get('tmp_dir'),
-                                       center_z=self.water_only)
+        molid = molutils.center_system(molid=molid, center_z=self.water_only)
         system = atomsel('all', molid=molid)
         tx = (-max(system.get('x')) - min(system.get('x')))/2.
         ty = (-max(system.get('y')) - min(system.get('y')))/2.
-        temp_mae = tempfile.mkstemp(suffix='.mae',
-                                    prefix='dabble_centered',
-                                    dir=self.opts.get('tmp_dir'))[1]
         system.moveby((tx, ty, 0))
-        system.write('mae', temp_mae)
-        molecule.delete(molid)
-        new_id = molecule.load('mae', temp_mae)
-        return new_id
+        return molid
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 #                           MODULE FUNCTIONS
@@ -963,7 +1091,7 @@ def _find_convertible_water_molecule(molid, # pylint: disable=invalid-name
     if len(sel) == 0:
         raise ValueError("No convertible water molecules found in %s" % sel)
 
-    return sel.get('index')[random.randint(0, len(sel))]
+    return sel.get('index')[random.randint(0, len(sel)-1)]
 
 #==========================================================================
 
@@ -1014,20 +1142,131 @@ def _remove_atoms(sel, molid):
 
 #==========================================================================
 
-def _remove_residues(sel, molid):
+def _get_removal_mask(molid):
     """
-    Marks all residues containing an atom in the selection for deletion.
-    IMPORTANT - atoms are not actually deleted until next call to write!
+    Tracks remaining atoms in a molecule, starting from those with beta 1
 
     Args:
-      sel (str): VMD atom selection string to remove
       molid (int): VMD molecule ID to consider
 
     Returns:
-      (int): The number of atoms removed
+      (RemovalMask): Mask of remaining atoms
+    """
+    allsel = atomsel('all', molid=molid)
+    return RemovalMask(residues=allsel.get('residue'),
+                       fragments=allsel.get('fragment'),
+                       remaining=np.array(allsel.get('beta')) == 1)
+
+#==========================================================================
+
+def _selection_mask(sel, molid):
+    """
+    Converts a VMD atom selection to a mask over all atoms
+
+    Args:
+      sel (str): VMD atom selection string
+      molid (int): VMD molecule ID to consider
+
+    Returns:
+      (numpy array of bools): True for atoms in the selection
+    """
+    mask = np.zeros(molecule.numatoms(molid), dtype=bool)
+    mask[atomsel(sel, molid=molid).get('index')] = True
+    return mask
+
+#==========================================================================
+
+def _get_coords(molid):
+    """
+    Args:
+      molid (int): VMD molecule ID to consider
+
+    Returns:
+      (numpy Nx3 array) coordinates of every atom in the molecule
+    """
+    allsel = atomsel('all', molid=molid)
+    return np.column_stack([allsel.get('x'), allsel.get('y'), allsel.get('z')])
+
+#==========================================================================
+
+def _get_clash_detector(molid):
+    """
+    Indexes the heavy atoms of a molecule for clash checks, using the
+    current coordinates and periodic box.
+
+    Args:
+      molid (int): VMD molecule ID to index
+
+    Returns:
+      (ClashDetector): Spatial index over the molecule
+    """
+    box = molecule.get_periodic(molid)
+    return ClashDetector(coords=_get_coords(molid),
+                         residues=atomsel('all', molid=molid).get('residue'),
+                         box=[box['a'], box['b'], box['c']],
+                         heavy=_selection_mask('noh', molid),
+                         cutoff=_CLASH_CUTOFF)
+
+#==========================================================================
+
+def _remove_residues_in_turn(removal, selections):
+    """
+    Removes the residues of several atom selections with one update of
+    the removal mask. Atoms are counted for each selection in turn, as
+    if the selections were removed one after another, so atoms already
+    taken by an earlier selection are not counted again.
+
+    Args:
+      removal (RemovalMask): Atoms remaining in the molecule
+      selections (list of arrays of N bools): Atoms whose residues should
+        be removed
+
+    Returns:
+      (int) number of atoms removed that were still present
+    """
+    removed = np.zeros(len(removal), dtype=bool)
+    total = 0
+    for atoms in selections:
+        residues = removal.residue_mask(atoms) & ~removed
+        total += removal.count(residues)
+        removed |= residues
+    removal.remove_atoms(removed)
+    return total
+
+def _combine_without_overlaps(buffers, residues):
+    """
+    Combines a system with solvent added to it, leaving out added residues
+    with a heavy atom overlapping the system. Only the system's own atoms
+    are checked against, without periodic images, as the added solvent is
+    cut to fit the box.
+
+    Args:
+      buffers (list of MoleculeBuffer): The system, then the added solvent
+      residues (list of arrays of int): Residue of each atom in each buffer,
+        numbered within that buffer
+
+    Returns:
+      (MoleculeBuffer) the combined system
     """
+    combined = MoleculeBuffer.concatenate(buffers)
+    offsets = np.cumsum([0] + [r.max() + 1 if len(r) else 0
+                               for r in residues[:-1]])
+    added = np.arange(len(combined)) >= len(buffers[0])
+    clashes = ClashDetector(coords=combined.coords,
+                            residues=np.concatenate([r + off for r, off
+                                                     in zip(residues,
+                                                            offsets)]),
+                            box=[0., 0., 0.],
+                            heavy=combined.fields['atomicnumber'] != 1,
+                            cutoff=_CLASH_CUTOFF)
+    overlapping = clashes.residues_near(added, ~added, _CLASH_CUTOFF)
+    if np.any(overlapping):
+        print("\tLeft out %d water atoms overlapping the system"
+              % np.count_nonzero(overlapping))
+        combined = combined.take(np.flatnonzero(~overlapping))
+    return combined
 
-    return _remove_atoms('same residue as (%s)' % sel, molid)
+#==========================================================================
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 #                            PUBLIC FUNCTIONS                             #
@@ -1055,6 +1294,117 @@ def add_salt_ion(element, molid):
 
 #==========================================================================
 
+def add_salt_ions(elements, molid, removal=None, water_sel='resname TIP3',
+                  min_ion_dist=5.0):
+    """
+    Changes several water molecules to salt ions at once. Convertible
+    water oxygens are found once, then ions are placed one after another
+    at random, excluding remaining candidates near each new ion. This
+    gives the same result as calling add_salt_ion for each element in
+    turn.
+
+    Args:
+      elements (list of str): Ions to add, in order
+      molid (int): VMD molecule id to consider
+      removal (RemovalMask): Atoms remaining in the molecule, or None to
+        use those with beta 1. The beta field is updated either way.
+      water_sel (str): VMD atom selection for water
+      min_ion_dist (float): Minimum distance between ions
+
+    Raises:
+      AssertionException : if an element is not supported
+      ValueError if there are not enough convertible water molecules
+
+    Returns:
+      (list of int) the indices of the water molecules that were replaced
+    """
+    # pylint: disable=too-many-locals
+    assert all(e in ['Na', 'K', 'Cl'] for e in elements), \
+            'element must be Na, K, or Cl'
+    if not elements:
+        return []
+
+    if removal is None:
+        removal = _get_removal_mask(molid)
+
+    allsel = atomsel('all', molid=molid)
+    box = molecule.get_periodic(molid)
+    detector = ClashDetector(coords=np.column_stack([allsel.get('x'),
+                                                     allsel.get('y'),
+                                                     allsel.get('z')]),
+                             residues=allsel.get('residue'),
+                             box=[box['a'], box['b'], box['c']],
+                             cutoff=min_ion_dist)
+
+    # Water oxygens not near anything else are the initial candidates
+    waters = _selection_mask(water_sel, molid) & removal.remaining
+    others = ~waters & removal.remaining
+    waters &= _selection_mask('noh', molid)
+    candidates = waters & ~detector.atoms_near(waters, others, min_ion_dist)
+
+    placed = _place_ions(detector, candidates, len(elements), min_ion_dist)
+
+    # Convert all the chosen waters, grouped by ion
+    for element in sorted(set(elements)):
+        molutils.set_ions(molid, placed[np.array(elements) == element].tolist(),
+                          element)
+    _remove_ion_hydrogens(removal, placed,
+                          _selection_mask('element H', molid))
+    allsel.set('beta', removal.remaining.astype(float).tolist())
+
+    return placed.tolist()
+
+#==========================================================================
+
+def _place_ions(detector, candidates, count, min_ion_dist):
+    """
+    Picks water oxygens to convert to ions one after another at random,
+    removing candidates that are too close to each new ion
+
+    Args:
+      detector (ClashDetector): Spatial index over the molecule
+      candidates (array of N bools): Water oxygens that may be converted
+      count (int): Number of ions to place
+      min_ion_dist (float): Minimum distance between ions
+
+    Returns:
+      (numpy array of ints) atom index of each chosen oxygen, in order
+
+    Raises:
+      ValueError if there are not enough convertible water molecules
+    """
+    candidates = np.array(candidates, dtype=bool)
+    placed = []
+    for _ in range(count):
+        indices = np.flatnonzero(candidates)
+        if not len(indices):
+            raise ValueError("No convertible water molecules found for "
+                             "ion %d of %d" % (len(placed)+1, count))
+        atom_id = int(indices[random.randint(0, len(indices)-1)])
+        candidates[detector.neighbors(atom_id, min_ion_dist)] = False
+        placed.append(atom_id)
+    return np.array(placed, dtype=int)
+
+#==========================================================================
+
+def _remove_ion_hydrogens(removal, placed, hydrogens):
+    """
+    Removes the hydrogens of waters whose oxygen became an ion
+
+    Args:
+      removal (RemovalMask): Atoms remaining in the molecule
+      placed (array of ints): Atom index of each converted oxygen
+      hydrogens (array of N bools): Hydrogen atoms in the molecule
+
+    Returns:
+      (int) number of hydrogens removed
+    """
+    converted = np.zeros(len(removal), dtype=bool)
+    converted[placed] = True
+    return removal.remove_atoms(hydrogens & removal.residue_mask(converted))
+
+#==========================================================================
+
 def tile_membrane_patch(input_id, min_size, tmp_dir, allow_z_tile):
     """
     Tiles a system in the x and y dimension (z currently unsupported) to
@@ -1071,13 +1421,8 @@ def tile_membrane_patch(input_id, min_size, tmp_dir, allow_z_tile):
       (int 3x) number of times tiled in x, y, z direction
     """
 
-    mem_dimensions = np.array(molutils.get_system_dimensions(molid=input_id))
-    times_x, times_y, times_z = [int(times) for times in \
-            np.ceil(min_size / mem_dimensions)]
-
-    # Disallow tiling in Z direction
-    if not allow_z_tile:
-        times_z = 1
+    times_x, times_y, times_z = _get_tile_times(input_id, min_size,
+                                                allow_z_tile)
 
     # If there is not enough water in the Z direction, it will be added later
 
@@ -1089,4 +1434,82 @@ def tile_membrane_patch(input_id, min_size, tmp_dir, allow_z_tile):
 
     return output_id, (times_x, times_y, times_z)
 
+#==========================================================================
+
+def get_membrane_filename(membrane_system):
+    """
+    Resolves the name of one of the included solvent systems to a file
+
+    Args:
+      membrane_system (str): 'DEFAULT' or None for a POPC membrane, 'TIP3'
+        for a water box, or the path to a solvent file
+
+    Returns:
+      (str) path to the solvent file
+    """
+    if membrane_system is None or membrane_system == 'DEFAULT':
+        return resource_filename(__name__, "lipid_membranes/popc.mae")
+    elif membrane_system == 'TIP3':
+        return resource_filename(__name__, "lipid_membranes/tip3pbox.mae")
+    return membrane_system
+
+#==========================================================================
+
+def tile_solvent_patch(input_id, min_size, allow_z_tile, center_z,
+                       cache=None, tmp_dir=None):
+    """
+    Tiles a solvent patch to at least the given size and centers it. If
+    a cache is given, a previously tiled and centered copy of the same
+    patch is loaded from it instead, and new results are saved to it.
+
+    Args:
+      input_id (int): VMD molecule id to tile
+      min_size (array of 3 floats): Final system X, Y, Z dimension
+      allow_z_tile (bool): Whether to allow tiling in the Z direction
+      center_z (bool): Whether to center along the Z axis as well as XY
+      cache (PatchCache): Cache of tiled patches, or None
+      tmp_dir (str): Unused, kept for compatibility
+
+    Returns:
+      (int) output molecule id
+      (int 3x) number of times tiled in x, y, z direction
+    """
+    times = _get_tile_times(input_id, min_size, allow_z_tile)
+    if cache is not None:
+        key = cache.key(MoleculeBuffer.from_molid(input_id), times, center_z)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached.to_molid('dabble_tiled'), times
+
+    output_id, times = tile_membrane_patch(input_id, min_size, tmp_dir,
+                                           allow_z_tile)
+    molutils.center_system(molid=output_id, center_z=center_z)
+    if cache is not None:
+        cache.put(key, MoleculeBuffer.from_molid(output_id))
+    return output_id, times
+
+#==========================================================================
+
+def _get_tile_times(input_id, min_size, allow_z_tile):
+    """
+    Computes how many times a patch must be tiled to reach a size
+
+    Args:
+      input_id (int): VMD molecule id to tile
+      min_size (array of 3 floats): Final system X, Y, Z dimension
+      allow_z_tile (bool): Whether to allow tiling in the Z direction
+
+    Returns:
+      (int 3x) number of times to tile in x, y, z direction
+    """
+    mem_dimensions = np.array(molutils.get_system_dimensions(molid=input_id))
+    times_x, times_y, times_z = [int(times) for times in \
+            np.ceil(min_size / mem_dimensions)]
+
+    # Disallow tiling in Z direction
+    if not allow_z_tile:
+        times_z = 1
+
+    return times_x, times_y, times_z
+
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -0,0 +1,202 @@
+"""
+This module contains the Checkpointer class, which saves snapshots of a
+system after each major stage of a build so that a failed or modified
+build can resume from the last stage whose inputs are unchanged.
+
+Author: Robin Betz
+
+Copyright (C) 2015 Robin Betz
+
+This program is free software; you can redistribute it and/or modify it under
+the terms of the GNU Lesser General Public License as published by the Free
+Software Foundation; either version 2 of the License, or (at your option) any
+later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place - Suite 330
+Boston, MA 02111-1307, USA.
+"""
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+
+# pylint: disable=import-error, unused-import
+import vmd
+import molecule
+# pylint: enable=import-error, unused-import
+
+from Dabble.fileutils import hash_file
+from Dabble.molbuffer import MoleculeBuffer
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Build stages that are checkpointed, in order
+STAGES = ('oriented', 'tiled', 'combined', 'trimmed', 'ionized')
+
+# Input files and options each stage depends on, beyond those of the
+# stages before it
+_STAGE_FILES = {
+    'oriented': ('solute_filename', 'membrane_system', 'opm_pdb'),
+}
+_STAGE_OPTIONS = {
+    'oriented': ('lipid_sel', 'opm_align', 'z_move', 'z_rotation'),
+    'tiled': ('xy_buf', 'wat_buffer', 'user_x', 'user_y', 'user_z'),
+    'combined': (),
+    'trimmed': ('lipid_sel', 'lipid_friendly_sel', 'clash_lipids'),
+    'ionized': ('salt_conc', 'cation'),
+}
+
+# Bump when the snapshot layout or the build itself changes
+_VERSION = 1
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                                   CLASSES                                   #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+class Checkpointer(object):
+    """
+    Saves and loads build snapshots. Each stage has a key hashing its
+    input files and options together with the key of the previous
+    stage, so changing an input invalidates every later checkpoint.
+
+    Attributes:
+      directory (str): Directory snapshots are saved in
+      resume (bool): Whether existing snapshots may be loaded
+      keys (dict str -> str): Hash of the inputs to each stage
+    """
+
+    #==========================================================================
+
+    def __init__(self, directory, opts, resume=False):
+        """
+        Args:
+          directory (str): Directory to save snapshots in
+          opts (dict): Builder options
+          resume (bool): Whether existing snapshots may be loaded
+        """
+        self.directory = directory
+        self.resume = resume
+        self.keys = {}
+
+        key = str(_VERSION)
+        for stage in STAGES:
+            digest = hashlib.sha1(key.encode('utf-8'))
+            for option in _STAGE_FILES.get(stage, ()):
+                digest.update(str(hash_file(opts.get(option))).encode('utf-8'))
+            digest.update(json.dumps([opts.get(o) for o in
+                                      _STAGE_OPTIONS[stage]]).encode('utf-8'))
+            key = digest.hexdigest()
+            self.keys[stage] = key
+
+    #=========================================================================
+    #                            Public methods                              #
+    #=========================================================================
+
+    def save(self, stage, molids, state):
+        """
+        Saves a snapshot of the molecules in the system after a stage
+
+        Args:
+          stage (str): Stage that was just completed
+          molids (dict str -> int): Molecules in the system, by description.
+            Molecules that no longer exist are skipped
+          state (dict): Other builder state to save, must be JSON
+            serializable
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Molecules may be stored under several descriptions
+        saved = {}
+        for desc, molid in sorted(molids.items()):
+            if not molecule.exists(molid):
+                continue
+            if molid not in saved:
+                saved[molid] = "%s_%d.npz" % (stage, len(saved))
+                MoleculeBuffer.from_molid(molid).save(
+                    os.path.join(self.directory, saved[molid]))
+
+        with open(self._metadata_filename(stage), 'w') as fileh:
+            json.dump({'key': self.keys[stage],
+                       'molecules': dict((desc, saved[molid])
+                                         for desc, molid in molids.items()
+                                         if molid in saved),
+                       'state': state}, fileh, indent=2)
+
+    #==========================================================================
+
+    def latest(self):
+        """
+        Finds the last stage with a snapshot matching the current inputs
+
+        Returns:
+          (str) name of the stage, or None if there is nothing to resume
+        """
+        if not self.resume:
+            return None
+
+        for stage in reversed(STAGES):
+            metadata = self._read_metadata(stage)
+            if metadata is not None and metadata['key'] == self.keys[stage] \
+               and all(os.path.isfile(os.path.join(self.directory, f))
+                       for f in metadata['molecules'].values()):
+                return stage
+        return None
+
+    #==========================================================================
+
+    def load(self, stage):
+        """
+        Loads a snapshot into new VMD molecules
+
+        Args:
+          stage (str): Stage to load
+
+        Returns:
+          (dict str -> int) molecule ids by description
+          (dict) other builder state that was saved
+
+        Raises:
+          ValueError if there is no snapshot for the stage
+        """
+        metadata = self._read_metadata(stage)
+        if metadata is None:
+            raise ValueError("No checkpoint found for stage '%s'" % stage)
+
+        loaded = {}
+        molids = {}
+        for desc, filename in metadata['molecules'].items():
+            if filename not in loaded:
+                buf = MoleculeBuffer.load(os.path.join(self.directory,
+                                                       filename))
+                loaded[filename] = buf.to_molid('dabble_%s' % desc)
+            molids[desc] = loaded[filename]
+        return molids, metadata['state']
+
+    #=========================================================================
+    #                           Private methods                              #
+    #=========================================================================
+
+    def _metadata_filename(self, stage):
+        return os.path.join(self.directory, "%s.json" % stage)
+
+    #==========================================================================
+
+    def _read_metadata(self, stage):
+        """
+        Returns:
+          (dict) saved metadata for the stage, or None if not present
+        """
+        if not os.path.isfile(self._metadata_filename(stage)):
+            return None
+        with open(self._metadata_filename(stage)) as fileh:
+            return json.load(fileh)
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -0,0 +1,275 @@
+"""
+This module contains the ClashDetector class, a periodic cell list over
+the heavy atoms of a built system. It answers which residues have atoms
+within some distance of a set of other atoms, replacing pbwithin atom
+selections that VMD would otherwise evaluate over the whole system.
+
+Author: Robin Betz
+
+Copyright (C) 2015 Robin Betz
+
+This program is free software; you can redistribute it and/or modify it under
+the terms of the GNU Lesser General Public License as published by the Free
+Software Foundation; either version 2 of the License, or (at your option) any
+later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place - Suite 330
+Boston, MA 02111-1307, USA.
+"""
+
+from __future__ import print_function
+from itertools import product
+import numpy as np
+
+from Dabble.removal import group_mask
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                                   CLASSES                                   #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+class ClashDetector(object):
+    """
+    Bins the heavy atoms of a system into a periodic cell list, so that
+    atoms near another set of atoms can be found by only checking
+    neighbouring cells. Coordinates are fixed when the detector is
+    built, so one detector can be shared by every clash removal pass
+    on a system.
+
+    Attributes:
+      coords (numpy Nx3 array): Atom coordinates
+      residues (numpy array of N ints): Residue each atom belongs to
+      heavy (numpy array of N bools): Which atoms are indexed
+      box (numpy array of 3 floats): Periodic box dimensions
+      cutoff (float): Largest distance that can be queried
+    """
+
+    #==========================================================================
+
+    def __init__(self, coords, residues, box, heavy=None, cutoff=1.75):
+        """
+        Builds the cell list
+
+        Args:
+          coords (numpy Nx3 array): Atom coordinates
+          residues (array of N ints): Residue number of each atom
+          box (array of 3 floats): Periodic box dimensions. Dimensions
+            that are zero are treated as non periodic
+          heavy (array of N bools): Atoms to index, or None for all atoms
+          cutoff (float): Largest distance that will be queried
+
+        Raises:
+          ValueError if cutoff is not positive
+        """
+        if cutoff <= 0:
+            raise ValueError("Clash cutoff must be positive, got %f" % cutoff)
+
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        self.residues = np.asarray(residues, dtype=int)
+        if heavy is None:
+            heavy = np.ones(len(self.coords), dtype=bool)
+        self.heavy = np.asarray(heavy, dtype=bool)
+        self.cutoff = float(cutoff)
+
+        # Non periodic dimensions get a box wide enough that the minimum
+        # image convention never wraps them
+        self.box = np.array(box, dtype=float)
+        span = np.ptp(self.coords, axis=0) if len(self.coords) \
+               else np.zeros(3)
+        flat = self.box <= 0.
+        self.box[flat] = 2.*(span[flat] + self.cutoff) + 1.
+
+        # Cells are at least as wide as the cutoff so all neighbours
+        # of an atom are in the adjacent cells
+        self._ncells = np.maximum(np.floor(self.box / self.cutoff), 1)
+        self._ncells = self._ncells.astype(int)
+        self._cells = np.floor(np.mod(self.coords, self.box) / self.box
+                               * self._ncells).astype(int)
+        self._cells = np.minimum(self._cells, self._ncells - 1)
+
+        # Only check distinct neighbouring cells if there are few cells
+        self._offsets = np.array(list(product(*[[-1, 0, 1] if n >= 3
+                                                else range(n)
+                                                for n in self._ncells])))
+
+        # Heavy atoms sorted by cell, for lookups around single atoms
+        self._sorted, self._sorted_cells = \
+                self._sort_by_cell(np.flatnonzero(self.heavy))
+
+    #=========================================================================
+    #                            Public methods                              #
+    #=========================================================================
+
+    def atoms_near(self, query, target, dist):
+        """
+        Finds heavy atoms within a distance of any target heavy atom,
+        using the minimum image convention.
+
+        Args:
+          query (array of N bools): Atoms to check
+          target (array of N bools): Atoms to measure distance to
+          dist (float): Distance cutoff, at most the detector cutoff
+
+        Returns:
+          (numpy array of N bools) query atoms near a target atom
+
+        Raises:
+          ValueError if dist is larger than the detector cutoff
+        """
+        if dist > self.cutoff:
+            raise ValueError("Clash distance %f is larger than detector "
+                             "cutoff %f" % (dist, self.cutoff))
+
+        result = np.zeros(len(self.coords), dtype=bool)
+        qidx = np.flatnonzero(np.asarray(query, dtype=bool) & self.heavy)
+        tidx = np.flatnonzero(np.asarray(target, dtype=bool) & self.heavy)
+        if not len(qidx) or not len(tidx):
+            return result
+
+        # Sort target atoms by cell so each cell is a contiguous range
+        tidx, tcells = self._sort_by_cell(tidx)
+
+        for offset in self._offsets:
+            pairs_q, pairs_t = self._cell_pairs(qidx, offset, tidx, tcells)
+            close = self._distances(pairs_q, pairs_t) <= dist*dist
+            result[pairs_q[close]] = True
+
+        return result
+
+    #==========================================================================
+
+    def residues_near(self, query, target, dist):
+        """
+        Finds whole residues with a query heavy atom within a distance of
+        any target heavy atom. This is the same as the VMD selection
+        "same residue as (noh and query and pbwithin dist of noh and target)"
+
+        Args:
+          query (array of N bools): Atoms to check
+          target (array of N bools): Atoms to measure distance to
+          dist (float): Distance cutoff, at most the detector cutoff
+
+        Returns:
+          (numpy array of N bools) atoms in residues that clash
+        """
+        return self.residue_mask(self.atoms_near(query, target, dist))
+
+    #==========================================================================
+
+    def neighbors(self, index, dist):
+        """
+        Finds heavy atoms within a distance of a single atom, using the
+        minimum image convention. The atom itself is included if it
+        is a heavy atom.
+
+        Args:
+          index (int): Atom to look around
+          dist (float): Distance cutoff, at most the detector cutoff
+
+        Returns:
+          (numpy array of ints) sorted indices of nearby heavy atoms
+
+        Raises:
+          ValueError if dist is larger than the detector cutoff
+        """
+        if dist > self.cutoff:
+            raise ValueError("Neighbor distance %f is larger than detector "
+                             "cutoff %f" % (dist, self.cutoff))
+
+        found = []
+        for offset in self._offsets:
+            pairs_q, pairs_t = self._cell_pairs(np.array([index]), offset,
+                                                self._sorted,
+                                                self._sorted_cells)
+            found.append(pairs_t[self._distances(pairs_q, pairs_t)
+                                 <= dist*dist])
+        return np.unique(np.concatenate(found))
+
+    #==========================================================================
+
+    def residue_mask(self, atoms):
+        """
+        Expands an atom mask to cover every atom in the same residues
+
+        Args:
+          atoms (array of N bools): Atoms to expand
+
+        Returns:
+          (numpy array of N bools) all atoms in residues containing
+            a selected atom
+        """
+        return group_mask(self.residues, atoms)
+
+    #=========================================================================
+    #                           Private methods                              #
+    #=========================================================================
+
+    def _flat_cell(self, cells):
+        """
+        Converts per-dimension cell indices, which may be one outside the
+        grid, to a single periodic cell index
+        """
+        cells = np.mod(cells, self._ncells)
+        return (cells[:, 0] * self._ncells[1] + cells[:, 1]) \
+               * self._ncells[2] + cells[:, 2]
+
+    #==========================================================================
+
+    def _sort_by_cell(self, indices):
+        """
+        Orders atoms by cell so each cell is a contiguous range
+
+        Returns:
+          (numpy array of ints) sorted atom indices
+          (numpy array of ints) cell of each sorted atom
+        """
+        cells = self._flat_cell(self._cells[indices])
+        order = np.argsort(cells, kind='mergesort')
+        return indices[order], cells[order]
+
+    #==========================================================================
+
+    def _cell_pairs(self, qidx, offset, tidx, tcells):
+        """
+        Pairs each query atom with every target atom in the cell at an
+        offset from its own
+
+        Args:
+          qidx (numpy array of ints): Query atom indices
+          offset (numpy array of 3 ints): Cell offset to look in
+          tidx (numpy array of ints): Target atom indices, sorted by cell
+          tcells (numpy array of ints): Cell of each sorted target atom
+
+        Returns:
+          (numpy array of ints) query atom of each pair
+          (numpy array of ints) target atom of each pair
+        """
+        ncell = self._flat_cell(self._cells[qidx] + offset)
+        start = np.searchsorted(tcells, ncell, side='left')
+        counts = np.searchsorted(tcells, ncell, side='right') - start
+        if not counts.sum():
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        ends = np.cumsum(counts)
+        return np.repeat(qidx, counts), \
+               tidx[np.repeat(start - ends + counts, counts)
+                    + np.arange(ends[-1])]
+
+    #==========================================================================
+
+    def _distances(self, first, second):
+        """
+        Returns:
+          (numpy array of floats) squared minimum image distance between
+            each pair of atoms
+        """
+        delta = self.coords[first] - self.coords[second]
+        delta -= self.box * np.round(delta / self.box)
+        return np.einsum('ij,ij->i', delta, delta)
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
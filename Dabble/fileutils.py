@@ -22,8 +22,10 @@ Boston, MA 02111-1307, USA.
 """
 
 from __future__ import print_function
+import hashlib
 import os
-import tempfile
+import shutil
+import numpy as np
 
 # pylint: disable=import-error, unused-import
 import vmd
@@ -31,7 +33,38 @@ import molecule
 from atomsel import atomsel
 # pylint: enable=import-error, unused-import
 
-from Dabble.param import AmberWriter, CharmmWriter
+from Dabble.molbuffer import MoleculeBuffer
+from Dabble.profiling import StageProfiler
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Atom record in the pdb files written for psfgen and leap
+_PDB_ATOM = ('%-6s%5d %-5s%-4s%c%4d    %8.3f%8.3f%8.3f%6.2f%6.2f'
+             '     %-4s%2s\n')
+
+# Per-atom VMD fields needed to write a pdb file
+_PDB_FIELDS = ('index', 'residue', 'name', 'resname', 'chain', 'resid',
+               'segname', 'element')
+
+# Header that starts every mae file, before the first CT block
+_MAE_HEADER = "{\n  s_m_m2io_version\n  :::\n  2.0.0\n}\n"
+
+# Per-atom columns of a CT block, as VMD writes them
+_MAE_ATOM_COLUMNS = ('i_m_mmod_type', 'r_m_x_coord', 'r_m_y_coord',
+                     'r_m_z_coord', 'i_m_residue_number', 's_m_insertion_code',
+                     's_m_mmod_res', 's_m_chain_name', 'i_m_color',
+                     'r_m_charge1', 'r_m_charge2', 's_m_pdb_residue_name',
+                     's_m_pdb_atom_name', 's_m_grow_name', 'i_m_atomic_number',
+                     'i_m_formal_charge', 'i_m_visibility',
+                     's_m_pdb_segment_name', 'r_ffio_x_vel', 'r_ffio_y_vel',
+                     'r_ffio_z_vel')
+
+# MacroModel atom type and Maestro color for each element, by atomic number.
+# Other elements get the generic type and carbon's color.
+_MAE_ELEMENTS = {1: (48, 21), 6: (14, 2), 7: (40, 43), 8: (23, 70),
+                 9: (56, 2), 11: (66, 4), 15: (53, 15), 16: (52, 2),
+                 17: (57, 2), 19: (67, 2), 35: (58, 2), 53: (59, 2)}
+_MAE_DEFAULT_ELEMENT = (64, 2)
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
@@ -41,7 +74,7 @@ def load_solute(filename, tmp_dir):
 
     Args:
       filename (str): Filename to load
-      tmp_dir (str): Directory to put temporary files in
+      tmp_dir (str): Unused, kept for compatibility
 
     Returns:
       (int) VMD molecule ID that was loaded
@@ -49,6 +82,7 @@ def load_solute(filename, tmp_dir):
     Raises:
       ValueError if filetype is currently unsupported
     """
+    # pylint: disable=unused-argument
     if len(filename) < 3:
         raise ValueError("Cannot determine filetype of input file '%s'"
                          % filename)
@@ -58,13 +92,9 @@ def load_solute(filename, tmp_dir):
     elif ext == 'dms':
         molid = molecule.load('dms', filename)
     elif ext == 'pdb':
-        # Need to convert to MAE so concatenation will work later
-        temp_mae = tempfile.mkstemp(suffix='.mae', prefix='dabble_input',
-                                    dir=tmp_dir)[1]
         molid = molecule.load('pdb', filename)
-        atomsel('all').write('mae', temp_mae)
-        molecule.delete(molid)
-        molid = molecule.load('mae', temp_mae)
+    elif ext == 'npz':
+        molid = MoleculeBuffer.load(filename).to_molid(os.path.basename(filename))
     else:
         raise ValueError("Filetype '%s' currently unsupported "
                          "for input protein" % ext)
@@ -81,16 +111,14 @@ def concatenate_mae_files(output_filename,
     the input molecules superimposed.
     Either takes a list of files to concatenate, or a list of VMD molecule
     ids. If molecule ids are given, VMD's interface is used to get the filename
-    corresponding to each id.
+    corresponding to each id. Files are copied in blocks, with the header
+    skipped for all but the first.
 
     Args:
       output_filename (str): Filename to write
       input_filenames (list of str): List of input mae files to combine, OR:
       input_ids (list of int): List of input molecules to combine
 
-    Returns:
-      True if successful
-
     Raises:
       ValueError: if input_filenames and input_ids are both specified
       AssertionError: if there are no input files
@@ -104,55 +132,116 @@ def concatenate_mae_files(output_filename,
         input_filenames = [(molecule.get_filenames(i))[0] for i in input_ids]
 
     assert len(input_filenames) > 0, 'need at least one input filename'
-    outfile = open(output_filename, 'w')
-    for line in open(input_filenames[0]):
-        outfile.write(line)
-    for input_filename in input_filenames[1:]:
-        infile = open(input_filename)
-        for i in xrange(5):
-            infile.readline()
-        for line in infile:
-            outfile.write(line)
-    outfile.close()
-    return
+    with open(output_filename, 'w') as outfile:
+        for i, input_filename in enumerate(input_filenames):
+            with open(input_filename) as infile:
+                if i:
+                    for _ in range(_MAE_HEADER.count('\n')):
+                        infile.readline()
+                shutil.copyfileobj(infile, outfile)
 
 #==========================================================================
 
-def write_ct_blocks(molid, sel, output_filename, tmp_dir):
+def write_ct_blocks(molid, sel, output_filename, tmp_dir=None):
     """
-    Writes a mae format file containing the specified selection.
+    Writes a mae format file containing the specified selection, with
+    one CT block for each distinct value of the user field.
 
     Args:
       molid (int): VMD molecule ID to write
       sel (str): the selection to write
       output_filename (str): the file to write to, including .mae extension
-      tmp_dir (str): Directory to put files in
+      tmp_dir (str): Unused, nothing is written besides the output file
 
     Returns:
       length (int): the number of CT blocks written
     """
-    users = sorted(set(atomsel(sel, molid=molid).get('user')))
-    filenames = [(tempfile.mkstemp(suffix='.mae',
-                                   prefix='dabble_tmp_user',
-                                   dir=tmp_dir))[1] for _ in users]
-    length = len(users)
-
-    for i, filen in zip(users, filenames):
-        tempsel = atomsel('user %f and (%s)' % (i, sel), molid=molid)
-        sel2 = atomsel('index ' + \
-                       ' '.join([str(s) for s in set(tempsel.get('index'))]),
-                       molid=molid)
-        sel2.set('user', 0.0)
-        sel2.write('mae', filen)
-
-    # Option lets us specify if we should write a pdb/psf or just a mae file
-    # Either way it writes a temp mae file, hacky but it works
-    concatenate_mae_files(output_filename, input_filenames=filenames)
-
-    # Clean up
-    for filename in filenames:
-        os.remove(filename) # delete temporary files
-    return length
+    # pylint: disable=unused-argument
+    system = MoleculeBuffer.from_molid(molid, sel)
+    users = np.unique(system.fields['user'])
+    write_mae(output_filename,
+              [system.take(np.flatnonzero(system.fields['user'] == user))
+               for user in users])
+    return len(users)
+
+#==========================================================================
+
+def write_mae(filename, buffers):
+    """
+    Writes molecules to a new mae file, each as its own CT block
+
+    Args:
+      filename (str): File to write
+      buffers (list of MoleculeBuffer): Molecules to write, in order
+    """
+    with open(filename, 'w') as fileh:
+        fileh.write(_MAE_HEADER)
+        for buf in buffers:
+            write_ct_block(fileh, buf)
+
+#==========================================================================
+
+def write_ct_block(fileh, buf, title=""):
+    """
+    Writes a molecule as one mae CT block, in the same layout as VMD's
+    mae writer. Each section is formatted and then written at once.
+
+    Args:
+      fileh (file handle): File to write to, after the mae header
+      buf (MoleculeBuffer): Molecule to write
+      title (str): Title of the CT block
+    """
+    box = [buf.box[0], 0, 0, 0, buf.box[1], 0, 0, 0, buf.box[2]]
+    fileh.write("f_m_ct {\n  s_m_title\n%s  :::\n  %s\n%s"
+                % (''.join("  r_chorus_box_%s%s\n" % (vec, dim)
+                           for vec in "abc" for dim in "xyz"),
+                   _mae_string(title),
+                   ''.join("  %s\n" % _mae_float(b) for b in box)))
+
+    fields = buf.fields
+    elements = [_MAE_ELEMENTS.get(anum, _MAE_DEFAULT_ELEMENT)
+                for anum in fields['atomicnumber'].tolist()]
+    charges = fields['charge'].tolist()
+    rows = zip(range(1, len(buf) + 1), elements, buf.coords.tolist(),
+               fields['resid'].tolist(), fields['insertion'].tolist(),
+               fields['chain'].tolist(), fields['resname'].tolist(),
+               fields['name'].tolist(), fields['atomicnumber'].tolist(),
+               charges, fields['segname'].tolist())
+    fileh.write("  m_atom[%d] {\n    # First column is atom index #\n%s"
+                "    :::\n" % (len(buf), ''.join("    %s\n" % col for col in
+                                                  _MAE_ATOM_COLUMNS)))
+    fileh.write(''.join("    %d %d %s %s %s %d %s \" \" %s %d 0 0 %s %s \" \" "
+                        "%d %d 1 %s 0 0 0 \n"
+                        % (idx, mmod, _mae_float(xyz[0]), _mae_float(xyz[1]),
+                           _mae_float(xyz[2]), resid,
+                           _mae_string(insertion or " "), _mae_string(chain),
+                           color, _mae_string("%-4s" % resname),
+                           _mae_string(name if len(name) > 3
+                                       else " %-3s" % name),
+                           anum, int(charge), _mae_string(segname))
+                        for idx, (mmod, color), xyz, resid, insertion, chain,
+                            resname, name, anum, charge, segname in rows))
+    fileh.write("    :::\n  }\n")
+
+    if len(buf.bonds):
+        fileh.write("  m_bond[%d] {\n    i_m_from\n    i_m_to\n"
+                    "    i_m_order\n    :::\n" % len(buf.bonds))
+        fileh.write(''.join("    %d %d %d %d\n" % (idx, i+1, j+1, order)
+                            for idx, (i, j), order in
+                            zip(range(1, len(buf.bonds) + 1),
+                                buf.bonds.tolist(),
+                                buf.bond_orders.tolist())))
+        fileh.write("    :::\n  }\n")
+
+    fileh.write("  ffio_ff {\n    :::\n    ffio_sites[%d] {\n"
+                "      s_ffio_type\n      r_ffio_charge\n      r_ffio_mass\n"
+                "      :::\n" % len(buf))
+    fileh.write(''.join("      %d atom %s %s\n" % (idx, _mae_float(charge),
+                                                   _mae_float(mass))
+                        for idx, charge, mass in
+                        zip(range(1, len(buf) + 1), charges,
+                            fields['mass'].tolist())))
+    fileh.write("      :::\n    }\n  }\n}\n\n")
 
 #==========================================================================
 
@@ -173,6 +262,12 @@ def write_final_system(out_fmt, out_name, molid, **kwargs):
       lipid_sel (str): Lipid selection
       hmassrepartition (bool): Whether or not to repartition hydrogen
         masses
+      native_psf (bool): Whether to build charmm psf files directly
+        instead of with psfgen
+      match_processes (int): Number of processes to match residues to
+        charmm topologies with
+      profiler (StageProfiler): Records the time taken to write each
+        format, if given
 
     Returns:
       (str) main final filename written
@@ -185,11 +280,13 @@ def write_final_system(out_fmt, out_name, molid, **kwargs):
         kwargs['lipid_sel'] = "lipid or resname POPS POPG"
     if not kwargs.get('forcefield'):
         kwargs['forcefield'] = "charmm"
+    profiler = kwargs.get('profiler') or StageProfiler()
 
     # Write a mae file always, removing the prefix from the output file
     mae_name = '.'.join(out_name.rsplit('.')[:-1]) + '.mae'
-    write_ct_blocks(molid=molid, sel='beta 1', output_filename=mae_name,
-                    tmp_dir=kwargs['tmp_dir'])
+    with profiler.stage('write_mae'):
+        write_ct_blocks(molid=molid, sel='beta 1', output_filename=mae_name,
+                        tmp_dir=kwargs['tmp_dir'])
 
     # If a converted output format (pdb or dms) desired, write that here
     # and the mae is a temp file that can be deleted
@@ -210,29 +307,28 @@ def write_final_system(out_fmt, out_name, molid, **kwargs):
     # If we want a parameterized format like amber or charmm, a psf must
     # first be written which does the atom typing, etc
 
-    tops = []; pars = []
-    if kwargs.get('extra_topos'):
-        tops.extend(kwargs.get('extra_topos'))
-    if kwargs.get('extra_params'):
-        pars.extend(kwargs.get('extra_params'))
-    if kwargs.get('extra_streams'):
-        tops.extend(kwargs.get('extra_streams'))
-        pars.extend(kwargs.get('extra_streams'))
-
+    tops, pars = get_extra_files(kwargs)
 
+    # The parameterization stack is slow to import, so it is only loaded
+    # when the output format needs it
     if out_fmt == 'charmm':
+        from Dabble.param import CharmmWriter
         temp_mol = molecule.load('mae', mae_name)
         write_psf_name = mae_name.replace('.mae', '')
         writer = CharmmWriter(molid=temp_mol,
                               tmp_dir=kwargs['tmp_dir'],
                               lipid_sel=kwargs.get('lipid_sel'),
-                              extra_topos=tops)
-        writer.write(write_psf_name)
+                              extra_topos=tops,
+                              native=kwargs.get('native_psf'),
+                              processes=kwargs.get('match_processes'))
+        with profiler.stage('write_charmm'):
+            writer.write(write_psf_name)
 
     # For amber format files, invoke the parmed chamber routine
     if out_fmt == 'amber':
         print("Writing AMBER format files with CHARMM parameters. "
               "This may take a moment...\n")
+        from Dabble.param import AmberWriter
         temp_mol = molecule.load('mae', mae_name)
         write_psf_name = mae_name.replace('.mae', '')
         writer = AmberWriter(molid=temp_mol,
@@ -242,12 +338,126 @@ def write_final_system(out_fmt, out_name, molid, **kwargs):
                              hmr=kwargs.get('hmassrepartition'),
                              extra_topos=tops,
                              extra_params=pars)
-        writer.write(write_psf_name)
+        with profiler.stage('write_amber'):
+            writer.write(write_psf_name)
 
     return out_name
 
 #==========================================================================
 
+def get_extra_files(opts):
+    """
+    Collects the extra topology and parameter files requested, with
+    stream files used as both
+
+    Args:
+      opts (dict): Options, with optional extra_topos, extra_params and
+        extra_streams lists
+
+    Returns:
+      (list of str) extra topology files
+      (list of str) extra parameter files
+    """
+    tops = []; pars = []
+    if opts.get('extra_topos'):
+        tops.extend(opts.get('extra_topos'))
+    if opts.get('extra_params'):
+        pars.extend(opts.get('extra_params'))
+    if opts.get('extra_streams'):
+        tops.extend(opts.get('extra_streams'))
+        pars.extend(opts.get('extra_streams'))
+    return tops, pars
+
+#==========================================================================
+
+def get_pdb_columns(selection):
+    """
+    Reads the atom fields needed to write a pdb file from VMD, all at once
+
+    Args:
+      selection (VMD atomsel): Atoms to read
+
+    Returns:
+      (dict str -> numpy array) index, residue, name, resname, chain,
+        resid, segname and element of each atom, plus Nx3 coords
+    """
+    columns = dict((field, np.array(selection.get(field), dtype=object))
+                   for field in _PDB_FIELDS)
+    for field in ('index', 'residue', 'resid'):
+        columns[field] = columns[field].astype(int)
+    columns['coords'] = np.column_stack([selection.get('x'),
+                                         selection.get('y'),
+                                         selection.get('z')]).reshape(-1, 3)
+    return columns
+
+#==========================================================================
+
+def write_pdb_block(fileh, columns, order=None, serial=1, resids=None,
+                    hetatm=False):
+    """
+    Writes atoms as pdb records. All the records are formatted and then
+    written at once.
+
+    Args:
+      fileh (file handle): File to write to
+      columns (dict str -> numpy array): Atom fields, as from get_pdb_columns
+      order (array of int): Positions in columns of the atoms to write, in
+        the order to write them, or None to write all atoms in order
+      serial (int): Atom serial number of the first atom written
+      resids (array of int): Resid to write for each written atom, or None
+        to use the resids in columns
+      hetatm (bool): Whether to write HETATM rather than ATOM records
+
+    Returns:
+      (int) atom serial number following the last atom written
+    """
+    if order is None:
+        order = np.arange(len(columns['name']))
+    order = np.asarray(order, dtype=int)
+    if resids is None:
+        resids = columns['resid'][order]
+    record = "HETATM" if hetatm else "ATOM"
+
+    coords = columns['coords'][order].tolist()
+    rows = zip(range(serial, serial + len(order)),
+               columns['name'][order].tolist(),
+               columns['resname'][order].tolist(),
+               columns['chain'][order].tolist(),
+               np.asarray(resids).tolist(),
+               columns['segname'][order].tolist(),
+               columns['element'][order].tolist())
+    fileh.write(''.join(_PDB_ATOM % (record, idx, name, resname, chain, resid,
+                                     xyz[0], xyz[1], xyz[2], 0.0, 0.0,
+                                     segname, element)
+                        for (idx, name, resname, chain, resid, segname,
+                             element), xyz in zip(rows, coords)))
+    return serial + len(order)
+
+#==========================================================================
+
+def write_pdb(filename, columns, order=None, resids=None):
+    """
+    Writes atoms to a new pdb file
+
+    Args:
+      filename (str): File to write
+      columns (dict str -> numpy array): Atom fields, as from get_pdb_columns
+      order (array of int): Positions in columns of the atoms to write, in
+        the order to write them, or None to write all atoms in order
+      resids (array of int): Resid to write for each written atom, or None
+        to use the resids in columns
+
+    Returns:
+      (int) number of atoms written
+    """
+    with open(filename, 'w') as fileh:
+        written = write_pdb_block(fileh, columns, order=order,
+                                  resids=resids) - 1
+        fileh.write('END\n')
+    return written
+
+#==========================================================================
+
 def check_write_ok(filename, out_fmt, overwrite=False):
     """
     Checks if the output files for the requested format exists,
@@ -341,4 +551,48 @@ def check_out_type(value, forcefield, hmr=False):
 
     return out_fmt
 
+#==========================================================================
+
+def hash_file(filename):
+    """
+    Hashes the contents of a file
+
+    Args:
+      filename (str): File to hash, or None
+
+    Returns:
+      (str) hex digest of the contents, or None if there is no file or
+        it can't be read
+    """
+    if not filename:
+        return None
+    digest = hashlib.sha1()
+    try:
+        with open(filename, 'rb') as fileh:
+            for chunk in iter(lambda: fileh.read(1 << 20), b''):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+#==========================================================================
+
+def _mae_string(value):
+    """
+    Returns:
+      (str) value as a mae string, quoted if empty or containing spaces
+    """
+    if not value or any(c.isspace() or c in '"\\' for c in value):
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return value
+
+#==========================================================================
+
+def _mae_float(value):
+    """
+    Returns:
+      (str) value as a mae real, with the precision VMD writes
+    """
+    return "%g" % value
+
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -0,0 +1,397 @@
+"""
+This module contains the MoleculeBuffer class, which holds the atoms,
+bonds and periodic cell of a molecule as numpy arrays. Systems can
+then be moved, tiled and combined in memory and loaded back into VMD
+directly, instead of round tripping through intermediate mae files.
+
+Author: Robin Betz
+
+Copyright (C) 2015 Robin Betz
+
+This program is free software; you can redistribute it and/or modify it under
+the terms of the GNU Lesser General Public License as published by the Free
+Software Foundation; either version 2 of the License, or (at your option) any
+later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place - Suite 330
+Boston, MA 02111-1307, USA.
+"""
+
+from __future__ import print_function
+import hashlib
+import numpy as np
+
+# pylint: disable=import-error, unused-import
+import vmd
+import molecule
+import topology
+from atomsel import atomsel
+from VMD import evaltcl
+# pylint: enable=import-error, unused-import
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Per-atom VMD fields stored in a buffer, and the type used to hold them.
+# Coordinates are kept separately as an Nx3 array.
+_FIELDS = (('name', object),
+           ('type', object),
+           ('resname', object),
+           ('resid', int),
+           ('insertion', object),
+           ('chain', object),
+           ('segname', object),
+           ('altloc', object),
+           ('element', object),
+           ('atomicnumber', int),
+           ('mass', float),
+           ('charge', float),
+           ('radius', float),
+           ('occupancy', float),
+           ('beta', float),
+           ('user', float))
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                                   CLASSES                                   #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+class MoleculeBuffer(object):
+    """
+    An in-memory copy of a molecule, backed by numpy arrays.
+
+    Attributes:
+      fields (dict str -> numpy array): Per-atom VMD fields, keyed by
+        field name
+      coords (numpy Nx3 array): Atom coordinates
+      bonds (numpy Mx2 array of int): Indices of bonded atoms within
+        this buffer, lower index first
+      bond_orders (numpy array of M floats): Order of each bond
+      box (numpy array of 3 floats): Periodic box a, b, c dimensions
+    """
+
+    #==========================================================================
+
+    def __init__(self, fields, coords, bonds=None, bond_orders=None,
+                 box=None):
+        self.fields = fields
+        self.coords = np.array(coords, dtype=float).reshape(-1, 3)
+        if bonds is None:
+            bonds = np.zeros((0, 2), dtype=int)
+        self.bonds = np.array(bonds, dtype=int).reshape(-1, 2)
+        if bond_orders is None:
+            bond_orders = np.ones(len(self.bonds))
+        self.bond_orders = np.array(bond_orders, dtype=float)
+        if box is None:
+            box = [0., 0., 0.]
+        self.box = np.array(box, dtype=float)
+
+    #==========================================================================
+
+    def __len__(self):
+        return len(self.coords)
+
+    #=========================================================================
+    #                            Public methods                              #
+    #=========================================================================
+
+    @classmethod
+    def from_molid(cls, molid, sel='all'):
+        """
+        Reads the atoms in a VMD selection into a new buffer. Bonds are
+        only kept if both atoms are in the selection.
+
+        Args:
+          molid (int): VMD molecule ID to read
+          sel (str): VMD atom selection to read, defaults to all
+
+        Returns:
+          (MoleculeBuffer) buffer holding the selected atoms
+        """
+        selection = atomsel(sel, molid=molid)
+        fields = dict((field, np.array(selection.get(field), dtype=dtype))
+                      for field, dtype in _FIELDS)
+        coords = np.column_stack([selection.get('x'),
+                                  selection.get('y'),
+                                  selection.get('z')])
+
+        # Translate bonds from molecule indices to buffer indices,
+        # dropping those that leave the selection
+        lookup = -np.ones(molecule.numatoms(molid), dtype=int)
+        lookup[np.array(selection.get('index'), dtype=int)] = \
+                np.arange(len(selection))
+        bondlist = np.array(topology.bondlist(molid=molid, type=False,
+                                              order=True),
+                            dtype=float).reshape(-1, 3)
+        pairs = lookup[bondlist[:, :2].astype(int)]
+        keep = np.all(pairs >= 0, axis=1)
+
+        box = molecule.get_periodic(molid)
+        return cls(fields=fields,
+                   coords=coords,
+                   bonds=np.sort(pairs[keep], axis=1),
+                   bond_orders=bondlist[keep, 2],
+                   box=[box['a'], box['b'], box['c']])
+
+    #==========================================================================
+
+    def to_molid(self, name='dabble'):
+        """
+        Creates a new VMD molecule holding the atoms in this buffer.
+        The structure is reanalyzed so that VMD residue and fragment
+        numbering reflect the new atoms and bonds.
+
+        Args:
+          name (str): Name of the new molecule
+
+        Returns:
+          (int) VMD molecule ID of the new molecule
+        """
+        molid = molecule.new(name, len(self))
+        molecule.dupframe(molid, -1)
+
+        sel = atomsel('all', molid=molid)
+        for field, _ in _FIELDS:
+            sel.set(field, self.fields[field].tolist())
+        sel.set('x', self.coords[:, 0].tolist())
+        sel.set('y', self.coords[:, 1].tolist())
+        sel.set('z', self.coords[:, 2].tolist())
+
+        neighbors, orders = self._adjacency()
+        sel.setbonds(neighbors)
+        sel.setbondorders(orders)
+
+        molecule.set_periodic(molid, -1, self.box[0], self.box[1],
+                              self.box[2], 90.0, 90.0, 90.0)
+        evaltcl('mol reanalyze %d' % molid)
+        return molid
+
+    #==========================================================================
+
+    def digest(self):
+        """
+        Hashes the contents of the buffer, so that identical molecules
+        can be recognized.
+
+        Returns:
+          (str) hex digest of the atoms, bonds and box
+        """
+        digest = hashlib.sha1()
+        for array in [self.coords, self.bonds, self.bond_orders, self.box]:
+            digest.update(np.ascontiguousarray(array).tobytes())
+        for field, dtype in _FIELDS:
+            values = self.fields[field]
+            if dtype is object:
+                values = values.astype(str)
+            digest.update(np.ascontiguousarray(values).tobytes())
+        return digest.hexdigest()
+
+    #==========================================================================
+
+    def save(self, filename):
+        """
+        Saves the buffer to a numpy .npz file
+
+        Args:
+          filename (str): File to write, should end in .npz
+        """
+        # String fields are stored as fixed width strings so the file
+        # can be loaded without pickling
+        arrays = dict(('field_%s' % field,
+                       self.fields[field].astype(str if dtype is object
+                                                 else dtype))
+                      for field, dtype in _FIELDS)
+        np.savez(filename, coords=self.coords, bonds=self.bonds,
+                 bond_orders=self.bond_orders, box=self.box, **arrays)
+
+    #==========================================================================
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a buffer saved with save
+
+        Args:
+          filename (str): File to read
+
+        Returns:
+          (MoleculeBuffer) the saved buffer
+        """
+        # Copy everything out so the file is closed before returning
+        with np.load(filename) as data:
+            fields = dict((field, data['field_%s' % field].astype(dtype))
+                          for field, dtype in _FIELDS)
+            return cls(fields=fields,
+                       coords=data['coords'],
+                       bonds=data['bonds'],
+                       bond_orders=data['bond_orders'],
+                       box=data['box'])
+
+    #==========================================================================
+
+    def copy(self):
+        """
+        Returns:
+          (MoleculeBuffer) an independent copy of this buffer
+        """
+        return MoleculeBuffer(fields=dict((k, v.copy()) for k, v in
+                                          self.fields.items()),
+                              coords=self.coords.copy(),
+                              bonds=self.bonds.copy(),
+                              bond_orders=self.bond_orders.copy(),
+                              box=self.box.copy())
+
+    #==========================================================================
+
+    def take(self, indices):
+        """
+        Copies some atoms of this buffer into a new buffer. Bonds are
+        only kept if both atoms are taken.
+
+        Args:
+          indices (array of int): Positions of the atoms to take, in the
+            order they should appear in the new buffer
+
+        Returns:
+          (MoleculeBuffer) buffer holding the taken atoms
+        """
+        indices = np.asarray(indices, dtype=int)
+        lookup = -np.ones(len(self), dtype=int)
+        lookup[indices] = np.arange(len(indices))
+        pairs = lookup[self.bonds]
+        keep = np.all(pairs >= 0, axis=1)
+
+        return MoleculeBuffer(fields=dict((k, v[indices]) for k, v in
+                                          self.fields.items()),
+                              coords=self.coords[indices],
+                              bonds=np.sort(pairs[keep], axis=1),
+                              bond_orders=self.bond_orders[keep],
+                              box=self.box.copy())
+
+    #==========================================================================
+
+    def moveby(self, vector):
+        """
+        Translates all atoms in the buffer
+
+        Args:
+          vector (array of 3 floats): Amount to move in x, y, z
+        """
+        self.coords += np.asarray(vector, dtype=float)
+
+    #==========================================================================
+
+    def center(self, center_z=False):
+        """
+        Centers the buffer at the origin in the XY-plane, and optionally
+        in the Z dimension.
+
+        Args:
+          center_z (bool): Whether or not to center along the Z axis as well
+        """
+        # pylint: disable=invalid-name
+        x, y, z = self.coords.mean(axis=0)
+        if center_z is True:
+            self.moveby((-x, -y, -z))
+        else:
+            self.moveby((-x, -y, 0))
+
+    #==========================================================================
+
+    def tile(self, times, spacing, resid_step=0):
+        """
+        Copies this buffer onto a lattice of translations in one pass.
+        Tiles are ordered as a nested x, y, z loop with z varying fastest.
+
+        Args:
+          times (array of 3 ints): Number of copies in x, y, and z
+          spacing (array of 3 floats): Distance between copies in x, y, z
+          resid_step (int): Amount to add to resids for each successive tile
+
+        Returns:
+          (MoleculeBuffer) the tiled system, with a periodic box spanning
+            all of the tiles
+        """
+        times = np.asarray(times, dtype=int)
+        spacing = np.asarray(spacing, dtype=float)
+        shifts = np.indices(times).reshape(3, -1).T * spacing
+        ntiles = len(shifts)
+
+        fields = dict((field, np.tile(self.fields[field], ntiles))
+                      for field, _ in _FIELDS)
+        fields['resid'] = (self.fields['resid'][np.newaxis, :] + \
+                           resid_step*np.arange(ntiles)[:, np.newaxis]).ravel()
+        coords = self.coords[np.newaxis, :, :] + shifts[:, np.newaxis, :]
+        bonds = self.bonds[np.newaxis, :, :] + \
+                len(self)*np.arange(ntiles)[:, np.newaxis, np.newaxis]
+
+        return MoleculeBuffer(fields=fields,
+                              coords=coords.reshape(-1, 3),
+                              bonds=bonds.reshape(-1, 2),
+                              bond_orders=np.tile(self.bond_orders, ntiles),
+                              box=times*spacing)
+
+    #==========================================================================
+
+    @staticmethod
+    def concatenate(buffers, box=None):
+        """
+        Combines buffers into one, in order. Bond indices are offset to
+        refer to the atoms' positions in the combined buffer.
+
+        Args:
+          buffers (list of MoleculeBuffer): Buffers to combine
+          box (array of 3 floats): Periodic box of the combined system,
+            or None to use that of the first buffer
+
+        Returns:
+          (MoleculeBuffer) the combined system
+
+        Raises:
+          ValueError if no buffers are given
+        """
+        if not len(buffers):
+            raise ValueError("Need at least one buffer to concatenate")
+
+        offsets = np.cumsum([0] + [len(b) for b in buffers[:-1]])
+        fields = dict((field, np.concatenate([b.fields[field] for b in buffers]))
+                      for field, _ in _FIELDS)
+        bonds = np.concatenate([b.bonds + off for b, off in zip(buffers, offsets)])
+        orders = np.concatenate([b.bond_orders for b in buffers])
+        if box is None:
+            box = buffers[0].box
+
+        return MoleculeBuffer(fields=fields,
+                              coords=np.concatenate([b.coords for b in buffers]),
+                              bonds=bonds,
+                              bond_orders=orders,
+                              box=box)
+
+    #=========================================================================
+    #                           Private methods                              #
+    #=========================================================================
+
+    def _adjacency(self):
+        """
+        Lists the bonds of each atom, in the per-atom form VMD uses to
+        set all bonds of a selection at once. Each bond is listed for
+        both of its atoms, and each atom's neighbors are in index order.
+
+        Returns:
+          (list of N lists of int) indices of the atoms bonded to each atom
+          (list of N lists of float) order of each of those bonds
+        """
+        if not len(self):
+            return [], []
+        pairs = np.concatenate([self.bonds, self.bonds[:, ::-1]])
+        orders = np.concatenate([self.bond_orders, self.bond_orders])
+        ordering = np.lexsort((pairs[:, 1], pairs[:, 0]))
+        splits = np.cumsum(np.bincount(pairs[:, 0], minlength=len(self)))[:-1]
+        return ([n.tolist() for n in np.split(pairs[ordering, 1], splits)],
+                [o.tolist() for o in np.split(orders[ordering], splits)])
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -22,8 +22,6 @@ Boston, MA 02111-1307, USA.
 """
 from __future__ import print_function
 import numpy as np
-import os
-import tempfile
 
 # pylint: disable=import-error, unused-import
 import vmd
@@ -31,7 +29,7 @@ import molecule
 from atomsel import atomsel
 # pylint: enable=import-error
 
-from Dabble import fileutils
+from Dabble.molbuffer import MoleculeBuffer
 
 # pylint: disable=no-member
 
@@ -100,32 +98,91 @@ def get_system_net_charge(molid):
 
 def diameter(coords, chunkmem=30e6):
     """
-    Returns the diameter of a set of xy coordinates.
+    Returns the diameter of a set of xy coordinates. This is the largest
+    distance between two points, found exactly by rotating calipers
+    around the convex hull of the points.
 
     Args:
       coords (numpy array Nx2) : XY coordinates to get diameter of
-      chunkmem (int) : Chunk memory for calculation
+      chunkmem (int) : Unused, kept for compatibility
 
     Returns:
-      (float, float): The diameter of the stuff in both dimensions
+      (float): The diameter of the coordinates
     """
-    # pylint: disable=invalid-name
-    coords = np.require(coords, dtype=np.float32)
+    # pylint: disable=unused-argument
+    coords = np.require(coords, dtype=np.float64).reshape(-1, 2)
     if coords.size == 0:
         return 0
-    nper = int(chunkmem / (4*coords.size))
-    D = np.array([np.inner(x, x) for x in coords])
-    i = 0
-    d = 0
-    while i < len(coords):
-        M = np.inner(-2*coords, coords[i:i+nper])
-        M += D[i:i+nper]
-        M += D[:, None]
-        nd = M.max()
-        if nd > d:
-            d = nd
-        i += nper
-    return np.sqrt(d)
+    hull = convex_hull_2d(coords)
+    if len(hull) < 3:
+        return np.sqrt(np.max(np.sum((hull - hull[0])**2, axis=1)))
+
+    # Walk antipodal pairs, advancing the opposite vertex while it gets
+    # farther from the current edge
+    # pylint: disable=invalid-name
+    n = len(hull)
+    best = 0.
+    k = 1
+    for i in range(n):
+        a, b = hull[i], hull[(i+1) % n]
+        edge = b - a
+        while _cross(edge, hull[(k+1) % n] - a) > _cross(edge, hull[k] - a):
+            k = (k+1) % n
+        best = max(best, np.sum((hull[k] - a)**2), np.sum((hull[k] - b)**2))
+    return np.sqrt(best)
+
+#==========================================================================
+
+def convex_hull_2d(coords):
+    """
+    Returns the convex hull of a set of xy coordinates, using Andrew's
+    monotone chain algorithm.
+
+    Args:
+      coords (numpy array Nx2) : XY coordinates
+
+    Returns:
+      (numpy array Mx2): Hull vertices in counterclockwise order, with
+        collinear points omitted
+    """
+    coords = np.require(coords, dtype=np.float64).reshape(-1, 2)
+    points = np.unique(coords, axis=0) if len(coords) else coords
+    if len(points) < 3:
+        return points
+
+    # Drop points inside the quadrilateral of extreme points, since they
+    # can't be on the hull
+    quad = points[[np.argmin(points[:, 0]), np.argmin(points[:, 1]),
+                   np.argmax(points[:, 0]), np.argmax(points[:, 1])]]
+    inside = np.ones(len(points), dtype=bool)
+    for i in range(4):
+        edge = quad[(i+1) % 4] - quad[i]
+        inside &= (edge[0] * (points[:, 1] - quad[i][1]) -
+                   edge[1] * (points[:, 0] - quad[i][0])) > 0
+    points = points[~inside]
+
+    def half_hull(ordered):
+        """ Builds the lower hull of points sorted along x """
+        chain = []
+        for point in ordered:
+            while len(chain) >= 2 and \
+                  _cross(chain[-1] - chain[-2], point - chain[-2]) <= 0:
+                chain.pop()
+            chain.append(point)
+        return chain
+
+    # np.unique sorts by x then y already
+    lower = half_hull(points)
+    upper = half_hull(points[::-1])
+    return np.array(lower[:-1] + upper[:-1])
+
+#==========================================================================
+
+def _cross(first, second):
+    """
+    Returns the z component of the cross product of two xy vectors
+    """
+    return first[0]*second[1] - first[1]*second[0]
 
 #==========================================================================
 
@@ -146,6 +203,68 @@ def solute_xy_diameter(solute_sel, molid):
 
 #==========================================================================
 
+def residue_centers(residues, coords, atoms=None):
+    """
+    Computes the center of every residue at once, by sorting atoms by
+    residue and summing each run of coordinates.
+
+    Args:
+      residues (array of N ints): Residue number of each atom
+      coords (numpy Nx3 array): Atom coordinates
+      atoms (array of N bools): Atoms to compute centers from, or None
+        to use all atoms
+
+    Returns:
+      (numpy array of ints) sorted residue numbers with a selected atom
+      (numpy Mx3 array) center of each of those residues
+    """
+    residues = np.asarray(residues, dtype=int)
+    coords = np.asarray(coords, dtype=float)
+    if atoms is not None:
+        atoms = np.asarray(atoms, dtype=bool)
+        residues = residues[atoms]
+        coords = coords[atoms]
+    if not len(residues):
+        return np.zeros(0, dtype=int), np.zeros((0, 3))
+
+    order = np.argsort(residues, kind='mergesort')
+    residues = residues[order]
+    starts = np.flatnonzero(np.concatenate(([True],
+                                            residues[1:] != residues[:-1])))
+    counts = np.diff(np.append(starts, len(residues)))
+    sums = np.add.reduceat(coords[order], starts, axis=0)
+    return residues[starts], sums / counts[:, np.newaxis]
+
+#==========================================================================
+
+def residues_centered_outside(residues, coords, atoms, half_x, half_y):
+    """
+    Finds residues whose center lies outside a box centered at the
+    origin in the XY plane.
+
+    Args:
+      residues (array of N ints): Residue number of each atom
+      coords (numpy Nx3 array): Atom coordinates
+      atoms (array of N bools): Atoms to compute residue centers from
+      half_x (float): Half the box size in x
+      half_y (float): Half the box size in y
+
+    Returns:
+      (numpy array of N bools) atoms in residues centered outside the box.
+        Residues with no selected atoms are never outside.
+    """
+    residues = np.asarray(residues, dtype=int)
+    if not len(residues):
+        return np.zeros(0, dtype=bool)
+
+    resnums, centers = residue_centers(residues, coords, atoms)
+    outside = np.zeros(residues.max() + 1, dtype=bool)
+    outside[resnums] = (np.abs(centers[:, 0]) > half_x) | \
+                       (np.abs(centers[:, 1]) > half_y)
+    return outside[residues]
+
+#==========================================================================
+
 def get_num_salt_ions_needed(molid,
                              conc,
                              water_sel='water and element O',
@@ -249,48 +368,86 @@ def get_num_salt_ions_needed(molid,
 
 #==========================================================================
 
-def lipid_composition(lipid_sel, molid):
+def lipid_composition(lipid_sel, molid, remaining=None):
     """
-    Calculates the lipid composition of each leaflet of the membrane
+    Calculates the lipid composition of each leaflet of the membrane.
+    Lipids are counted by fragment, from their heavy atoms other than
+    carbon, with count_leaflet_lipids. All the atom fields needed are
+    read at once.
 
     Args:
       lipid_sel (str): VMD selection string for lipid
       molid (int) : VMD molecule ID to consider
+      remaining (array of bools): Atoms still in the system, or None to
+        use those with beta 1
+
+    Returns:
+      (dict str -> int) number of each lipid resname on the inner leaflet
+      (dict str -> int) number of each lipid resname on the outer leaflet
+    """
+    allsel = atomsel('all', molid=molid)
+    if remaining is None:
+        remaining = np.array(allsel.get('beta')) == 1
+    lipids = np.zeros(len(allsel), dtype=bool)
+    lipids[atomsel(lipid_sel, molid=molid).get('index')] = True
+    atoms = lipids & np.asarray(remaining, dtype=bool) & \
+            ~np.isin(allsel.get('element'), ['H', 'C'])
+
+    return count_leaflet_lipids(
+        np.array(allsel.get('resname'), dtype=object)[atoms],
+        np.array(allsel.get('fragment'))[atoms],
+        np.array(allsel.get('z'))[atoms])
+
+#==========================================================================
+
+def count_leaflet_lipids(resnames, fragments, z):
+    """
+    Counts lipids of each resname in each leaflet, from atom arrays.
+    Each fragment counts once per resname in each leaflet it has atoms
+    in, with atoms below z=0 in the inner leaflet.
+
+    Args:
+      resnames (array of N str): Resname of each lipid atom
+      fragments (array of N ints): Fragment of each lipid atom
+      z (array of N floats): Z coordinate of each lipid atom
 
     Returns:
-      (int tuple) number of lipids on inner and outer membrane leaflets
+      (dict str -> int) number of each lipid resname on the inner leaflet
+      (dict str -> int) number of each lipid resname on the outer leaflet
     """
+    names, kinds = np.unique(np.asarray(resnames, dtype=object).astype(str),
+                             return_inverse=True)
+    outer = np.asarray(z, dtype=float) >= 0
 
-    def leaflet(leaflet_sel):
-        """
-        Returns the composition in one selected leaflet
-        """
-        sel = atomsel_remaining(molid, 'not element H C and (%s) and (%s)'
-                                % (lipid_sel, leaflet_sel))
-        resnames = set(sel.get('resname'))
-        dct = dict([(s, len(set(atomsel_remaining(molid, 'not element H C and ' \
-             'resname %s and (%s) and (%s)' % (s, lipid_sel, leaflet_sel) \
-             ).get('fragment')))) for s in resnames])
-        return dct
+    groups = np.unique(np.column_stack([outer.astype(int), kinds.ravel(),
+                                        np.asarray(fragments, dtype=int)]),
+                       axis=0)
+    counts = np.zeros((2, len(names)), dtype=int)
+    np.add.at(counts, (groups[:, 0], groups[:, 1]), 1)
 
-    inner, outer = leaflet('z < 0'), leaflet('not (z < 0)')
-    return inner, outer
+    return tuple(dict((str(name), int(num))
+                      for name, num in zip(names, leaflet) if num)
+                 for leaflet in counts)
 
 #==========================================================================
 
-def print_lipid_composition(lipid_sel, molid):
+def print_lipid_composition(lipid_sel, molid, remaining=None):
     """
-    Describes the composition of the inner and outer leaflet
+    Describes the composition of the inner and outer leaflet, along with
+    the area per lipid of each leaflet and the difference in the number
+    of lipids between them.
 
     Args:
        molid (int): VMD molecule id to look at
        lipid_sel (str): VMD atom selection for lipid
+       remaining (array of bools): Atoms still in the system, or None to
+         use those with beta 1
 
     Returns:
       (str) string describing the lipid composition
     """
 
-    inner, outer = lipid_composition(lipid_sel, molid)
+    inner, outer = lipid_composition(lipid_sel, molid, remaining)
     desc = "Inner leaflet:"
     for kind, num in sorted(inner.items()):
         desc += "  %d %s\n" % (num, kind)
@@ -298,6 +455,15 @@ def print_lipid_composition(lipid_sel, molid):
     for kind, num in sorted(outer.items()):
         desc += "  %d %s\n" % (num, kind)
 
+    ninner = sum(inner.values())
+    nouter = sum(outer.values())
+    box = molecule.get_periodic(molid)
+    area = box['a'] * box['b']
+    if area and ninner and nouter:
+        desc += "Area per lipid: %.1f A^2 inner, %.1f A^2 outer\n" \
+                % (area / ninner, area / nouter)
+    desc += "Leaflet asymmetry: %+d lipids (outer - inner)\n" % (nouter - ninner)
+
     return desc
 
 #==========================================================================
@@ -325,21 +491,21 @@ def get_system_dimensions(molid):
 
 #==========================================================================
 
-def center_system(molid, tmp_dir, center_z=False):
+def center_system(molid, tmp_dir=None, center_z=False):
     """
     Centers an entire system in the XY-plane, and optionally in the Z
-    dimension. Needs to save and reload the file in case the current
-    positions need to be concatenated to produce a new file.
+    dimension. The molecule is moved in place, since systems are combined
+    from their in-memory coordinates.
 
     Args:
       molid (int): VMD molecule id to center
-      tmp_dir (str): Directory to create temp file in
+      tmp_dir (str): Unused, kept for compatibility
       center_z (bool): Whether or not to center along the Z axis as well
 
     Returns:
       (int) : VMD molecule id of centered system
     """
-    # pylint: disable=invalid-name
+    # pylint: disable=invalid-name, unused-argument
     x, y, z = atomsel('all', molid=molid).center()
 
     if center_z is True:
@@ -347,14 +513,7 @@ def center_system(molid, tmp_dir, center_z=False):
     else:
         atomsel('all', molid=molid).moveby((-x, -y, 0))
 
-    # Save and reload the solute to record atom positions
-    temp_mae = tempfile.mkstemp(suffix='.mae',
-                                prefix='dabble_centered',
-                                dir=tmp_dir)[1]
-    atomsel('all', molid=molid).write('mae', temp_mae)
-    molecule.delete(molid)
-    new_id = molecule.load('mae', temp_mae)
-    return new_id
+    return molid
 
 #==========================================================================
 
@@ -370,10 +529,29 @@ def set_ion(molid, atom_id, element):
     Raises:
       ValueError if the index to change is not present
     """
+    set_ions(molid, [atom_id], element)
+
+#==========================================================================
 
-    sel = atomsel('index %d' % atom_id, molid=molid)
-    if len(sel) == 0:
-        raise ValueError("Index %d does not exist" % atom_id)
+def set_ions(molid, atom_ids, element):
+    """
+    Sets several atoms to be the desired ion at once
+
+    Args:
+      molid (int): VMD molecule to operate on
+      atom_ids (list of int): Atom indices to change to ion
+      element (str in Na, K, Cl): Ion to apply
+
+    Raises:
+      ValueError if any of the indices to change are not present
+    """
+    if not len(atom_ids):
+        return
+
+    sel = atomsel('index %s' % ' '.join(str(i) for i in atom_ids),
+                  molid=molid)
+    if len(sel) != len(set(atom_ids)):
+        raise ValueError("Indices %s do not all exist" % atom_ids)
 
     resname = dict(Na='SOD', K='POT', Cl='CLA')[element]
     name = dict(Na='NA', K='K', Cl='CL')[element]
@@ -411,7 +589,7 @@ def set_cations(molid, element, filter_sel='none'):
 
 #==========================================================================
 
-def tile_system(input_id, times_x, times_y, times_z, tmp_dir):
+def tile_system(input_id, times_x, times_y, times_z, tmp_dir=None):
     """
     Tiles the membrane or solvent system the given number of times
     in each direction to produce a larger system.
@@ -421,78 +599,79 @@ def tile_system(input_id, times_x, times_y, times_z, tmp_dir):
       times_x (int): Number of times to tile in x direction
       times_y (int): Number of times to tile in y direction
       times_z (int): Number of times to tile in z direction
-      tmp_dir (str): Directory in which to put temporary files
+      tmp_dir (str): Unused, kept for compatibility
 
     Returns:
       (int) VMD molecule ID of tiled system
     """
-    # pylint: disable=invalid-name, too-many-locals
-    # Read in the equilibrated bilayer file
-    new_resid = np.array(atomsel('all', molid=input_id).get('residue'))
-    num_residues = new_resid.max()
-    atomsel('all', molid=input_id).set('user', 2.)
-    wx, wy, wz = get_system_dimensions(molid=input_id)
+    # pylint: disable=unused-argument
+    tiled = _tile_patch(input_id, (times_x, times_y, times_z))
+    return tiled.to_molid('dabble_tiled')
 
-    # Move the lipids over, save that file, move them back, repeat, then
-    # stack all of those together to make a tiled membrane. Uses
-    # temporary mae files to save each "tile" since this
-    # format is easy to combine. Renumbers residues as it goes along.
-    tile_filenames = []
-    for nx in range(times_x):
-        for ny in range(times_y):
-            for nz in range(times_z):
-                tx = np.array([nx * wx, ny * wy, nz * wz])
-                atomsel('all', molid=input_id).moveby(tuple(tx))
-                atomsel('all', molid=input_id).set('resid', new_resid)
-                new_resid += num_residues
-                tile_filename = tempfile.mkstemp(suffix='.mae',
-                                                 prefix='dabble_tile_tmp',
-                                                 dir=tmp_dir)[1]
-                tile_filenames.append(tile_filename)
-                atomsel('all', molid=input_id).write('mae', tile_filename)
-                atomsel('all', molid=input_id).moveby(tuple(-tx))
-
-    # Write all of these tiles together into one large bilayer
-    merge_output_filename = tempfile.mkstemp(suffix='.mae',
-                                             prefix='dabble_merge_tile_tmp',
-                                             dir=tmp_dir)[1]
-    fileutils.concatenate_mae_files(merge_output_filename,
-                                    input_filenames=tile_filenames)
-
-    # Read that large bilayer file in as a new molecule and
-    # write it as the output file
-    output_id = molecule.load('mae', merge_output_filename)
-    molecule.set_periodic(output_id, -1,
-                          times_x * wx, times_y * wy, times_z * wz,
-                          90.0, 90.0, 90.0)
-
-    # Save and clean up
-    atomsel('all', molid=output_id).write('mae', merge_output_filename)
-
-    for tile_filename in tile_filenames:
-        os.remove(tile_filename)
-    return output_id
+#==========================================================================
+
+def solvent_slab(input_id, size_x, size_y, zmin, zmax, anchor_top=False):
+    """
+    Fills a slab with copies of a solvent patch, entirely in memory. The
+    patch is tiled just enough times to cover the slab and centered in
+    XY, then placed with its bottom at zmin, or its top at zmax if
+    anchor_top is set. Residues with a heavy atom outside the slab's Z
+    range are dropped.
+
+    Args:
+      input_id (int): VMD molecule id of the solvent patch
+      size_x (float): Slab size in x
+      size_y (float): Slab size in y
+      zmin (float): Bottom of the slab
+      zmax (float): Top of the slab
+      anchor_top (bool): Whether to line the solvent up with the top of
+        the slab rather than the bottom
+
+    Returns:
+      (MoleculeBuffer) solvent filling the slab
+      (numpy array of ints) residue of each atom, distinct between tiles
+    """
+    dims = np.array(get_system_dimensions(molid=input_id))
+    times = tuple(int(t) for t in
+                  np.ceil(np.array([size_x, size_y, zmax - zmin]) / dims))
+    residues = np.array(atomsel('all', molid=input_id).get('residue'))
+    if times == (1, 1, 1):
+        slab = MoleculeBuffer.from_molid(input_id)
+    else:
+        slab = _tile_patch(input_id, times)
+    residues = (residues[np.newaxis, :] + (residues.max() + 1) *
+                np.arange(len(slab) // len(residues))[:, np.newaxis]).ravel()
+
+    slab.center(center_z=False)
+    if anchor_top:
+        slab.moveby((0, 0, zmax - slab.coords[:, 2].max()))
+    else:
+        slab.moveby((0, 0, zmin - slab.coords[:, 2].min()))
+
+    zcoord = slab.coords[:, 2]
+    outside = (slab.fields['atomicnumber'] != 1) & \
+              ((zcoord < zmin) | (zcoord > zmax))
+    keep = np.flatnonzero(~np.isin(residues, residues[outside]))
+    return slab.take(keep), residues[keep]
 
 #==========================================================================
 
-def combine_molecules(input_ids, tmp_dir):
+def combine_molecules(input_ids, tmp_dir=None):
     """
     Combines input molecules, closes them and returns the molecule id
     of the new molecule that combines them, putting it on top.
 
     Args:
       input_ids (list of int): Molecule IDs to combine, will be closed
-      tmp_dir (str): Directory to put combined molecule into
+      tmp_dir (str): Unused, kept for compatibility
 
     Returns:
       (int) molid of combined system
     """
-
-    output_filename = tempfile.mkstemp(suffix='.mae',
-                                       prefix='dabble_combine',
-                                       dir=tmp_dir)[1]
-    fileutils.concatenate_mae_files(output_filename, input_ids=input_ids)
-    output_id = molecule.load('mae', output_filename)
+    # pylint: disable=unused-argument
+    combined = MoleculeBuffer.concatenate([MoleculeBuffer.from_molid(i)
+                                           for i in input_ids])
+    output_id = combined.to_molid('dabble_combined')
     molecule.set_top(output_id)
     for i in input_ids:
         molecule.delete(i)
@@ -591,5 +770,30 @@ def num_lipids_remaining(molid, lipid_sel):
 
     return np.unique(atomsel_remaining(molid, lipid_sel).get('fragment')).size
 
+#==========================================================================
+
+def _tile_patch(input_id, times):
+    """
+    Copies a membrane or solvent patch onto every tile position at once.
+    Atoms are marked with user 2, and residues are renumbered by
+    offsetting VMD's residue numbering for each tile.
+
+    Args:
+      input_id (int): VMD molecule id to tile
+      times (tuple of 3 ints): Number of times to tile in x, y, z
+
+    Returns:
+      (MoleculeBuffer) the tiled system
+    """
+    # pylint: disable=invalid-name
+    atomsel('all', molid=input_id).set('user', 2.)
+    wx, wy, wz = get_system_dimensions(molid=input_id)
+    patch = MoleculeBuffer.from_molid(input_id)
+
+    residues = np.array(atomsel('all', molid=input_id).get('residue'))
+    patch.fields['resid'] = residues
+    return patch.tile(times=times, spacing=(wx, wy, wz),
+                      resid_step=residues.max())
+
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
@@ -26,6 +26,7 @@ from __future__ import print_function
 import os
 import sys
 import tempfile
+import numpy as np
 from pkg_resources import resource_filename
 from subprocess import check_output
 
@@ -35,6 +36,8 @@ from atomsel import atomsel
 
 from parmed.tools import chamber, parmout, HMassRepartition, checkValidity
 from parmed.amber import AmberParm
+from Dabble.fileutils import get_pdb_columns, write_pdb, write_pdb_block
+from Dabble.molbuffer import MoleculeBuffer
 from Dabble.param import CharmmWriter, AmberMatcher
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -77,12 +80,7 @@ class AmberWriter(object):
             if not os.environ.get("AMBERHOME"):
                 raise ValueError("AMBERHOME must be set to use AMBER forcefield!")
 
-            self.topologies = [
-                os.path.join(os.environ["AMBERHOME"],"dat","leap","cmd","leaprc.ff14SB"),
-                os.path.join(os.environ["AMBERHOME"],"dat","leap","cmd","leaprc.lipid14"),
-                os.path.join(os.environ["AMBERHOME"],"dat","leap","cmd","leaprc.lipid11"),
-                os.path.join(os.environ["AMBERHOME"],"dat","leap","cmd","leaprc.gaff")
-               ]
+            self.topologies = get_topologies()
             self.parameters = [
                 os.path.join(os.environ["AMBERHOME"],"dat","leap","parm","frcmod.ionsjc_tip3p")
             ]
@@ -116,7 +114,7 @@ class AmberWriter(object):
         # Amber forcefield
         elif self.forcefield is 'amber':
             # Initialize the matcher
-            self.matcher = AmberMatcher(self.topologies)
+            self.matcher = AmberMatcher.cached(self.topologies)
             # Save and reload so residue looping is correct
             print("Assigning AMBER atom types...")
             self._split_caps()
@@ -169,19 +167,19 @@ class AmberWriter(object):
             ValueError if a residue definition could not be found
         """
 
-        nonlips = set(atomsel("not %s" % self.lipid_sel,
-                              molid=self.molid).get("residue"))
-        n_res = len(nonlips)
+        nonlips = atomsel("not %s" % self.lipid_sel, molid=self.molid)
+        n_res = len(set(nonlips.get("residue")))
         disulfides = set()
-        while nonlips:
-            if len(nonlips) % 500 == 0:
+        for done, (residue, rgraph) in \
+                enumerate(self.matcher.iter_vmd_graphs(nonlips)):
+            if (n_res - done) % 500 == 0:
                 sys.stdout.write("Renaming residues.... %.0f%%  \r"
-                                 % (100.-100*len(nonlips)/float(n_res)))
+                                 % (100.*done/float(n_res)))
                 sys.stdout.flush()
 
-            residue = nonlips.pop()
             sel = atomsel("residue %s" % residue)
-            resnames, atomnames = self.matcher.get_names(sel, print_warning=False)
+            resnames, atomnames = self.matcher.get_names(sel, print_warning=False,
+                                                         rgraph=rgraph)
             
             # Check if it's disulfide bond
             if not resnames:
@@ -370,25 +368,8 @@ class AmberWriter(object):
             idx (int): Current atom index
             hetatm (bool): Whether or not this is a heteroatom
         """
-        if hetatm:
-            atm = "HETATM"
-        else:
-            atm = "ATOM"
-        for i in ressel.get('index'):
-            a = atomsel('index %d' % i) # pylint: disable=invalid-name
-            entry = ('%-6s%5d %-5s%-4s%c%4d    %8.3f%8.3f%8.3f%6.2f%6.2f'
-                     '     %-4s%2s\n' % (atm, idx, a.get('name')[0],
-                                         a.get('resname')[0],
-                                         a.get('chain')[0],
-                                         a.get('resid')[0],
-                                         a.get('x')[0],
-                                         a.get('y')[0],
-                                         a.get('z')[0],
-                                         0.0, 0.0, a.get('segname')[0],
-                                         a.get('element')[0]))
-            fileh.write(entry)
-            idx += 1
-        return idx
+        return write_pdb_block(fileh, get_pdb_columns(ressel), serial=idx,
+                               hetatm=hetatm)
 
     #==========================================================================
     
@@ -458,12 +439,11 @@ class AmberWriter(object):
                                 % rid).set('resid', resid+1)
                         print("\tNMA %d -> %d" % (resid, resid+1))
 
-        # Have to save and reload so residues are parsed correctly by VMD
-        temp = tempfile.mkstemp(suffix='.mae', prefix='mae_renum_',
-                                dir=self.tmp_dir)[1]
-        atomsel('all').write('mae', temp)
+        # Have to copy to a new molecule so residues are parsed correctly
+        # by VMD
+        renumbered = MoleculeBuffer.from_molid(self.molid).to_molid('mae_renum')
         molecule.delete(self.molid)
-        self.molid = molecule.load('mae', temp)
+        self.molid = renumbered
         molecule.set_top(self.molid)
 
         return self.molid
@@ -577,31 +557,19 @@ class AmberWriter(object):
         """
         temp = tempfile.mkstemp(suffix='_indexed.pdb', prefix='amber_wat_',
                                 dir=self.tmp_dir)[1]
-        fileh = open(temp , 'w')
 
-        idx = 1
-        for r in range(len(residues)):
-            res = atomsel('residue %d' % residues[r])
-            res.set('user', 0.0)
-            
-            for i in res.get('index'):
-                a = atomsel('index %d' % i) # pylint: disable=invalid-name
-                entry = ('%-6s%5d %-5s%-4s%c%4d    %8.3f%8.3f%8.3f%6.2f%6.2f'
-                         '     %-4s%2s\n' % ('ATOM', idx, a.get('name')[0],
-                                             a.get('resname')[0],
-                                             a.get('chain')[0],
-                                             r+1,
-                                             a.get('x')[0],
-                                             a.get('y')[0],
-                                             a.get('z')[0],
-                                             0.0, 0.0, a.get('segname')[0],
-                                             a.get('element')[0]))
-                idx += 1
-                fileh.write(entry)
-
-        fileh.write('END\n')
-        fileh.close()
-        return temp 
+        # Write each water in the order given, atoms in index order, and
+        # number them by that order
+        sel = atomsel('residue %s' % ' '.join(str(r) for r in residues),
+                      molid=self.molid)
+        sel.set('user', 0.0)
+        columns = get_pdb_columns(sel)
+        position = np.zeros(max(residues) + 1, dtype=int)
+        position[residues] = np.arange(len(residues))
+        waternum = position[columns['residue']]
+        order = np.argsort(waternum, kind='mergesort')
+        write_pdb(temp, columns, order=order, resids=waternum[order] + 1)
+        return temp
 
     #==========================================================================
 
@@ -744,5 +712,28 @@ class AmberWriter(object):
         return outfile
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                              MODULE FUNCTIONS                               #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def get_topologies(extra_topos=None):
+    """
+    Gets the leaprc files an AmberWriter with the amber forcefield
+    matches residues against. AMBERHOME must be set.
 
+    Args:
+      extra_topos (list of str): Additional topology files, used after
+        the defaults
 
+    Returns:
+      (list of str) default topology files, then any extra ones
+    """
+    leap = os.path.join(os.environ["AMBERHOME"], "dat", "leap", "cmd")
+    topologies = [os.path.join(leap, "leaprc.ff14SB"),
+                  os.path.join(leap, "leaprc.lipid14"),
+                  os.path.join(leap, "leaprc.lipid11"),
+                  os.path.join(leap, "leaprc.gaff")]
+    if extra_topos:
+        topologies.extend(extra_topos)
+    return topologies
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -97,7 +97,7 @@ class AmberMatcher(MoleculeMatcher):
     #                            Public methods                              #
     #=========================================================================
 
-    def get_names(self, selection, print_warning=False):
+    def get_names(self, selection, print_warning=False, rgraph=None):
         """
         Obtains a name mapping for the current selection. Can't use
         parent here since name is stored in a different field.
@@ -106,6 +106,8 @@ class AmberMatcher(MoleculeMatcher):
             selection (VMD atomsel): Selection to set names for
             print_warning (bool): Whether or not to print matching suggestions
                 if matching fails. Set to false if you'll try patches later.
+            rgraph (networkx graph): Graph of the selection, if already
+                built by iter_vmd_graphs
 
         Returns:
             (dict int->str) Atom index to resname matched
@@ -116,9 +118,16 @@ class AmberMatcher(MoleculeMatcher):
         """
 
         resname = selection.get('resname')[0]
-        rgraph = self.parse_vmd_graph(selection)[0]
+        if rgraph is None:
+            rgraph = self.parse_vmd_graph(selection)[0]
         matched = False
 
+        # Identical residues seen before are named the same way
+        key, order = self._match_key(resname, rgraph)
+        cached = self._recall_match(key, order)
+        if cached:
+            return cached
+
         # First check against matching residue names
         if resname in self.known_res.keys():
             graph = self.known_res.get(resname)
@@ -128,8 +137,8 @@ class AmberMatcher(MoleculeMatcher):
                 matched = True
                 match = matcher.match().next()
         else:
-            # If that didn't work, loop through all known residues
-            for matchname in self.known_res.keys():
+            # If that didn't work, loop through known residues that could match
+            for matchname in self._get_candidates(rgraph):
                 graph = self.known_res[matchname]
                 matcher = isomorphism.GraphMatcher(rgraph, graph,
                                                    node_match=self._check_atom_match)
@@ -147,7 +156,7 @@ class AmberMatcher(MoleculeMatcher):
                             for i in match.keys() if \
                             graph.node[match[i]].get("residue") == "self")
 
-            return (resmatch, nammatch)
+            return self._remember_match(key, order, (resmatch, nammatch))
 
         # Try to print out a helpful error message here if matching failed
         if print_warning:
@@ -381,6 +390,7 @@ class AmberMatcher(MoleculeMatcher):
         leapdir = os.path.join(os.environ["AMBERHOME"], "dat", "leap")
 
         incmd = ""
+        self.sources.append(filename)
         with open(filename, 'r') as fh:
             for line in fh:
                 if "#" in line:
@@ -457,6 +467,7 @@ class AmberMatcher(MoleculeMatcher):
         incmd = ""
         cmdidx = 1
 
+        self.sources.append(filename)
         with open(filename, 'r') as fh:
             for line in fh:
                 if not len(line):
@@ -571,3 +582,18 @@ class AmberMatcher(MoleculeMatcher):
 
     #=========================================================================
 
+    @staticmethod
+    def _match_label(node):
+        """
+        Overridden for AmberMatcher to be consistent with its
+        _check_atom_match, where joined atoms match on residue only.
+        """
+        if node.get('residue') != "self":
+            return ("", node.get('residue') or "")
+        element = node.get('element')
+        if element not in AmberMatcher.LEAP_ELEMENTS.values():
+            element = "Other"
+        return (element, "self")
+
+    #=========================================================================
+
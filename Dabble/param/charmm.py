@@ -2,7 +2,8 @@
 This module contains the CharmmWriter class and associated methods,
 which outputs a psf/pdb file with CHARMM names and parameters.
 It does this by converting atom names to CHARMM names, writing
-intermediate files as necessary to invoke the vmd psfgen plugin.
+intermediate files as necessary to invoke the vmd psfgen plugin, or
+by building the psf directly with a PsfBuilder.
 
 Author: Robin Betz
 
@@ -24,12 +25,17 @@ Boston, MA 02111-1307, USA.
 """
 
 from __future__ import print_function
+import multiprocessing
 import sys
 import os
 import tempfile
+import numpy as np
 from pkg_resources import resource_filename
 
+from Dabble.fileutils import get_pdb_columns, write_pdb
+from Dabble.molbuffer import MoleculeBuffer
 from Dabble.param import CharmmMatcher
+from Dabble.param.psf import PsfBuilder
 
 # pylint: disable=import-error, unused-import
 import vmd
@@ -74,12 +80,17 @@ class CharmmWriter(object):
           psf
       prompt_topos (bool): Whether to ask for more topology files
       matcher (CharmmMatcher): Molecular graph matcher object
+      native (bool): Whether to build the psf directly instead of with
+          psfgen
+      psf (PsfBuilder): Structure being built, if native
+      processes (int): Number of processes to match residues with
 
     """
 
     #==========================================================================
 
-    def __init__(self, tmp_dir, molid, lipid_sel="lipid", extra_topos=None):
+    def __init__(self, tmp_dir, molid, lipid_sel="lipid", extra_topos=None,
+                 native=False, processes=1):
 
         # Create TCL temp file and directory
         self.tmp_dir = tmp_dir
@@ -89,21 +100,12 @@ class CharmmWriter(object):
         self.file = open(self.filename, 'w')
         self.molid = molid
         self.psf_name = ""
+        self.native = native
+        self.psf = None
+        self.processes = processes or 1
+        self._pool = None
         # Default parameter sets
-        self.topologies = [
-            resource_filename(__name__, "charmm_parameters/top_all36_caps.rtf"),
-            resource_filename(__name__, "charmm_parameters/top_water_ions.rtf"),
-            resource_filename(__name__, "charmm_parameters/top_all36_cgenff.rtf"),
-            resource_filename(__name__, "charmm_parameters/top_all36_prot.rtf"),
-            resource_filename(__name__, "charmm_parameters/top_all36_lipid.rtf"),
-            resource_filename(__name__, "charmm_parameters/top_all36_carb.rtf"),
-            resource_filename(__name__, "charmm_parameters/top_all36_na.rtf"),
-            resource_filename(__name__, "charmm_parameters/toppar_all36_prot_na_combined.str"),
-            resource_filename(__name__, "charmm_parameters/toppar_all36_prot_fluoro_alkanes.str"),
-            ]
-
-        if extra_topos:
-            self.topologies.extend(extra_topos)
+        self.topologies = get_topologies(extra_topos)
         self.prompt_topos = False
 
     #=========================================================================
@@ -167,7 +169,9 @@ class CharmmWriter(object):
             self.file.write('   topology %s\n' % top)
 
         # Initialize graph matcher with topologies we know about
-        self.matcher = CharmmMatcher(self.topologies)
+        self.matcher = CharmmMatcher.cached(self.topologies)
+        if self.native:
+            self.psf = PsfBuilder(self.matcher)
 
         # Mark all atoms as unsaved with the user field
         atomsel('all', molid=self.molid).set('user', 1.0)
@@ -188,27 +192,45 @@ class CharmmWriter(object):
         if not len(atomsel('resname %s' % _acids, molid=self.molid)):
             print("\tDidn't find any protein.\n")
 
-        # Pull out the protein, one fragment at a time
-        for frag in set(atomsel('resname %s' % _acids).get('fragment')):
-            self._write_protein_blocks(frag=frag)
-        # TODO: does patches care about order?
-        # End protein
-
-        # Check if there is anything else and let the user know about it
-        leftovers = atomsel('user 1.0', molid=self.molid)
-        for lig in set(leftovers.get('resname')):
-            residues = self._find_single_residue_names(resname=lig, molid=self.molid)
-            self._write_generic_block(residues)
+        # Match residues in worker processes, if requested
+        self._pool = self._start_pool()
+        try:
+            # Pull out the protein, one fragment at a time. All fragments
+            # are matched at once, so they can be matched in parallel
+            frags = list(set(atomsel('resname %s' % _acids).get('fragment')))
+            prepared = dict((frag, None) for frag in frags)
+            if self._pool is not None:
+                prepared = self._match_protein_fragments(frags)
+            for frag in frags:
+                self._write_protein_blocks(frag=frag, prepared=prepared[frag])
+            # TODO: does patches care about order?
+            # End protein
+
+            # Check if there is anything else and let the user know about it
+            leftovers = atomsel('user 1.0', molid=self.molid)
+            for lig in set(leftovers.get('resname')):
+                residues = self._find_single_residue_names(resname=lig, molid=self.molid)
+                self._write_generic_block(residues)
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
 
         # Write the output files and run
-        string = '''
-        writepsf x-plor cmap ${output}.psf
-        writepdb ${output}.pdb'''
-        self.file.write(string)
-        self.file.close()
+        if self.psf is not None:
+            self.file.close()
+            self._report_missing_atoms(self.psf.write(self.psf_name,
+                                                      self.topologies))
+        else:
+            string = '''
+            writepsf x-plor cmap ${output}.psf
+            writepdb ${output}.pdb'''
+            self.file.write(string)
+            self.file.close()
 
-        evaltcl('play %s' % self.filename)
-        self._check_psf_output()
+            evaltcl('play %s' % self.filename)
+            self._check_psf_output()
 
         # Reset top molecule
         molecule.set_top(old_top)
@@ -239,44 +261,45 @@ class CharmmWriter(object):
         atomsel('resname TIP3 and name HW2').set('name', 'H2')
 
         # Select all the waters. We'll use the user field to track which
-        # ones have been written
+        # ones have been written. Read everything needed to write them at once.
         allw = atomsel('water and user 1.0')
-        print("Found %d water residues" % len(set(atomsel('water and user 1.0').get('residue'))))
-
-        # Find the problem waters with unordered indices
-        problems = []
-        for r in set(allw.get('residue')):
-            widx = atomsel('residue %s' % r).get("index")
-            if max(widx) - min(widx) != 2:
-                problems.append(r)
-                atomsel('residue %s' % r).set("user", 0.0) # get it out of allw
-
-        allw.update()
-        num_written = len(allw)/(9999*3)+1
+        columns = get_pdb_columns(allw)
+        resid = columns['resid'].copy()
+        print("Found %d water residues" % len(set(columns['residue'].tolist())))
+
+        # Find the problem waters with unordered indices, or missing atoms.
+        # Good waters are then consecutive triples of atoms. Number them
+        # from 1 in each file of 10k waters
+        order, problems = _get_water_order(columns)
+        resid[order] = np.arange(len(order))//3 % 9999 + 1
+        allw.set('resid', resid.tolist())
+        num_written = (len(order) + 9999*3 - 1)//(9999*3)
         print("Going to write %d files for %d water atoms"
-              % (num_written, len(allw)))
+              % (num_written, len(order)))
 
-        # Pull out and write 10k waters at a time if we have normal waters
-        if allw:
-            idx = 1
+        # Build the segments directly, with the same layout psfgen is
+        # given, if not using psfgen
+        if self.psf is not None:
             for i in range(num_written):
-                temp = tempfile.mkstemp(suffix='_%d.pdb' % i, prefix='psf_wat_',
-                                        dir=self.tmp_dir)[1]
-                residues = list(set(allw.get('residue')))[:9999]
-               
-                batch = atomsel('residue %s' % ' '.join([str(x) for x in residues]))
-                try:
-                    batch.set('resid', [k for k in range(1, len(batch)/3+1)
-                                        for _ in range(3)])
-                except ValueError:
-                    print("\nERROR! You have some waters missing hydrogens!\n"
-                          "Found %d water residues, but %d water atoms. Check "
-                          " your crystallographic waters in the input structure."
-                          % (len(residues), len(batch)))
-                    quit(1)
-                batch.set('user', 0.0)
-                batch.write('pdb', temp)
-                allw.update()
+                atoms = order[i*9999*3:(i+1)*9999*3]
+                self.psf.segment("W%d" % i, columns, order=atoms,
+                                 resids=resid[atoms], auto=False)
+            allw.set('user', 0.0)
+            self._write_unorderedindex_waters(problems, self.molid,
+                                              segname="W%d" % num_written)
+            molecule.set_top(old_top)
+            return num_written
+
+        # Write the good waters directly from the arrays
+        jobs = []
+        for i in range(num_written):
+            temp = tempfile.mkstemp(suffix='_%d.pdb' % i, prefix='psf_wat_',
+                                    dir=self.tmp_dir)[1]
+            atoms = order[i*9999*3:(i+1)*9999*3]
+            jobs.append((temp, dict((k, v[atoms]) for k, v in columns.items()),
+                         resid[atoms]))
+        _map_parallel(_write_water_pdb, jobs)
+        allw.set('user', 0.0)
 
         # Now write the problem waters
         self._write_unorderedindex_waters(problems, self.molid)
@@ -302,7 +325,7 @@ class CharmmWriter(object):
 
     #==========================================================================
 
-    def _write_unorderedindex_waters(self, residues, molid):
+    def _write_unorderedindex_waters(self, residues, molid, segname=None):
         """
         Renumbers and sorts the specified waters manually. This is much less
         efficient but is necessary in cases where atoms within a water molecule
@@ -313,35 +336,34 @@ class CharmmWriter(object):
         Args:
             residues (list of int): Problem water molecules
             molid (int): VMD molecule ID to write
+            segname (str): Segment to add the waters to, if building the
+              psf directly
         Returns:
             (int) Number of waters written
         """
+        if not len(residues):
+            if self.psf is not None:
+                return 1
+            temp = tempfile.mkstemp(suffix='_indexed.pdb', prefix='psf_wat_',
+                                    dir=self.tmp_dir)[1]
+            return write_pdb(temp, get_pdb_columns(atomsel('none', molid=molid))) + 1
+
+        # Write each water in the order given, atoms in index order, and
+        # number them by that order
+        columns = get_pdb_columns(atomsel('residue %s' % ' '.join(str(r) for r in residues),
+                                          molid=molid))
+        position = np.zeros(max(residues) + 1, dtype=int)
+        position[residues] = np.arange(len(residues))
+        waternum = position[columns['residue']]
+        order = np.argsort(waternum, kind='mergesort')
+        if self.psf is not None:
+            self.psf.segment(segname, columns, order=order,
+                             resids=waternum[order] + 1, auto=False)
+            return len(order) + 1
+
         temp = tempfile.mkstemp(suffix='_indexed.pdb', prefix='psf_wat_',
                                 dir=self.tmp_dir)[1]
-        fileh = open(temp , 'w')
-
-        idx = 1
-        for r in range(len(residues)):
-            res = atomsel('residue %d' % residues[r], molid=molid)
-            
-            for i in res.get('index'):
-                a = atomsel('index %d' % i, molid) # pylint: disable=invalid-name
-                entry = ('%-6s%5d %-5s%-4s%c%4d    %8.3f%8.3f%8.3f%6.2f%6.2f'
-                         '     %-4s%2s\n' % ('ATOM', idx, a.get('name')[0],
-                                             a.get('resname')[0],
-                                             a.get('chain')[0],
-                                             r+1,
-                                             a.get('x')[0],
-                                             a.get('y')[0],
-                                             a.get('z')[0],
-                                             0.0, 0.0, a.get('segname')[0],
-                                             a.get('element')[0]))
-                idx += 1
-                fileh.write(entry)
-
-        fileh.write('END\n')
-        fileh.close()
-        return idx
+        return write_pdb(temp, columns, order=order, resids=waternum[order] + 1) + 1
 
     #==========================================================================
 
@@ -396,6 +418,12 @@ class CharmmWriter(object):
                 atomsel('residue %d and name %s'
                         % (res, name)).set('name', names[name])
 
+        if self.psf is not None:
+            self.psf.segment("L", get_pdb_columns(alll))
+            alll.set('user', 0.0)
+            molecule.set_top(old_top)
+            return
+
         # Write temporary lipid pdb
         temp = tempfile.mkstemp(suffix='.pdb', prefix='psf_lipid_',
                                 dir=self.tmp_dir)[1]
@@ -455,6 +483,12 @@ class CharmmWriter(object):
         batch = atomsel('residue %s' % ' '.join([str(s) for s in set(residues)]))
         batch.set('resid', [k for k in range(1, len(batch)+1)])
 
+        if self.psf is not None:
+            self.psf.segment("I", get_pdb_columns(atomsel('name SOD CLA POT')))
+            atomsel('name SOD CLA POT').set('user', 0.0)
+            molecule.set_top(old_top)
+            return
+
         # Save the temporary ions file
         temp = tempfile.mkstemp(suffix='.pdb', prefix='psf_ions_',
                                 dir=self.tmp_dir)[1]
@@ -510,11 +544,26 @@ class CharmmWriter(object):
                              "are %d resids! Check input." % (len(residues), resname, 
                                                               len(resids)))
 
+        # Match all the residues at once in worker processes, if requested
+        matches = {}
+        if self._pool is not None:
+            graphs = list(self.matcher.iter_vmd_graphs(
+                atomsel('user 1.0 and resname %s' % resname)))
+            matches = dict(zip([g[0] for g in graphs],
+                               self._match_residues([(resname, g[1])
+                                                     for g in graphs])))
+
         for residue in residues:
             sel = atomsel('residue %s and resname %s and user 1.0' % (residue, resname))
-            (newname, atomnames) = self.matcher.get_names(sel, print_warning=True)
+            if residue in matches:
+                (newname, atomnames), patched = matches[residue]
+                if not newname:
+                    self.matcher._print_match_warning(resname, len(sel)) # pylint: disable=protected-access
+            else:
+                (newname, atomnames) = self.matcher.get_names(sel, print_warning=True)
+                patched = None
             if not newname:
-                (resname, patch, atomnames) = self.matcher.get_patches(sel)
+                (resname, patch, atomnames) = patched or self.matcher.get_patches(sel)
                 if not newname:
                     print("ERROR: Could not find a residue definition for %s:%s"
                           % (resname, residue))
@@ -558,6 +607,13 @@ class CharmmWriter(object):
 
         alig = atomsel('user 1.0 and residue %s' % " ".join([str(x) for x in residues]))
 
+        if self.psf is not None:
+            self.psf.segment("B%s" % residues[0], get_pdb_columns(alig))
+            alig.set('user', 0.0)
+            if old_top != -1:
+                molecule.set_top(old_top)
+            return True
+
         # Write temporary file containg the residues and update tcl commands
         temp = tempfile.mkstemp(suffix='.pdb', prefix='psf_block_',
                                 dir=self.tmp_dir)[1]
@@ -579,13 +635,16 @@ class CharmmWriter(object):
 
     #==========================================================================
 
-    def _write_protein_blocks(self, frag):
+    def _write_protein_blocks(self, frag, prepared=None):
         """
         Writes a protein fragment to a pdb file for input to psfgen
         Automatically assigns amino acid names
 
         Args:
             frag (str): Fragment to write
+            prepared (tuple): Molecule ID of the numbered fragment, its
+              residue graphs, and their matches, if already matched by
+              _match_protein_fragments
 
         Returns:
 #TODO
@@ -600,20 +659,29 @@ class CharmmWriter(object):
         patches = set()
         seg = "P%s" % frag
 
-        ## Save and reload so residue looping is correct
-        prot_molid = self._number_protein_fragment(frag=frag, molid=self.molid)
-        molecule.set_top(prot_molid)
+        if prepared is not None:
+            prot_molid, graphs, matches = prepared
+            molecule.set_top(prot_molid)
+        else:
+            ## Save and reload so residue looping is correct
+            prot_molid = self._number_protein_fragment(frag=frag, molid=self.molid)
+            molecule.set_top(prot_molid)
 
-        # Sanity check that there is no discrepancy between defined resids and
-        # residues as interpreted by VMD.
-        residues = list(set(atomsel('all').get('residue')))
-        resids = list(set(atomsel('all').get('resid')))
+            # Build all residue graphs at once. This also checks there is no
+            # discrepancy between defined resids and residues as interpreted by VMD.
+            graphs = self.matcher.iter_vmd_graphs(atomsel('all'))
+            matches = None
 
-        for residue in residues:
+        for i, (residue, rgraph) in enumerate(graphs):
             sel = atomsel('residue %s' % residue)
             resid = sel.get('resid')[0]
-            (newname, atomnames) = self.matcher.get_names(sel,
-                                                           print_warning=False)
+            if matches is not None:
+                (newname, atomnames), patched = matches[i]
+            else:
+                (newname, atomnames) = self.matcher.get_names(sel,
+                                                               print_warning=False,
+                                                               rgraph=rgraph)
+                patched = None
 
             # Couldn't find a match. See if it's a disulfide bond participant
             # Need to do this selection by resid, not residue since it is
@@ -628,7 +696,7 @@ class CharmmWriter(object):
 
             # Couldn't find a match. See if it's a patched residue
             if not newname:
-                (newname, patch, atomnames) = self.matcher.get_patches(sel)
+                (newname, patch, atomnames) = patched or self.matcher.get_patches(sel)
                 if newname:
                     patches.add("patch %s %s:%d\n" % (patch, seg, resid))
 
@@ -645,6 +713,23 @@ class CharmmWriter(object):
                     atom.set('name', name)
             sel.set('resname', newname)
 
+        print("Applying the following patches:\n")
+        print("\t%s" % "\t".join(patches))
+
+        if self.psf is not None:
+            columns = get_pdb_columns(atomsel('all'))
+            self.psf.segment(seg, columns, order=_get_residue_order(columns))
+            for patchline in patches:
+                self.psf.patch(*patchline.split()[1:])
+            print("\tBuilt %d atoms in the protein segment %s"
+                  % (len(atomsel('all')), seg))
+
+            if old_top != -1:
+                molecule.set_top(old_top)
+            molecule.delete(prot_molid)
+            atomsel("fragment %s" % frag, molid=self.molid).set('user', 0.0)
+            return None
+
         # Save protein chain in the correct order
         filename = self.tmp_dir + '/psf_protein_%s.pdb' % seg 
         self._write_ordered_pdb(filename, 'all', prot_molid)
@@ -663,9 +748,6 @@ class CharmmWriter(object):
         self.file.write(string)
         self.file.write(''.join(patches))
 
-        print("Applying the following patches:\n")
-        print("\t%s" % "\t".join(patches))
-
         # Angles must be regenerated FIRST!
         # See http://www.ks.uiuc.edu/Research/namd/mailing_list/namd-l.2009-2010/4137.html
         self.file.write("regenerate angles\nregenerate dihedrals\n")
@@ -680,6 +762,80 @@ class CharmmWriter(object):
 
     #==========================================================================
 
+    def _match_protein_fragments(self, frags):
+        """
+        Numbers each protein fragment and extracts its residue graphs,
+        then matches the residues of all fragments at once in the worker
+        processes. Names are applied later, on the main thread.
+
+        Args:
+            frags (list of int): Fragments to match
+
+        Returns:
+            (dict int -> tuple) for each fragment, the molecule ID of the
+              numbered fragment, its residue graphs as from
+              iter_vmd_graphs, and their matches as from _match_residues
+        """
+        prepared = {}
+        jobs = []
+        for frag in frags:
+            prot_molid = self._number_protein_fragment(frag=frag, molid=self.molid)
+            everything = atomsel('all', molid=prot_molid)
+            graphs = list(self.matcher.iter_vmd_graphs(everything))
+            resnames = dict(zip(everything.get('residue'),
+                                everything.get('resname')))
+            jobs.extend((resnames[residue], rgraph) for residue, rgraph in graphs)
+            prepared[frag] = (prot_molid, graphs)
+
+        print("Matching %d protein residues in %d processes"
+              % (len(jobs), self.processes))
+        matches = self._match_residues(jobs)
+        for frag in frags:
+            prot_molid, graphs = prepared[frag]
+            prepared[frag] = (prot_molid, graphs, matches[:len(graphs)])
+            matches = matches[len(graphs):]
+        return prepared
+
+    #==========================================================================
+
+    def _start_pool(self):
+        """
+        Starts the worker processes residues are matched in, each with
+        its own copy of the matcher
+
+        Returns:
+            (multiprocessing.Pool) the workers, or None if residues should
+              be matched on the main thread
+        """
+        # Worker processes, such as batch builds, can't start their own
+        if self.processes < 2 or multiprocessing.current_process().daemon:
+            return None
+        return multiprocessing.Pool(self.processes,
+                                    initializer=_set_worker_matcher,
+                                    initargs=(self.matcher,))
+
+    #==========================================================================
+
+    def _match_residues(self, jobs):
+        """
+        Matches residue graphs to the topologies in the worker processes
+
+        Args:
+            jobs (list of tuple): Residue name and graph of each residue
+
+        Returns:
+            (list of tuple) for each residue, the matched residue name and
+              atom names as from CharmmMatcher.match_graph, and if that
+              failed, the patch match from CharmmMatcher.match_patches,
+              or None
+        """
+        if not len(jobs):
+            return []
+        chunksize = max(1, len(jobs) // (4*self.processes))
+        return self._pool.map(_match_residue, jobs, chunksize=chunksize)
+
+    #==========================================================================
+
     def _number_protein_fragment(self, frag, molid):
         """
         Pulls out the indicated protein fragment and renumbers the residues
@@ -734,11 +890,10 @@ class CharmmWriter(object):
                             % rid).set('resid', resid+1)
                     print("\tNMA %d -> %d" % (resid, resid+1))
 
-        # Have to save and reload so residues are parsed correctly by VMD
-        temp = tempfile.mkstemp(suffix='_P%s.mae' % frag,
-                                prefix='psf_prot_', dir=self.tmp_dir)[1]
-        fragment.write('mae', temp)
-        prot_molid = molecule.load('mae', temp)
+        # Have to copy to a new molecule so residues are parsed correctly
+        # by VMD
+        prot_molid = MoleculeBuffer.from_molid(molid, 'fragment %s' % frag) \
+                .to_molid('psf_prot_P%s' % frag)
 
         # Put things back the way they were
         if old_top != -1:
@@ -759,84 +914,10 @@ class CharmmWriter(object):
           sel (str): VMD atomsel string for atoms that will be written
           molid (int): VMD molecule ID to write from
         """
-        old_top = molecule.get_top()
-        molecule.set_top(molid)
-
-        fileh = open(filename, 'w')
-        # Use resids since order can be wrong when sorting by residue
-        # Then, use residue to pull out each one since it is much much
-        # faster then trying to pull out residues
-        resids = set(atomsel(sel).get('resid'))
-
-        # Add additional residue constraint to selection since pulling out
-        # by resid can match something in a different chain
-        resstr = ' '.join([str(x) for x in set(atomsel(sel).get('residue'))])
-
-        idx = 1
-        # For renumbering capping groups
-        for resid in sorted(resids):
-            rid = atomsel('resid %d and residue %s'
-                          % (resid,resstr)).get('residue')[0]
-#            names = set(atomsel('residue %d'% rid).get('resname'))
-#            assert len(names) < 3, ("More than 2 residues with same number... "
-#                                    "currently unhandled. Report a bug")
-#
-#            if len(names) > 1:
-#                if 'ACE' in names and 'NMA' in names:
-#                    print("ERROR: Both ACE and NMA were given the same resid"
-#                          "Check your input structure")
-#                    quit(1)
-#
-#                if 'ACE' in names:
-#                    # Set ACE residue number as one less
-#                    resid = atomsel('residue %d and not resname ACE' % rid).get('resid')[0]
-#                    if len(atomsel('(%s) and resid %d' % (sel, resid-1))):
-#                        raise ValueError('ACE resid collision number %d' % resid-1)
-#                    atomsel('residue %d and resname ACE'
-#                            % rid).set('resid', resid-1)
-#
-#                    # Handle all of the ACE atoms before the others
-#                    atoms = atomsel('residue %d and resname ACE'
-#                                    % rid).get('index')
-#                    atoms.extend(atomsel('residue %d and not resname ACE'
-#                                         % rid).get('index'))
-#
-#                elif 'NMA' in names:
-#                    # Set NMA residue number as one more
-#                    resid = atomsel('residue %d and not resname NMA' % rid).get('resid')[0]
-#                    if len(atomsel('(%s) and resid %d' % (sel, resid+1))):
-#                        raise ValueError('NMA resid collision number %d' % resid+1)
-#
-#                    atomsel('residue %d and resname NMA'
-#                            % rid).set('resid', resid+1)
-#                    # Handle all the NMA atoms after the others
-#                    atoms = atomsel('residue %d and not resname NMA'
-#                                    % rid).get('index')
-#                    atoms.extend(atomsel('residue %d and resname NMA'
-#                                         % rid).get('index'))
-#
-#            else:
-#                atoms = atomsel('residue %d' % rid).get('index')
-
-            for i in atomsel('residue %d' % rid).get('index'):
-                a = atomsel('index %d' % i) # pylint: disable=invalid-name
-                entry = ('%-6s%5d %-5s%-4s%c%4d    %8.3f%8.3f%8.3f%6.2f%6.2f'
-                         '     %-4s%2s\n' % ('ATOM', idx, a.get('name')[0],
-                                             a.get('resname')[0],
-                                             a.get('chain')[0],
-                                             a.get('resid')[0],
-                                             a.get('x')[0],
-                                             a.get('y')[0],
-                                             a.get('z')[0],
-                                             0.0, 0.0, a.get('segname')[0],
-                                             a.get('element')[0]))
-                idx += 1
-                fileh.write(entry)
-        fileh.write('END\n')
-        atomsel(sel).set('user', 0.0) # Mark as written
-        fileh.close()
-        molecule.set_top(old_top)
-
+        selection = atomsel(sel, molid=molid)
+        columns = get_pdb_columns(selection)
+        write_pdb(filename, columns, order=_get_residue_order(columns))
+        selection.set('user', 0.0) # Mark as written
 
     #==========================================================================
 
@@ -857,13 +938,26 @@ class CharmmWriter(object):
         # Open the pdb file in VMD and check for atoms with no occupancy
         fileh = molecule.load('pdb', '%s.pdb' % self.psf_name)
         errors = atomsel("occupancy=-1", molid=fileh)
+        self._report_missing_atoms(zip(errors.get("resname"),
+                                       errors.get("resid"),
+                                       errors.get("name")))
+
+    #==========================================================================
+
+    def _report_missing_atoms(self, missing):
+        """
+        Exits with an error message if any atoms in the topology were
+        not present in the input structure
 
-        # Print out error messages
-        if len(errors):
+        Args:
+          missing (list of tuple): Resname, resid and name of each atom
+            that couldn't be found
+        """
+        missing = list(missing)
+        if len(missing):
             print("\nERROR: Couldn't find the following atoms.")
-            for i in range(len(errors)):
-                print("  %s%s:%s" % (errors.get("resname")[i], errors.get("resid")[i],
-                                   errors.get("name")[i]))
+            for resname, resid, name in missing:
+                print("  %s%s:%s" % (resname, resid, name))
 
             print("Check if they are present in the original structure.\n"
                   "If they are, check dabble name translation or file a "
@@ -1093,4 +1187,165 @@ class CharmmWriter(object):
                       % name)
                 atomsel('name %s', molid=molid).set('name', name.replace(' ', ''))
 
+#
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                              MODULE FUNCTIONS                               #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def get_topologies(extra_topos=None):
+    """
+    Gets the topology files a CharmmWriter matches residues against
+
+    Args:
+      extra_topos (list of str): Additional topology files, used after
+        the defaults
+
+    Returns:
+      (list of str) default topology files, then any extra ones
+    """
+    topologies = [
+        resource_filename(__name__, "charmm_parameters/top_all36_caps.rtf"),
+        resource_filename(__name__, "charmm_parameters/top_water_ions.rtf"),
+        resource_filename(__name__, "charmm_parameters/top_all36_cgenff.rtf"),
+        resource_filename(__name__, "charmm_parameters/top_all36_prot.rtf"),
+        resource_filename(__name__, "charmm_parameters/top_all36_lipid.rtf"),
+        resource_filename(__name__, "charmm_parameters/top_all36_carb.rtf"),
+        resource_filename(__name__, "charmm_parameters/top_all36_na.rtf"),
+        resource_filename(__name__, "charmm_parameters/toppar_all36_prot_na_combined.str"),
+        resource_filename(__name__, "charmm_parameters/toppar_all36_prot_fluoro_alkanes.str"),
+        ]
+    if extra_topos:
+        topologies.extend(extra_topos)
+    return topologies
+
+#==========================================================================
+
+def _get_residue_order(columns):
+    """
+    Orders atoms by resid, since psfgen wants each residue sequentially.
+    Uses resids since order can be wrong when sorting by residue. Each
+    resid is taken as the whole residue of its first atom, since pulling
+    out by resid alone can match something in a different chain.
+
+    Args:
+      columns (dict str -> numpy array): Atom fields, as from
+        fileutils.get_pdb_columns
+
+    Returns:
+      (numpy array of int) positions in columns of the atoms, in order
+    """
+    if not len(columns['resid']):
+        return np.zeros(0, dtype=int)
+    _, first = np.unique(columns['resid'], return_index=True)
+    rank = -np.ones(columns['residue'].max() + 1, dtype=int)
+    rank[columns['residue'][first][::-1]] = np.arange(len(first))[::-1]
+    rank = rank[columns['residue']]
+    order = np.flatnonzero(rank >= 0)
+    return order[np.argsort(rank[order], kind='mergesort')]
+
+#==========================================================================
+
+def _get_water_order(columns):
+    """
+    Finds the waters that can be written to psfgen as they are, which
+    are those with three atoms at consecutive indices.
+
+    Args:
+      columns (dict str -> numpy array): Atom fields of the waters, as from
+        fileutils.get_pdb_columns
+
+    Returns:
+      (numpy array of int) positions in columns of the atoms in good
+        waters, in order
+      (list of int) residues of the other, problem waters
+    """
+    index = columns['index']
+    residue = columns['residue']
+    if not len(residue):
+        return np.zeros(0, dtype=int), []
+
+    order = np.argsort(residue, kind='mergesort')
+    waters, starts, counts = np.unique(residue[order], return_index=True,
+                                       return_counts=True)
+    spread = np.maximum.reduceat(index[order], starts) - \
+             np.minimum.reduceat(index[order], starts)
+    ok = (counts == 3) & (spread == 2)
+    good = ok[np.searchsorted(waters, residue)]
+    return np.flatnonzero(good), waters[~ok].tolist()
+
+#==========================================================================
+
+def _set_worker_matcher(matcher):
+    """
+    Sets the matcher used by _match_residue in a worker process
+
+    Args:
+      matcher (CharmmMatcher): Matcher to use
+    """
+    global _worker_matcher # pylint: disable=global-statement, invalid-name
+    _worker_matcher = matcher
+
+_worker_matcher = None # pylint: disable=invalid-name
+
+#==========================================================================
+
+def _match_residue(job):
+    """
+    Matches one residue graph to the topologies. Runs in a worker process.
+
+    Args:
+      job (tuple): Residue name and graph of the residue
+
+    Returns:
+      (tuple) resname and atom names matched, or None, None
+      (tuple) resname, patch and atom names matched if the residue
+        matched a patched residue instead, otherwise None
+    """
+    resname, rgraph = job
+    (newname, atomnames) = _worker_matcher.match_graph(resname, rgraph)
+    if newname:
+        return (newname, atomnames), None
+
+    patched = _worker_matcher.match_patches(rgraph, resname=resname)
+    return (newname, atomnames), (patched if patched[0] else None)
+
+#==========================================================================
+
+def _write_water_pdb(args):
+    """
+    Writes a pdb file of waters for psfgen. Takes a single tuple so it
+    can be mapped across processes.
+
+    Args:
+      args (tuple): Filename to write, atom columns as from
+        fileutils.get_pdb_columns, and resid of each atom
+    """
+    filename, columns, resids = args
+    write_pdb(filename, columns, resids=resids)
+
+#==========================================================================
+
+def _map_parallel(function, jobs):
+    """
+    Runs a function on each job, in parallel if there is more than one
+    and this isn't already a worker process, since those can't start
+    their own.
+
+    Args:
+      function (callable): Module level function taking one argument
+      jobs (list): Arguments to call the function with
+    """
+    if len(jobs) < 2 or multiprocessing.current_process().daemon:
+        for job in jobs:
+            function(job)
+        return
+
+    pool = multiprocessing.Pool(min(len(jobs), multiprocessing.cpu_count()))
+    try:
+        pool.map(function, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -52,8 +52,12 @@ class CharmmMatcher(MoleculeMatcher):
             from parent class
         nodenames (dict name -> element): Translates atom names to
             elements, from parent class
-        known_pres (dict tuple (str resname, patchname) -> networkx graph)
+        known_pres (dict tuple (str resname, patchname) -> networkx graph):
+            Patched amino acids built so far, or None if the patch
+            doesn't apply. Built on demand by _get_patched
         patches (dict patchname -> str instructions): Known patches
+        residues (dict resname -> str instructions): Known residues
+        masses (dict str type -> float): Mass of each atom type
     """
 
     #==========================================================================
@@ -64,6 +68,8 @@ class CharmmMatcher(MoleculeMatcher):
         as known molecules
         """
         self.patches = {}
+        self.residues = {}
+        self.masses = {}
         self.known_pres = {}
 
         # Parent assigns and parses topologies
@@ -73,12 +79,8 @@ class CharmmMatcher(MoleculeMatcher):
         for res in self.known_res.keys():
             self._assign_elements(self.known_res[res])
 
-        # Create dictionary of patched amino acids that we know about
-        for res in [s for s in self.known_res.keys() if s in self._acids]:
-            for patch in self.patches.keys():
-                applied = self._apply_patch(res, patch)
-                if applied:
-                    self.known_pres[(res, patch)] = applied
+        # Patched amino acids are built when first needed, by _get_patched
+        self._patch_index = {}
 
     #=========================================================================
     #                            Public methods                              #
@@ -104,17 +106,48 @@ class CharmmMatcher(MoleculeMatcher):
         resname = selection.get('resname')[0]
         rgraph = self.parse_vmd_graph(selection)[0]
 
-        # Check this residue against all possible patches applied to the
-        for names in self.known_pres.keys():
-            graph = self.known_pres[names]
-            matcher = isomorphism.GraphMatcher(rgraph, graph, \
-                        node_match=super(CharmmMatcher, self)._check_atom_match)
-            if matcher.is_isomorphic():
-                logger.info("Detected patch %s", names[1])
-                return (names[0], names[1], matcher.match().next())
+        result = self.match_patches(rgraph, resname=resname)
+        if result[0] is None:
+            logger.error("Couldn't find a patch for resname %s. Dumping as 'rgraph.dot'", resname)
+            nx.write_dot(rgraph, "rgraph.dot")
+        return result
+
+    #=========================================================================
+
+    def match_patches(self, rgraph, resname=None):
+        """
+        Obtains names and patch info for a modified residue graph, as in
+        get_patches. Doesn't use VMD, so can be run in a worker process.
+
+        Args:
+            rgraph (networkx graph): Graph of the residue
+            resname (str): Residue name of the graph, if known. Patches
+                to this residue are tried first
+
+        Returns:
+            (str, str, dict) resname matched, patch applied,
+              name translation dictionary, or all None if no patch matched
+        """
+        formula = self._formula(rgraph)
+        residues = [s for s in self.known_res.keys() if s in self._acids]
+        if resname in residues:
+            residues.remove(resname)
+            residues.insert(0, resname)
+
+        # Check this residue against the patches that would give it the
+        # right atoms, applied to each amino acid
+        for res in residues:
+            delta = _subtract(formula, self._formula(self.known_res[res]))
+            for patch in self._get_patch_index(res).get(delta, []):
+                graph = self._get_patched(res, patch)
+                if graph is None:
+                    continue
+                matcher = isomorphism.GraphMatcher(rgraph, graph, \
+                            node_match=super(CharmmMatcher, self)._check_atom_match)
+                if matcher.is_isomorphic():
+                    logger.info("Detected patch %s", patch)
+                    return (res, patch, matcher.match().next())
 
-        logger.error("Couldn't find a patch for resname %s. Dumping as 'rgraph.dot'", resname)
-        nx.write_dot(rgraph, "rgraph.dot")
         return (None, None, None)
 
     #=========================================================================
@@ -209,7 +242,7 @@ class CharmmMatcher(MoleculeMatcher):
 
     #=========================================================================
 
-    def get_names(self, selection, print_warning=False):
+    def get_names(self, selection, print_warning=False, rgraph=None):
         """
         Returns at atom name matching up dictionary.
         Does the generic moleculematcher algorithm then checks that only
@@ -219,6 +252,8 @@ class CharmmMatcher(MoleculeMatcher):
         Args:
             selection (VMD atomsel): Selection to rename
             print_warning (bool): Debug output
+            rgraph (networkx graph): Graph of the selection, if already
+                built by iter_vmd_graphs
 
         Returns:
             (str) resname matched
@@ -227,22 +262,48 @@ class CharmmMatcher(MoleculeMatcher):
         Raises:
             ValueError if more than one residue name is matched
         """
-        (resnames, atomnames) = super(CharmmMatcher,self).get_names(selection,
-                                                                    print_warning)
+        resname = selection.get('resname')[0]
+        if rgraph is None:
+            rgraph = self.parse_vmd_graph(selection)[0]
+
+        (newname, atomnames) = self.match_graph(resname, rgraph)
+        if newname is None and print_warning:
+            self._print_match_warning(resname, len(selection))
+        return (newname, atomnames)
+
+    #=========================================================================
+
+    def match_graph(self, resname, rgraph):
+        """
+        Returns an atom name matching up dictionary for a residue graph,
+        as in get_names. Doesn't use VMD, so can be run in a worker
+        process.
+
+        Args:
+            resname (str): Residue name of the graph
+            rgraph (networkx graph): Graph of the residue
+
+        Returns:
+            (str) resname matched, or None
+            (dict int->str) translation dictionary from index to atom name
+
+        Raises:
+            ValueError if more than one residue name is matched
+        """
+        (resnames, atomnames) = self._match_graph(resname, rgraph)
         if not resnames:
             return (None, None)
 
         # Set the resname correctly after checking only one resname
         # matched since this is charmm
-        resname = set(resnames.values())
-        if len(resname) > 1:
+        newname = set(resnames.values())
+        if len(newname) > 1:
             raise ValueError("More than one residue name was returned as "
                              "belonging to a single residue in CHARMM matching."
                              " Not sure how this happened; something is really "
-                             "really wrong. Residue was: %s:%d" %
-                             (sel.get("resname")[0], sel.get("resid")[0]))
+                             "really wrong. Residue was: %s" % resname)
 
-        return (resname.pop(), atomnames)
+        return (newname.pop(), atomnames)
 
     #=========================================================================
     #                           Private methods                              #
@@ -269,6 +330,7 @@ class CharmmMatcher(MoleculeMatcher):
         data = ""
         patch = False
 
+        self.sources.append(filename)
         with open(filename, 'r') as fh:
             for line in fh:
                 # Remove comments except "special" graphmatcher directives
@@ -292,6 +354,7 @@ class CharmmMatcher(MoleculeMatcher):
                         self.patches[resname] = data
                     else:
                         self.known_res[resname] = self._rtf_to_graph(data, resname)
+                        self.residues[resname] = data
                     data = ""
 
                 # Handle new residue definition
@@ -316,6 +379,7 @@ class CharmmMatcher(MoleculeMatcher):
                     else:
                         self.nodenames[tokens[2]] = \
                                 MoleculeMatcher.get_element(float(tokens[3]))
+                        self.masses[tokens[2]] = float(tokens[3])
                 elif resname and resname != "_skip":
                     data += ' '.join(tokens) + '\n'
 
@@ -325,6 +389,7 @@ class CharmmMatcher(MoleculeMatcher):
                 self.patches[resname] = data
             else:
                 self.known_res[resname] = self._rtf_to_graph(data, resname)
+                self.residues[resname] = data
 
         return True
 
@@ -403,6 +468,7 @@ class CharmmMatcher(MoleculeMatcher):
                 else:
                     self.nodenames[tokens[2]] = \
                             MoleculeMatcher.get_element(float(tokens[3]))
+                    self.masses[tokens[2]] = float(tokens[3])
 
             # Patches can delete atoms
             elif tokens[0] == "DELETE" or tokens[0] == "DELE":
@@ -495,6 +561,93 @@ class CharmmMatcher(MoleculeMatcher):
 
     #=========================================================================
 
+    def _get_patched(self, matchname, patch):
+        """
+        Gets a patched amino acid, building it the first time
+
+        Args:
+          matchname (str): The residue to patch
+          patch (str): The patch to apply
+
+        Returns:
+          networkx graph that's the patched residue, or None
+          if the patch does not apply
+        """
+        if (matchname, patch) not in self.known_pres:
+            self.known_pres[(matchname, patch)] = self._apply_patch(matchname,
+                                                                    patch)
+        return self.known_pres[(matchname, patch)]
+
+    #=========================================================================
+
+    def _get_patch_index(self, matchname):
+        """
+        Groups patches by how they would change the atoms of a residue,
+        predicted from the ATOM and DELETE ATOM lines of each patch
+        without building the patched graph. Only patches that give a
+        residue the same atoms as an observed one need to be tried.
+
+        Args:
+          matchname (str): The residue to be patched
+
+        Returns:
+          (dict tuple -> list of str) patch names, in patches order, by
+            change in formula as from _subtract
+        """
+        if matchname in self._patch_index:
+            return self._patch_index[matchname]
+
+        graph = self.known_res[matchname]
+        index = {}
+        for patch in self.patches.keys():
+            names = dict((n, self._match_label(d)[0])
+                         for n, d in graph.nodes(data=True)
+                         if d.get('residue') == "self")
+            before = self._count(names.values())
+            for line in self.patches[patch].splitlines():
+                tokens = [i.strip().upper() for i in line.split()]
+                if len(tokens) > 2 and tokens[0] == "ATOM" and \
+                   tokens[1] not in names:
+                    names[tokens[1]] = self._match_label(
+                        {'element': self.nodenames.get(tokens[2])})[0]
+                elif len(tokens) > 2 and tokens[0] in ("DELETE", "DELE") and \
+                     tokens[1] == "ATOM":
+                    name = tokens[2][1:] if tokens[2][0].isdigit() else tokens[2]
+                    names.pop(name, None)
+            delta = _subtract(self._count(names.values()), before)
+            index.setdefault(delta, []).append(patch)
+
+        self._patch_index[matchname] = index
+        return index
+
+    #=========================================================================
+
+    @classmethod
+    def _formula(cls, graph):
+        """
+        Returns:
+          (dict str -> int) number of atoms of each element in the
+            residue itself, not counting +/- joins
+        """
+        return cls._count(cls._match_label(d)[0]
+                          for _, d in graph.nodes(data=True)
+                          if d.get('residue') == "self")
+
+    #=========================================================================
+
+    @staticmethod
+    def _count(elements):
+        """
+        Returns:
+          (dict str -> int) number of times each element occurs
+        """
+        counts = {}
+        for element in elements:
+            counts[element] = counts.get(element, 0) + 1
+        return counts
+
+    #=========================================================================
+
     def _apply_patch(self, matchname, patch):
         """
         Applies a patch to a graph, returning a modified graph
@@ -569,5 +722,18 @@ class CharmmMatcher(MoleculeMatcher):
                        graph.node[e[1]]["patched"]):
                     graph.remove_node(n)
 
-    #=========================================================================
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                              MODULE FUNCTIONS                               #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
+def _subtract(formula, other):
+    """
+    Returns:
+      (tuple) the elements whose counts differ between two formulas and
+        by how much, in a form that can be used as a dictionary key
+    """
+    return tuple(sorted((element, formula.get(element, 0) - other.get(element, 0))
+                        for element in set(formula) | set(other)
+                        if formula.get(element, 0) != other.get(element, 0)))
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -24,18 +24,31 @@ Boston, MA 02111-1307, USA.
 
 from __future__ import print_function
 import abc
+import hashlib
 import logging
+import os
+import tempfile
 from itertools import product
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import networkx as nx
+import numpy as np
 from networkx.algorithms import isomorphism
 # pylint: disable=import-error, unused-import
 import vmd
 from atomsel import atomsel
 # pylint: enable=import-error, unused-import
 
+from Dabble.fileutils import hash_file
+
 logger = logging.getLogger(__name__) # pylint: disable=invalid-name
 
+# Bump when the parsed representation of topologies changes, so old
+# cached matchers are not loaded
+_CACHE_VERSION = 3
 
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -56,6 +69,7 @@ class MoleculeMatcher(object): # pylint: disable=too-few-public-methods
         patches (dict patchname -> str instructions): Known patches
         nodenames (dict name -> element): Translates atom names to
             elements
+        sources (list of str): Every file read while parsing the topologies
     """
 
     #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -98,6 +112,7 @@ class MoleculeMatcher(object): # pylint: disable=too-few-public-methods
             self.topologies = kwargs.get("topologies")
             self.nodenames = {}
             self.known_res = {}
+            self.sources = []
 
             # Parse input topology files
             for filename in self.topologies:
@@ -114,7 +129,63 @@ class MoleculeMatcher(object): # pylint: disable=too-few-public-methods
     #                            Public methods                              #
     #=========================================================================
 
-    def get_names(self, selection, print_warning=False):
+    @classmethod
+    def cached(cls, topologies, cache_dir=None):
+        """
+        Creates a matcher for the given topologies, loading the parsed
+        topologies from an on-disk cache if none of the files read to
+        create it have changed. Otherwise, the topologies are parsed
+        and the result saved to the cache for next time.
+
+        Args:
+            topologies (list of str): Topologies to initialize
+            cache_dir (str): Directory to cache parsed topologies in, or
+                None for the default from get_cache_dir
+
+        Returns:
+            (MoleculeMatcher) matcher of this class for the topologies
+        """
+        if cache_dir is None:
+            cache_dir = get_cache_dir()
+        key = hashlib.sha1(("%s %d" % (cls.__name__, _CACHE_VERSION)).encode('utf-8'))
+        for top in topologies:
+            key.update(os.path.abspath(top).encode('utf-8'))
+        filename = os.path.join(cache_dir, "%s_%s.pkl" % (cls.__name__.lower(),
+                                                          key.hexdigest()))
+
+        try:
+            with open(filename, 'rb') as fileh:
+                saved = pickle.load(fileh)
+            if all(hash_file(src) == digest for src, digest in saved['sources']):
+                matcher = cls.__new__(cls)
+                matcher.__dict__.update(saved['state'])
+                # Keep the caller's list, it may be added to later
+                matcher.topologies = topologies
+                return matcher
+            logger.info("Topologies changed, reparsing them")
+        except (IOError, OSError, EOFError, KeyError, ValueError,
+                AttributeError, ImportError, pickle.UnpicklingError):
+            pass
+
+        matcher = cls(topologies)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            sources = [(src, hash_file(src)) for src in sorted(set(matcher.sources))]
+            # Write to a temporary file and rename so other processes never
+            # see a partial file
+            handle, temp = tempfile.mkstemp(suffix='.pkl', dir=cache_dir)
+            with os.fdopen(handle, 'wb') as fileh:
+                pickle.dump({'sources': sources, 'state': matcher.__dict__},
+                            fileh, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp, filename)
+        except (IOError, OSError) as err:
+            logger.warning("Couldn't cache parsed topologies: %s", err)
+        return matcher
+
+    #=========================================================================
+
+    def get_names(self, selection, print_warning=False, rgraph=None):
         """
         Obtains a name mapping for the current selection
 
@@ -122,6 +193,8 @@ class MoleculeMatcher(object): # pylint: disable=too-few-public-methods
             selection (VMD atomsel): Selection to set names for
             print_warning (bool): Whether or not to print matching suggestions
                 if matching fails. Set to false if you'll try patches later.
+            rgraph (networkx graph): Graph of the selection, if already
+                built by iter_vmd_graphs
 
         Returns:
             (dict int->str) Atom index to resname matched
@@ -131,7 +204,36 @@ class MoleculeMatcher(object): # pylint: disable=too-few-public-methods
             KeyError: if no matching possible
         """
         resname = selection.get('resname')[0]
-        rgraph = self.parse_vmd_graph(selection)[0]
+        if rgraph is None:
+            rgraph = self.parse_vmd_graph(selection)[0]
+
+        (resmatch, match) = self._match_graph(resname, rgraph)
+        if resmatch is None and print_warning:
+            self._print_match_warning(resname, len(selection))
+        return (resmatch, match)
+
+    #=========================================================================
+    #                           Private methods                              #
+    #=========================================================================
+
+    def _match_graph(self, resname, rgraph):
+        """
+        Obtains a name mapping for a residue graph. Doesn't use VMD, so
+        can be run in a worker process.
+
+        Args:
+            resname (str): Residue name of the graph
+            rgraph (networkx graph): Graph of the residue
+
+        Returns:
+            (dict int->str) Atom index to resname matched, or None
+            (dict int->str) Atom index to atom name matched up, or None
+        """
+        # Identical residues seen before are named the same way
+        key, order = self._match_key(resname, rgraph)
+        cached = self._recall_match(key, order)
+        if cached:
+            return cached
 
         # First check against matching residue names
         if resname in self.known_res.keys():
@@ -142,10 +244,10 @@ class MoleculeMatcher(object): # pylint: disable=too-few-public-methods
                 match = matcher.match().next()
                 resmatch = dict((i, graph.node[match[i]].get("resname")) \
                                 for i in match.keys())
-                return (resmatch, match)
+                return self._remember_match(key, order, (resmatch, match))
 
-        # If that didn't work, loop through all known residues
-        for matchname in self.known_res.keys():
+        # If that didn't work, loop through known residues that could match
+        for matchname in self._get_candidates(rgraph):
             graph = self.known_res[matchname]
             matcher = isomorphism.GraphMatcher(rgraph, graph,
                                                node_match=self._check_atom_match)
@@ -154,26 +256,128 @@ class MoleculeMatcher(object): # pylint: disable=too-few-public-methods
                 match = matcher.match().next()
                 resmatch = dict((i,graph.node[match[i]].get("resname")) \
                                 for i in match.keys())
-                return (resmatch, match)
-
-        # Try to print out a helpful error message here if matching failed
-        if print_warning:
-            print("\nERROR: Couldn't find a topological match for resname %s" % resname)
-            if self.known_res.get(resname):
-                print("      I found a residue definition with the same name, but "
-                      "it didn't match up")
-                print("      That definition had %d atoms, and your residue had "
-                      "%d atoms" % (len(self.known_res[resname]), len(selection)))
-                print("      If that's the same, check the connectivity")
-                print("      If it's not, check your hydrogens")
-            else:
-                print("      I couldn't find any residues with that name. Did you "
-                      "forget to provide a topology file?")
+                return self._remember_match(key, order, (resmatch, match))
 
         return (None, None)
 
     #=========================================================================
-    #                           Private methods                              #
+
+    def _print_match_warning(self, resname, natoms):
+        """
+        Prints a helpful error message when a residue couldn't be matched
+
+        Args:
+            resname (str): Residue name that failed to match
+            natoms (int): Number of atoms in the residue
+        """
+        print("\nERROR: Couldn't find a topological match for resname %s" % resname)
+        if self.known_res.get(resname):
+            print("      I found a residue definition with the same name, but "
+                  "it didn't match up")
+            print("      That definition had %d atoms, and your residue had "
+                  "%d atoms" % (len(self.known_res[resname]), natoms))
+            print("      If that's the same, check the connectivity")
+            print("      If it's not, check your hydrogens")
+        else:
+            print("      I couldn't find any residues with that name. Did you "
+                  "forget to provide a topology file?")
+
+    #=========================================================================
+
+    def _get_candidates(self, rgraph):
+        """
+        Finds the known residues that could be isomorphic to a graph.
+        Isomorphic graphs have the same invariant, so residues are indexed
+        by invariant and only those sharing the graph's invariant need a
+        full isomorphism check.
+
+        Args:
+            rgraph (networkx graph): Graph to be matched
+
+        Returns:
+            (list of str) names of candidate residues, in known_res order
+        """
+        # Built on first use since subclasses modify known_res after parsing
+        if getattr(self, "_index", None) is None:
+            self._index = {}
+            for name, graph in self.known_res.items():
+                self._index.setdefault(self._graph_invariant(graph),
+                                       []).append(name)
+        return self._index.get(self._graph_invariant(rgraph), [])
+
+    #=========================================================================
+
+    def _match_key(self, resname, rgraph):
+        """
+        Computes a key identifying a residue graph, so residues that were
+        already matched can be named without another isomorphism search.
+        Atoms are put in a fixed order, residue atoms by index and then
+        joined atoms by residue membership and index, and the key holds
+        the attributes of each atom and the bonds between them in that
+        order. Identical residues written with the same atom order, like
+        all the waters or lipids of one type in a system, have the same key.
+
+        Args:
+            resname (str): Residue name of the graph
+            rgraph (networkx graph): Graph of the residue
+
+        Returns:
+            (tuple) key for the residue
+            (list) graph nodes in the order used by the key
+        """
+        attrs = dict(rgraph.nodes(data=True))
+        order = sorted(rgraph.nodes(),
+                       key=lambda n: (attrs[n].get('residue') != "self",
+                                      attrs[n].get('residue'), n))
+        pos = dict((n, i) for i, n in enumerate(order))
+        labels = tuple((attrs[n].get('element'), attrs[n].get('residue'))
+                       for n in order)
+        bonds = tuple(sorted(tuple(sorted((pos[i], pos[j])))
+                             for i, j in rgraph.edges()))
+        return (resname, labels, bonds), order
+
+    #=========================================================================
+
+    def _recall_match(self, key, order):
+        """
+        Looks up the result of matching an identical residue
+
+        Args:
+            key (tuple): Key of the residue, from _match_key
+            order (list): Nodes of the residue in key order
+
+        Returns:
+            (tuple of dict) the result of matching the residue, as
+              dictionaries keyed by this residue's nodes, or None
+        """
+        saved = getattr(self, "_matches", {}).get(key)
+        if saved is None:
+            return None
+        return tuple(dict((order[i], value) for i, value in result)
+                     for result in saved)
+
+    #=========================================================================
+
+    def _remember_match(self, key, order, result):
+        """
+        Saves the result of matching a residue, in terms of node positions
+        so it can be applied to identical residues
+
+        Args:
+            key (tuple): Key of the residue, from _match_key
+            order (list): Nodes of the residue in key order
+            result (tuple of dict): Dictionaries keyed by node
+
+        Returns:
+            (tuple of dict) result, unchanged
+        """
+        if getattr(self, "_matches", None) is None:
+            self._matches = {}
+        self._matches[key] = tuple(tuple((i, res[n]) for i, n in enumerate(order)
+                                         if n in res)
+                                   for res in result)
+        return result
+
     #=========================================================================
 
     __metaclass__ = abc.ABCMeta
@@ -244,6 +448,49 @@ class MoleculeMatcher(object): # pylint: disable=too-few-public-methods
 
     #=========================================================================
 
+    @staticmethod
+    def _match_label(node):
+        """
+        Gets a label for a node such that nodes that match under
+        _check_atom_match always have the same label. Unknown elements
+        all match each other, so they get the same label.
+
+        Args:
+            node (dict): Node attributes
+
+        Returns:
+            (tuple of str) the label
+        """
+        element = node.get('element')
+        if element not in MoleculeMatcher.MASS_LOOKUP.values():
+            element = "Other"
+        return (element, node.get('residue') or "")
+
+    #=========================================================================
+
+    @classmethod
+    def _graph_invariant(cls, graph):
+        """
+        Computes a value that is the same for any two graphs that are
+        isomorphic under _check_atom_match. This is the sorted list of
+        node labels, each paired with the sorted labels of its neighbors,
+        so it captures the element formula, the number of +/- joins and
+        the degree of each atom.
+
+        Args:
+            graph (networkx graph): Graph to compute invariant of
+
+        Returns:
+            (tuple) the invariant
+        """
+        labels = dict((n, cls._match_label(data))
+                      for n, data in graph.nodes(data=True))
+        return tuple(sorted((labels[n],
+                             tuple(sorted(labels[m] for m in graph.neighbors(n))))
+                            for n in graph.nodes()))
+
+    #=========================================================================
+
     @staticmethod
     def parse_vmd_graph(selection):
         """
@@ -272,41 +519,137 @@ class MoleculeMatcher(object): # pylint: disable=too-few-public-methods
             raise ValueError("Empty selection %s to vmd graph!" % selection)
         resid = resid.pop()
 
+        indices = selection.get('index')
+        bonds = selection.bonds
+
+        # Look up atoms in other residues that are bonded to this one,
+        # such as amino acid +N or -CA, all at once
+        others = set(j for bonded in bonds for j in bonded) - set(indices)
+        external = {}
+        if others:
+            osel = atomsel('index %s' % ' '.join(str(j) for j in others),
+                           molid=selection.molid)
+            external = dict(zip(osel.get('index'),
+                                zip(osel.get('resid'), osel.get('element'))))
+
+        rgraph = MoleculeMatcher._residue_graph(indices,
+                                                selection.get('element'),
+                                                bonds, resid, external)
+        return (rgraph, bool(others))
+
+    #=========================================================================
+
+    @staticmethod
+    def iter_vmd_graphs(selection):
+        """
+        Translates each residue in a VMD atom selection, such as a whole
+        fragment, to a graph representation. Atom attributes and bonds
+        are read from VMD once for the whole selection, rather than once
+        per residue as with parse_vmd_graph.
+
+        Args:
+            selection (VMD atomsel): Atom selection containing whole residues
+
+        Yields:
+            (int) VMD residue number
+            graph representing the residue, as from parse_vmd_graph
+
+        Raises:
+            ValueError if a residue contains more than one resid
+        """
+        # Atoms bonded to the selection may be anywhere in the molecule
+        whole = atomsel('all', molid=selection.molid)
+        resids = np.array(whole.get('resid'))
+        elements = np.array(whole.get('element'), dtype=object)
+
+        indices = np.array(selection.get('index'), dtype=int)
+        residues = np.array(selection.get('residue'), dtype=int)
+        bonds = selection.bonds
+        if not len(indices):
+            return
+
+        # Group atoms by residue, keeping index order within each
+        order = np.argsort(residues, kind='mergesort')
+        splits = np.flatnonzero(np.diff(residues[order])) + 1
+        for group in np.split(order, splits):
+            atoms = indices[group]
+            resid = set(resids[atoms].tolist())
+            if len(resid) > 1:
+                raise ValueError("Residue %d is more than one resid!"
+                                 % residues[group[0]])
+            resid = resid.pop()
+
+            rbonds = [bonds[i] for i in group]
+            others = set(j for bonded in rbonds for j in bonded) - \
+                     set(atoms.tolist())
+            external = dict((j, (resids[j], elements[j])) for j in others)
+            yield (int(residues[group[0]]),
+                   MoleculeMatcher._residue_graph(atoms.tolist(),
+                                                  elements[atoms].tolist(),
+                                                  rbonds, resid, external))
+
+    #=========================================================================
+
+    @staticmethod
+    def _residue_graph(indices, elements, bonds, resid, external):
+        """
+        Builds the graph of a residue from its atoms and bonds
+
+        Args:
+            indices (list of int): Atom indices in the residue
+            elements (list of str): Element of each atom
+            bonds (list of list of int): Atoms bonded to each atom
+            resid (int): Resid of the residue
+            external (dict int -> (int, str)): Resid and element of atoms
+                in other residues bonded to this one
+
+        Returns:
+            graph representing the residue, with nodes named indices
+        """
         # Name nodes by atom index so duplicate names aren't a problem
         rgraph = nx.Graph()
-        rgraph.add_nodes_from(selection.get('index'))
+        rgraph.add_nodes_from(indices)
 
         # Edges. This adds each bond twice but it's no big deal
-        for i in range(len(selection)):
-            gen = product([selection.get('index')[i]], selection.bonds[i])
-            rgraph.add_edges_from([bnd for bnd in gen])
+        for idx, bonded in zip(indices, bonds):
+            rgraph.add_edges_from(product([idx], bonded))
 
         # Dictionary translating index to element, set as known attribute
-        rdict = {selection.get('index')[i]: selection.get('element')[i] \
-                for i in range(len(selection))}
-
         # Set all atoms to belong to this residue by default
+        rdict = dict(zip(indices, elements))
+        edict = dict.fromkeys(indices, "self")
 
-        # Loop through all nodes for indices that are not in this selection.
-        # They were added to the graph from edges that go to other residues,
-        # such as amino acid +N or -CA bonds. Mark these as special elements.
-        edict = {selection.get('index')[i]: "self" \
-                 for i in range(len(selection))}
-        others = set(rgraph.nodes()) - set(selection.get('index'))
-        is_covalent = bool(len(others))
-        for oth in others:
-            sel = atomsel('index %d' % oth, molid=selection.molid)
-            resido = sel.get('resid')[0]
+        # Mark atoms in other residues as joins to the next or previous one
+        for oth, (resido, element) in external.items():
             if resido > resid:
                 edict[oth] = "+"
             else:
                 edict[oth] = "-"
-            rdict[oth] = sel.get('element')[0]
+            rdict[oth] = element
 
         # Set node attributes
         nx.set_node_attributes(rgraph, 'element', rdict)
         nx.set_node_attributes(rgraph, 'residue', edict)
 
-        return (rgraph, is_covalent)
+        return rgraph
 
-    #=========================================================================
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                              MODULE FUNCTIONS                               #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def get_cache_dir():
+    """
+    Gets the directory parsed topologies are cached in. This is
+    $DABBLE_CACHE_DIR if set, otherwise a dabble directory in the
+    user's cache directory.
+
+    Returns:
+        (str) cache directory, which may not exist yet
+    """
+    if os.environ.get("DABBLE_CACHE_DIR"):
+        return os.environ["DABBLE_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or \
+           os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "dabble")
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
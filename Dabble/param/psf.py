@@ -0,0 +1,551 @@
+"""
+This module contains the PsfBuilder class, which builds a CHARMM psf
+file in memory from the residue and patch definitions parsed by a
+CharmmMatcher, as an alternative to generating and running a psfgen
+script.
+
+Author: Robin Betz
+
+Copyright (C) 2015 Robin Betz
+
+This program is free software; you can redistribute it and/or modify it under
+the terms of the GNU Lesser General Public License as published by the Free
+Software Foundation; either version 2 of the License, or (at your option) any
+later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place - Suite 330
+Boston, MA 02111-1307, USA.
+"""
+
+from __future__ import print_function
+from collections import OrderedDict
+import numpy as np
+
+from Dabble.fileutils import write_pdb
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Number of atoms in each kind of bonded term, by the rtf keywords that
+# define it
+_TERMS = {'BOND': ('bonds', 2), 'DOUB': ('bonds', 2), 'TRIP': ('bonds', 2),
+          'ANGL': ('angles', 3), 'THET': ('angles', 3),
+          'DIHE': ('dihedrals', 4), 'PHI': ('dihedrals', 4),
+          'IMPR': ('impropers', 4), 'IMPH': ('impropers', 4),
+          'CMAP': ('cmaps', 8)}
+
+# Bonded terms in the order they are written, and how many fit on a line
+_SECTIONS = (('bonds', 'NBOND: bonds', 4),
+             ('angles', 'NTHETA: angles', 3),
+             ('dihedrals', 'NPHI: dihedrals', 2),
+             ('impropers', 'NIMPHI: impropers', 2))
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                                   CLASSES                                   #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+class PsfBuilder(object):
+    """
+    Builds a psf structure the way psfgen does, with segments and patches
+    added in the same order a psfgen script would issue them. Segments
+    are always built with no terminal patches, as dabble's psfgen
+    scripts request, and angles and dihedrals are generated from the
+    final bonds so no regenerate step is needed.
+
+    Attributes:
+      matcher (CharmmMatcher): Parsed topology definitions
+      segments (list of tuple): Name, whether angles and dihedrals are
+        generated, and list of residues of each segment
+      patches (list of str): Patches applied, as psfgen commands
+    """
+
+    #==========================================================================
+
+    def __init__(self, matcher):
+        """
+        Args:
+          matcher (CharmmMatcher): Matcher holding the topologies to use
+        """
+        self.matcher = matcher
+        self.segments = []
+        self.patches = []
+        self._residues = {}
+        self._terms = dict((kind, []) for kind, _ in _TERMS.values())
+        self._definitions = {}
+
+    #=========================================================================
+    #                            Public methods                              #
+    #=========================================================================
+
+    def segment(self, segname, columns, order=None, resids=None, auto=True):
+        """
+        Adds a segment, like psfgen's segment and coordpdb commands
+        together. A new residue starts whenever the resid changes.
+
+        Args:
+          segname (str): Segment name
+          columns (dict str -> numpy array): Atom fields, as from
+            fileutils.get_pdb_columns. Atoms must already have topology
+            atom and residue names
+          order (array of int): Positions in columns of the atoms in the
+            segment, in order, or None for all atoms in order
+          resids (array of int): Resid of each atom in the segment, or None
+            to use the resids in columns
+          auto (bool): Whether to generate angles and dihedrals
+
+        Raises:
+          ValueError if a residue isn't defined in the topologies
+        """
+        if order is None:
+            order = np.arange(len(columns['name']))
+        order = np.asarray(order, dtype=int)
+        if resids is None:
+            resids = columns['resid'][order]
+        resids = np.asarray(resids, dtype=int)
+        if not len(order):
+            return
+
+        names = columns['name'][order].tolist()
+        resnames = columns['resname'][order].tolist()
+        chains = columns['chain'][order].tolist()
+        elements = columns['element'][order].tolist()
+        coords = columns['coords'][order]
+        starts = np.flatnonzero(np.diff(resids)) + 1
+        bounds = zip([0] + starts.tolist(), starts.tolist() + [len(order)])
+
+        residues = []
+        for start, end in bounds:
+            residue = _Residue(segname, int(resids[start]), resnames[start])
+            for i in range(start, end):
+                residue.inputs[names[i]] = (coords[i], chains[i], elements[i])
+            for keyword, args in self._get_definition(residue.resname,
+                                                      patch=False):
+                if keyword == 'ATOM':
+                    residue.add_atom(*args)
+            residues.append(residue)
+            self._residues[(segname, residue.resid)] = residue
+        self.segments.append((segname, auto, residues))
+
+        # Terms can refer to the previous or next residue, so wait until
+        # the whole segment exists
+        for i, residue in enumerate(residues):
+            for keyword, args in self._get_definition(residue.resname,
+                                                      patch=False):
+                if keyword in _TERMS:
+                    self._add_terms(keyword, args, residues, i)
+
+    #==========================================================================
+
+    def patch(self, patchname, *targets):
+        """
+        Applies a patch, like psfgen's patch command
+
+        Args:
+          patchname (str): Name of the patch
+          targets (str): Residues to patch, as SEGNAME:RESID
+
+        Raises:
+          ValueError if the patch or a target residue doesn't exist
+        """
+        residues = []
+        for target in targets:
+            segname, resid = target.rsplit(':', 1)
+            if (segname, int(resid)) not in self._residues:
+                raise ValueError("Can't apply patch %s to nonexistent "
+                                 "residue %s" % (patchname, target))
+            residues.append(self._residues[(segname, int(resid))])
+        self.patches.append("patch %s %s" % (patchname, ' '.join(targets)))
+
+        # New atoms go after the atom listed before them, as in psfgen
+        previous = {}
+        for keyword, args in self._get_definition(patchname, patch=True):
+            if keyword == 'ATOM':
+                residue, name = _patch_target(residues, args[0])
+                residue.add_atom(name, args[1], args[2],
+                                 after=previous.get(id(residue)))
+                previous[id(residue)] = name
+            elif keyword == 'DELETE':
+                self._delete(args[0], [_patch_target(residues, n)
+                                       for n in args[1:]])
+            elif keyword in _TERMS:
+                self._add_terms(keyword, args, residues, None)
+
+    #==========================================================================
+
+    def write(self, psf_name, topologies=()):
+        """
+        Writes the built structure as an x-plor psf file with cmap terms,
+        and a pdb file with the input coordinates of each atom
+
+        Args:
+          psf_name (str): Prefix for the pdb/psf output files, extension
+            will be appended
+          topologies (list of str): Topology files, noted in the psf title
+
+        Returns:
+          (list of tuple) resname, resid and name of each atom with no
+            coordinates in the input
+
+        Raises:
+          ValueError if an atom type has no mass defined
+        """
+        atoms = [atom for _, _, residues in self.segments
+                 for residue in residues for atom in residue.atoms.values()]
+        for serial, atom in enumerate(atoms):
+            atom.serial = serial + 1
+        terms = self._get_terms()
+
+        missing = [(a.residue.resname, a.residue.resid, a.name)
+                   for a in atoms if a.name not in a.residue.inputs]
+        for residue in [r for _, _, residues in self.segments for r in residues]:
+            for name in set(residue.inputs) - set(residue.atoms):
+                print("WARNING: Ignoring atom %s:%d:%s, which is not in the "
+                      "topology" % (residue.resname, residue.resid, name))
+
+        # Use the extended format if any field doesn't fit the usual one
+        ext = len(atoms) > 99999 or \
+              any(len(a.name) > 4 or len(a.type) > 4 or len(str(a.residue.resid)) > 4
+                  or len(a.residue.resname) > 4 or len(a.residue.segname) > 4
+                  for a in atoms)
+        width = 10 if ext else 8
+        if ext:
+            atomline = "%10d %-8s %-8d %-8s %-8s %-6s %10.6f    %10.4f  %10d\n"
+        else:
+            atomline = "%8d %-4s %-4d %-4s %-4s %-4s %10.6f    %10.4f  %10d\n"
+
+        title = ["original generated structure x-plor psf file",
+                 "%d patches were applied to the molecule." % len(self.patches)]
+        title.extend("topology %s" % top for top in topologies)
+        title.extend("segment %s { first NONE; last NONE; auto %s }"
+                     % (segname, "angles dihedrals" if auto else "none")
+                     for segname, auto, _ in self.segments)
+        title.extend(self.patches)
+
+        with open('%s.psf' % psf_name, 'w') as fileh:
+            fileh.write("PSF%s CMAP\n\n" % (" EXT" if ext else ""))
+            fileh.write("%*d !NTITLE\n" % (width, len(title)))
+            fileh.write(''.join(" REMARKS %s\n" % line for line in title))
+            fileh.write("\n%*d !NATOM\n" % (width, len(atoms)))
+            fileh.write(''.join(atomline % (a.serial, a.residue.segname,
+                                            a.residue.resid, a.residue.resname,
+                                            a.name, a.type, a.charge,
+                                            self._get_mass(a.type), 0)
+                                for a in atoms))
+
+            for kind, header, perline in _SECTIONS:
+                fileh.write("\n%*d !%s\n" % (width, len(terms[kind]), header))
+                _write_indices(fileh, terms[kind], perline, width)
+
+            fileh.write("\n%*d !NDON: donors\n\n" % (width, 0))
+            fileh.write("\n%*d !NACC: acceptors\n\n" % (width, 0))
+            fileh.write("\n%*d !NNB\n\n" % (width, 0))
+            _write_indices(fileh, [(0,)]*len(atoms), 8, width)
+            fileh.write("\n%*d%*d !NGRP\n" % (width, 1, width, 0))
+            fileh.write("%*d%*d%*d\n" % (width, 0, width, 0, width, 0))
+            fileh.write("\n%*d !NCRTERM: cross-terms\n" % (width, len(terms['cmaps'])))
+            _write_indices(fileh, terms['cmaps'], 1, width)
+            fileh.write("\n")
+
+        # Atoms without coordinates are written at the origin, so they
+        # can be reported all at once
+        columns = dict(name=np.array([a.name for a in atoms], dtype=object),
+                       resname=np.array([a.residue.resname for a in atoms], dtype=object),
+                       chain=np.array([a.residue.inputs.get(a.name, (None, ' '))[1]
+                                       for a in atoms], dtype=object),
+                       resid=np.array([a.residue.resid for a in atoms], dtype=int),
+                       segname=np.array([a.residue.segname for a in atoms], dtype=object),
+                       element=np.array([a.residue.inputs.get(a.name, (None, None, ''))[2]
+                                         for a in atoms], dtype=object),
+                       coords=np.array([a.residue.inputs.get(a.name, ((0., 0., 0.),))[0]
+                                        for a in atoms], dtype=float).reshape(-1, 3))
+        write_pdb('%s.pdb' % psf_name, columns)
+        return missing
+
+    #=========================================================================
+    #                           Private methods                              #
+    #=========================================================================
+
+    def _get_definition(self, name, patch):
+        """
+        Parses a residue or patch definition into a list of commands,
+        caching the result
+
+        Args:
+          name (str): Residue or patch name
+          patch (bool): If a patch is wanted
+
+        Returns:
+          (list of tuple) keyword and arguments of each line. ATOM lines
+            have name, type and charge, DELETE lines the kind of item
+            and its atom names, and bonded terms their atom names.
+
+        Raises:
+          ValueError if the definition doesn't exist or uses unsupported
+            features
+        """
+        if (name, patch) in self._definitions:
+            return self._definitions[(name, patch)]
+
+        data = self.matcher.patches.get(name) if patch else \
+               self.matcher.residues.get(name)
+        if data is None:
+            raise ValueError("No %s definition for %s in the topologies"
+                             % ("patch" if patch else "residue", name))
+
+        commands = []
+        for line in data.splitlines():
+            tokens = [i.strip().upper() for i in line.split()]
+            if not tokens:
+                continue
+            keyword = tokens[0][:4]
+            if keyword == 'ATOM':
+                commands.append(('ATOM', (tokens[1], tokens[2], float(tokens[3]))))
+            elif keyword == 'DELE':
+                commands.append(('DELETE', (tokens[1][:4],) + tuple(tokens[2:])))
+            elif keyword in _TERMS:
+                size = _TERMS[keyword][1]
+                if (len(tokens)-1) % size:
+                    raise ValueError("Wrong number of atoms in %s terms\n"
+                                     "Line was:\n%s" % (tokens[0], line))
+                commands.append((keyword, tuple(tokens[1:])))
+            elif keyword == 'LONE':
+                raise ValueError("Lone pairs in %s can't be written without "
+                                 "psfgen" % name)
+        self._definitions[(name, patch)] = commands
+        return commands
+
+    #==========================================================================
+
+    def _add_terms(self, keyword, names, residues, current):
+        """
+        Adds the bonded terms on one definition line. Terms that refer to
+        atoms that don't exist, such as the next residue at the end of a
+        segment, are skipped as psfgen does.
+
+        Args:
+          keyword (str): Term keyword, abbreviated to 4 letters
+          names (tuple of str): Atom names in the terms
+          residues (list of _Residue): Segment residues, or patch targets
+          current (int): Position in residues of the residue being
+            defined, or None if applying a patch
+        """
+        kind, size = _TERMS[keyword]
+        for i in range(0, len(names), size):
+            if current is None:
+                atoms = [_patch_target(residues, n) for n in names[i:i+size]]
+                atoms = [res.atoms.get(name) for res, name in atoms]
+            else:
+                atoms = [_residue_atom(residues, current, n)
+                         for n in names[i:i+size]]
+            if all(atoms):
+                self._terms[kind].append(tuple(atoms))
+
+    #==========================================================================
+
+    def _delete(self, kind, atoms):
+        """
+        Deletes an atom or a bonded term as instructed by a patch
+
+        Args:
+          kind (str): Kind of item to delete, abbreviated to 4 letters
+          atoms (list of tuple): Residue and name of the atoms involved
+        """
+        if kind == 'ATOM':
+            for residue, name in atoms:
+                # Atoms in terms are removed when the psf is written
+                if name in residue.atoms:
+                    residue.atoms[name].deleted = True
+                    del residue.atoms[name]
+        elif kind in _TERMS:
+            target = [res.atoms.get(name) for res, name in atoms]
+            terms = self._terms[_TERMS[kind][0]]
+            terms[:] = [t for t in terms if list(t) != target and
+                        list(reversed(t)) != target]
+
+    #==========================================================================
+
+    def _get_terms(self):
+        """
+        Collects the bonded terms between remaining atoms, and generates
+        angles and dihedrals from the bonds in segments that want them.
+        Atoms must already be numbered.
+
+        Returns:
+          (dict str -> list of tuple) serial numbers of the atoms in each
+            bond, angle, dihedral, improper and cross-term
+        """
+        terms = {}
+        for kind in self._terms:
+            terms[kind] = [tuple(a.serial for a in term) for term in self._terms[kind]
+                           if not any(a.deleted for a in term)]
+
+        # Bonds are not directional and only listed once
+        terms['bonds'] = _unique(terms['bonds'], lambda t: (min(t), max(t)))
+
+        # Generate angles and dihedrals around atoms in auto segments
+        auto = set(a.serial for _, generate, residues in self.segments if generate
+                   for residue in residues for a in residue.atoms.values())
+        neighbors = {}
+        for i, j in terms['bonds']:
+            neighbors.setdefault(i, []).append(j)
+            neighbors.setdefault(j, []).append(i)
+
+        angles = list(terms['angles'])
+        dihedrals = list(terms['dihedrals'])
+        for center in sorted(auto & set(neighbors)):
+            bonded = sorted(neighbors[center])
+            angles.extend((bonded[i], center, bonded[k])
+                          for i in range(len(bonded))
+                          for k in range(i+1, len(bonded)))
+        for i, j in terms['bonds']:
+            if i not in auto and j not in auto:
+                continue
+            dihedrals.extend((k, i, j, l) for k in neighbors[i] if k != j
+                             for l in neighbors[j] if l != i and l != k)
+
+        terms['angles'] = _unique(angles, lambda t: min(t, t[::-1]))
+        terms['dihedrals'] = _unique(dihedrals, lambda t: min(t, t[::-1]))
+        return terms
+
+    #==========================================================================
+
+    def _get_mass(self, atomtype):
+        """
+        Returns:
+          (float) mass of an atom type
+
+        Raises:
+          ValueError if the type has no MASS line in the topologies
+        """
+        if atomtype not in self.matcher.masses:
+            raise ValueError("No mass defined for atom type %s" % atomtype)
+        return self.matcher.masses[atomtype]
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+class _Residue(object):
+    """
+    A residue being built
+
+    Attributes:
+      segname (str): Segment name
+      resid (int): Residue number
+      resname (str): Residue name
+      atoms (dict str -> _Atom): Atoms in the residue, in psf order
+      inputs (dict str -> tuple): Coordinates, chain and element of each
+        input atom, by name
+    """
+
+    def __init__(self, segname, resid, resname):
+        self.segname = segname
+        self.resid = resid
+        self.resname = resname
+        self.atoms = OrderedDict()
+        self.inputs = {}
+
+    def add_atom(self, name, atomtype, charge, after=None):
+        """
+        Adds an atom, or changes its type and charge if already present.
+        New atoms are added at the end, or after the atom named after.
+        """
+        if name in self.atoms:
+            self.atoms[name].type = atomtype
+            self.atoms[name].charge = charge
+        elif after not in self.atoms:
+            self.atoms[name] = _Atom(name, atomtype, charge, self)
+        else:
+            atoms = list(self.atoms.items())
+            position = [n for n, _ in atoms].index(after) + 1
+            atoms.insert(position, (name, _Atom(name, atomtype, charge, self)))
+            self.atoms = OrderedDict(atoms)
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+class _Atom(object): # pylint: disable=too-few-public-methods
+    """
+    An atom being built
+    """
+    __slots__ = ('name', 'type', 'charge', 'residue', 'serial', 'deleted')
+
+    def __init__(self, name, atomtype, charge, residue):
+        self.name = name
+        self.type = atomtype
+        self.charge = charge
+        self.residue = residue
+        self.serial = None
+        self.deleted = False
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                              MODULE FUNCTIONS                               #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def _residue_atom(residues, current, name):
+    """
+    Finds an atom named in a residue definition, where names starting
+    with + or - refer to the next or previous residue in the segment
+
+    Returns:
+      (_Atom) the atom, or None if it doesn't exist
+    """
+    if name[0] in "+-":
+        current += 1 if name[0] == "+" else -1
+        name = name[1:]
+        if current < 0 or current >= len(residues):
+            return None
+    return residues[current].atoms.get(name)
+
+#==========================================================================
+
+def _patch_target(residues, name):
+    """
+    Finds which patch target an atom name refers to. As in psfgen, a
+    leading digit is the position of the target, and other names refer
+    to the first target.
+
+    Returns:
+      (_Residue) the target residue
+      (str) the atom name within it
+    """
+    if name[0].isdigit() and int(name[0]) <= len(residues):
+        return residues[int(name[0])-1], name[1:]
+    return residues[0], name
+
+#==========================================================================
+
+def _unique(terms, key):
+    """
+    Returns:
+      (list of tuple) terms with duplicates removed, keeping the first
+        of any terms with the same key
+    """
+    seen = set()
+    unique = []
+    for term in terms:
+        if key(term) not in seen:
+            seen.add(key(term))
+            unique.append(term)
+    return unique
+
+#==========================================================================
+
+def _write_indices(fileh, terms, perline, width):
+    """
+    Writes a psf section of atom serial numbers, with a number of terms
+    on each line
+
+    Args:
+      fileh (file handle): File to write to
+      terms (list of tuple): Serial numbers of the atoms in each term
+      perline (int): Number of terms on each line
+      width (int): Field width of each number
+    """
+    for i in range(0, len(terms), perline):
+        fileh.write(''.join("%*d" % (width, n) for term in terms[i:i+perline]
+                            for n in term) + "\n")
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -0,0 +1,167 @@
+"""
+This module contains the PatchCache class, an on-disk cache of tiled
+and centered solvent patches. Builds that tile the same membrane or
+water box to the same number of copies can then load the result
+instead of tiling again. Only this first tiling step is cached; the
+water slabs added above and below a membrane are built in memory
+each time, as they are cheap compared to reading a cached file.
+
+Author: Robin Betz
+
+Copyright (C) 2015 Robin Betz
+
+This program is free software; you can redistribute it and/or modify it under
+the terms of the GNU Lesser General Public License as published by the Free
+Software Foundation; either version 2 of the License, or (at your option) any
+later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place - Suite 330
+Boston, MA 02111-1307, USA.
+"""
+
+from __future__ import print_function
+import hashlib
+import os
+import tempfile
+
+from Dabble.molbuffer import MoleculeBuffer
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                                   CLASSES                                   #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+class PatchCache(object):
+    """
+    Content addressed store of MoleculeBuffers saved as .npz files.
+    Files are named by a hash of the patch contents and how it was
+    tiled, and the least recently used files are deleted when the cache
+    grows past its maximum size.
+
+    Attributes:
+      directory (str): Directory holding cached patches
+      max_size (int): Maximum total size of cached files, in bytes
+    """
+
+    #==========================================================================
+
+    def __init__(self, directory, max_size=1024*1024*1024):
+        """
+        Args:
+          directory (str): Directory to hold cached patches, created if
+            it doesn't exist
+          max_size (int): Maximum total size of cached files, in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    #=========================================================================
+    #                            Public methods                              #
+    #=========================================================================
+
+    @staticmethod
+    def key(patch, times, center_z):
+        """
+        Computes the cache key for a tiled patch
+
+        Args:
+          patch (MoleculeBuffer): Untiled solvent patch
+          times (tuple of 3 ints): Number of times tiled in x, y, z
+          center_z (bool): Whether the patch is centered in z as well
+
+        Returns:
+          (str) cache key
+        """
+        digest = hashlib.sha1(patch.digest().encode('utf-8'))
+        digest.update(("%d %d %d %s" % (times[0], times[1], times[2],
+                                        bool(center_z))).encode('utf-8'))
+        return digest.hexdigest()
+
+    #==========================================================================
+
+    def get(self, key):
+        """
+        Loads a cached patch, marking it as recently used
+
+        Args:
+          key (str): Cache key
+
+        Returns:
+          (MoleculeBuffer) the cached patch, or None if not cached
+        """
+        filename = self._filename(key)
+        try:
+            patch = MoleculeBuffer.load(filename)
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError, KeyError):
+            # Missing, or evicted or truncated by another process
+            return None
+        return patch
+
+    #==========================================================================
+
+    def put(self, key, patch):
+        """
+        Saves a patch to the cache, then evicts old patches if the
+        cache is too large
+
+        Args:
+          key (str): Cache key
+          patch (MoleculeBuffer): Tiled and centered patch
+        """
+        # Write to a temporary file and rename so other processes never
+        # see a partial file
+        handle, temp = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+        os.close(handle)
+        patch.save(temp)
+        os.rename(temp, self._filename(key))
+        self._evict(keep=self._filename(key))
+
+    #=========================================================================
+    #                           Private methods                              #
+    #=========================================================================
+
+    def _filename(self, key):
+        return os.path.join(self.directory, "patch_%s.npz" % key)
+
+    #==========================================================================
+
+    def _evict(self, keep):
+        """
+        Deletes least recently used patches until the cache fits in its
+        maximum size. The most recently added patch is always kept.
+
+        Args:
+          keep (str): Filename never to delete
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not (name.startswith('patch_') and name.endswith('.npz')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
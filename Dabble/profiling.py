@@ -0,0 +1,189 @@
+"""
+This module contains the StageProfiler class, which records how long
+each stage of building and writing a system takes, how much memory it
+uses, and how many atoms are in the system before and after.
+
+Author: Robin Betz
+
+Copyright (C) 2015 Robin Betz
+
+This program is free software; you can redistribute it and/or modify it under
+the terms of the GNU Lesser General Public License as published by the Free
+Software Foundation; either version 2 of the License, or (at your option) any
+later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place - Suite 330
+Boston, MA 02111-1307, USA.
+"""
+
+from __future__ import print_function
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                                   CLASSES                                   #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+class StageProfiler(object):
+    """
+    Times named stages of a build. When disabled, stages are not
+    measured at all so there is no overhead.
+
+    Attributes:
+      enabled (bool): Whether stages are measured
+      pstats_dir (str): Directory to save cProfile statistics for each
+        stage in, or None to not run cProfile
+      stages (list of dict): Measurements of each completed stage, in
+        the order they finished
+    """
+
+    #==========================================================================
+
+    def __init__(self, enabled=False, pstats_dir=None):
+        self.enabled = enabled
+        self.pstats_dir = pstats_dir
+        self.stages = []
+        self._depth = 0
+        self._profilers = []
+
+    #=========================================================================
+    #                            Public methods                              #
+    #=========================================================================
+
+    @contextmanager
+    def stage(self, name, atoms=None):
+        """
+        Measures the code run inside a with block as one stage. Stages
+        may be nested, in which case the outer stage's times include
+        the inner ones but its cProfile statistics do not.
+
+        Args:
+          name (str): Name of the stage
+          atoms (callable): Function returning the current number of atoms
+            in the system, or None to not count atoms
+        """
+        if not self.enabled:
+            yield
+            return
+
+        record = {'stage': name,
+                  'depth': self._depth,
+                  'atoms_before': atoms() if atoms else None}
+        # Only one cProfile can run at once, so the enclosing stage's
+        # statistics are paused while a nested stage runs
+        profiler = None
+        if self.pstats_dir:
+            profiler = cProfile.Profile()
+            if self._profilers:
+                self._profilers[-1].disable()
+            self._profilers.append(profiler)
+        self._depth += 1
+        wall = time.time()
+        cpu = _cpu_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                self._profilers.pop()
+                if self._profilers:
+                    self._profilers[-1].enable()
+            record['wall_time'] = time.time() - wall
+            record['cpu_time'] = _cpu_time() - cpu
+            record['peak_rss_mb'] = _peak_rss_mb()
+            record['atoms_after'] = atoms() if atoms else None
+            self._depth -= 1
+
+            if profiler:
+                record['pstats'] = os.path.join(self.pstats_dir,
+                                                "%s_%d.pstats"
+                                                % (name, len(self.stages)))
+                profiler.dump_stats(record['pstats'])
+            self.stages.append(record)
+
+    #==========================================================================
+
+    def write(self, filename):
+        """
+        Writes the recorded stages as a JSON report
+
+        Args:
+          filename (str): File to write
+
+        Returns:
+          (str) filename written, or None if profiling is disabled
+        """
+        if not self.enabled:
+            return None
+
+        with open(filename, 'w') as fileh:
+            json.dump({'stages': self.stages,
+                       'command': sys.argv,
+                       'total_wall_time': sum(s['wall_time'] for s in
+                                              self.stages if not s['depth'])},
+                      fileh, indent=2)
+        return filename
+
+    #==========================================================================
+
+    def summary(self):
+        """
+        Returns:
+          (str) human readable table of stage times
+        """
+        lines = ["%-30s %10s %10s %10s" % ("Stage", "Wall (s)", "CPU (s)",
+                                           "RSS (MB)")]
+        for record in self.stages:
+            lines.append("%-30s %10.2f %10.2f %10s"
+                         % ("  "*record['depth'] + record['stage'],
+                            record['wall_time'], record['cpu_time'],
+                            "%.1f" % record['peak_rss_mb']
+                            if record['peak_rss_mb'] is not None else "-"))
+        return "\n".join(lines)
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                              MODULE FUNCTIONS                               #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def _cpu_time():
+    """
+    Returns:
+      (float) user plus system CPU time of this process, in seconds
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+#==========================================================================
+
+def _peak_rss_mb():
+    """
+    Returns:
+      (float) peak resident set size of this process in MB, or None if
+        it can't be determined on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X reports bytes
+    if sys.platform == 'darwin':
+        return peak / 1048576.
+    return peak / 1024.
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -0,0 +1,233 @@
+"""
+This module contains the RemovalMask class, which tracks which atoms of
+a system are still present while it is being built. Atoms are never
+actually deleted from the VMD molecule, only marked, so that indices
+stay the same throughout the build.
+
+Author: Robin Betz
+
+Copyright (C) 2015 Robin Betz
+
+This program is free software; you can redistribute it and/or modify it under
+the terms of the GNU Lesser General Public License as published by the Free
+Software Foundation; either version 2 of the License, or (at your option) any
+later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place - Suite 330
+Boston, MA 02111-1307, USA.
+"""
+
+from __future__ import print_function
+import numpy as np
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                                   CLASSES                                   #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+class RemovalMask(object):
+    """
+    Boolean mask of the atoms remaining in a system, with lookups from
+    atoms to their residue and fragment so whole residues or molecules
+    can be removed at once.
+
+    Attributes:
+      remaining (numpy array of N bools): Atoms still in the system
+      residues (numpy array of N ints): Residue each atom belongs to
+      fragments (numpy array of N ints): Fragment each atom belongs to
+    """
+
+    #==========================================================================
+
+    def __init__(self, residues, fragments, remaining=None):
+        """
+        Args:
+          residues (array of N ints): Residue number of each atom
+          fragments (array of N ints): Fragment number of each atom
+          remaining (array of N bools): Atoms initially present, or None
+            if all atoms are present
+        """
+        self.residues = np.asarray(residues, dtype=int)
+        self.fragments = np.asarray(fragments, dtype=int)
+        if remaining is None:
+            remaining = np.ones(len(self.residues), dtype=bool)
+        self.remaining = np.array(remaining, dtype=bool)
+
+    #==========================================================================
+
+    def __len__(self):
+        return len(self.remaining)
+
+    #=========================================================================
+    #                            Public methods                              #
+    #=========================================================================
+
+    def remove_atoms(self, atoms):
+        """
+        Marks atoms for removal
+
+        Args:
+          atoms (array of N bools): Atoms to remove
+
+        Returns:
+          (int) number of atoms removed that were still present
+        """
+        atoms = np.asarray(atoms, dtype=bool) & self.remaining
+        self.remaining[atoms] = False
+        return int(atoms.sum())
+
+    #==========================================================================
+
+    def remove_residues(self, atoms):
+        """
+        Marks every atom in residues containing a given atom for removal
+
+        Args:
+          atoms (array of N bools): Atoms whose residues should be removed
+
+        Returns:
+          (int) number of atoms removed that were still present
+        """
+        return self.remove_atoms(self.residue_mask(atoms))
+
+    #==========================================================================
+
+    def remove_fragments(self, atoms):
+        """
+        Marks every atom in fragments containing a given atom for removal
+
+        Args:
+          atoms (array of N bools): Atoms whose fragments should be removed
+
+        Returns:
+          (int) number of atoms removed that were still present
+        """
+        return self.remove_atoms(self.fragment_mask(atoms))
+
+    #==========================================================================
+
+    def residue_mask(self, atoms):
+        """
+        Expands a mask to cover whole residues
+
+        Args:
+          atoms (array of N bools): Atoms to expand
+
+        Returns:
+          (numpy array of N bools) atoms in residues containing a
+            selected atom
+        """
+        return group_mask(self.residues, atoms)
+
+    #==========================================================================
+
+    def fragment_mask(self, atoms):
+        """
+        Expands a mask to cover whole fragments
+
+        Args:
+          atoms (array of N bools): Atoms to expand
+
+        Returns:
+          (numpy array of N bools) atoms in fragments containing a
+            selected atom
+        """
+        return group_mask(self.fragments, atoms)
+
+    #==========================================================================
+
+    def count(self, atoms=None):
+        """
+        Counts remaining atoms
+
+        Args:
+          atoms (array of N bools): Atoms to count, or None for all atoms
+
+        Returns:
+          (int) number of the atoms that are still present
+        """
+        if atoms is None:
+            return int(self.remaining.sum())
+        return int(np.count_nonzero(self.remaining &
+                                    np.asarray(atoms, dtype=bool)))
+
+    #==========================================================================
+
+    def count_residues(self, atoms=None):
+        """
+        Counts residues with remaining atoms
+
+        Args:
+          atoms (array of N bools): Atoms to consider, or None for all
+
+        Returns:
+          (int) number of residues with a selected atom still present
+        """
+        return _count_unique(self.residues, self._present(atoms))
+
+    #==========================================================================
+
+    def count_fragments(self, atoms=None):
+        """
+        Counts fragments with remaining atoms
+
+        Args:
+          atoms (array of N bools): Atoms to consider, or None for all
+
+        Returns:
+          (int) number of fragments with a selected atom still present
+        """
+        return _count_unique(self.fragments, self._present(atoms))
+
+    #=========================================================================
+    #                           Private methods                              #
+    #=========================================================================
+
+    def _present(self, atoms):
+        """
+        Returns:
+          (numpy array of N bools) atoms that are selected and remaining
+        """
+        if atoms is None:
+            return self.remaining
+        return self.remaining & np.asarray(atoms, dtype=bool)
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#                              MODULE FUNCTIONS                               #
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def group_mask(groups, atoms):
+    """
+    Selects every atom sharing a group, such as a residue or fragment,
+    with a selected atom
+
+    Args:
+      groups (numpy array of N ints): Group number of each atom
+      atoms (array of N bools): Selected atoms
+
+    Returns:
+      (numpy array of N bools) atoms in selected groups
+    """
+    if not len(groups):
+        return np.zeros(0, dtype=bool)
+    flagged = np.zeros(groups.max() + 1, dtype=bool)
+    flagged[groups[np.asarray(atoms, dtype=bool)]] = True
+    return flagged[groups]
+
+#==========================================================================
+
+def _count_unique(groups, atoms):
+    """
+    Counts how many distinct groups have a selected atom
+    """
+    if not len(groups):
+        return 0
+    return int(np.count_nonzero(np.bincount(groups[atoms],
+                                            minlength=groups.max() + 1)))
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
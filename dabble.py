@@ -130,15 +130,24 @@ parser = argparse.ArgumentParser(prog='dabble')
 group = parser.add_argument_group('Input and Output Files')
 group.add_argument('-i', '--input', dest='solute_filename',
                    metavar='<input>', type=str,
-                   required=True,
                    help='Path to input protein or ligand file to build into '
                    'the system')
 group.add_argument('-o', '--output', dest='output_filename',
                    metavar='<output>', type=str,
-                   required=True,
                    help='Name of output file, format will be inferred by '
                    'extension. Currently supported: pdb, mae, psf (charmm), '
                    'prmtop (amber or charmm)')
+group.add_argument('-b', '--batch', dest='batch', metavar='<manifest>',
+                   type=str, default=None,
+                   help='Build every system listed in a csv or json manifest '
+                   'instead of a single input. Each system needs an input '
+                   'and output, and may override any other option by its '
+                   'long name with dashes as underscores, e.g. '
+                   'solute_filename, output_filename, salt_conc')
+group.add_argument('-j', '--jobs', dest='jobs', metavar='<jobs>',
+                   type=int, default=None,
+                   help='With --batch, number of systems to build at once '
+                   '[default: number of CPUs]')
 group.add_argument('-M', '--membrane-system', dest='membrane_system',
                    type=str, metavar='<solvent>',
                    default="DEFAULT",
@@ -158,6 +167,14 @@ group.add_argument('-ff', '--forcefield', dest='forcefield',
 group.add_argument('--hmr', dest='hmassrepartition', default=False,
                    action='store_true', help='Repartition Hydrogen masses'
                    'to allow up to 4fs time steps. Currently prmtop output only')
+group.add_argument('--native-psf', dest='native_psf', default=False,
+                   action='store_true', help='Build psf files directly '
+                   'from the topologies instead of with psfgen. Currently '
+                   'psf output only')
+group.add_argument('--match-jobs', dest='match_processes', default=1,
+                   type=int, metavar='<jobs>', help='Number of processes '
+                   'to match protein and ligand residues to the topologies '
+                   'with. Currently psf output only')
 group.add_argument('-top', '--topology', default=None, action='append',
                     type=str, metavar='<topologies>', dest='extra_topos',
                     help='Additional topology (rtf, off, lib) file to '
@@ -246,12 +263,41 @@ group.add_argument('--membrane-rotation', dest='z_rotation',
 
 group = parser.add_argument_group('Debug and Testing Options')
 group.add_argument('--tmp-dir', dest='tmp_dir', default=None)
+group.add_argument('--checkpoint', dest='checkpoint', default=False,
+                   action='store_true', help='Save a snapshot of the system '
+                   'after each build stage in --tmp-dir, so the build can be '
+                   'resumed later [default: no snapshots]')
+group.add_argument('--resume', dest='resume', default=False,
+                   action='store_true', help='Resume a build from the '
+                   'checkpoints saved in --tmp-dir, redoing only the stages '
+                   'whose inputs have changed. Implies --checkpoint')
+group.add_argument('--patch-cache', dest='patch_cache', default=None,
+                   type=str, help='Directory to cache the tiled membrane or '
+                   'water box in, so builds with the same membrane and box '
+                   'size can reuse it. Extra water layers are not cached '
+                   '[default: no cache]')
+group.add_argument('--patch-cache-size', dest='patch_cache_size',
+                   default=1024, type=int, help='Maximum size of the patch '
+                   'cache in MB, least recently used patches are deleted '
+                   'first [default: 1024]')
 group.add_argument('--verbose', dest='debug_verbose', default=False,
                    action='store_true')
+group.add_argument('--profile', dest='profile', default=False,
+                   action='store_true', help='Record the time, CPU time, '
+                   'memory and atom count of each build stage in a json '
+                   'report next to the output file')
+group.add_argument('--pstats', dest='pstats', default=False,
+                   action='store_true', help='With --profile, also save '
+                   'cProfile statistics for each stage to the temporary '
+                   'directory')
 
 print(WELCOME_SCREEN)
 print("\nCommand was:\n  %s\n" % " ".join([i for i in sys.argv]))
 opts = parser.parse_args(sys.argv[1:])
+if not opts.batch and not (opts.solute_filename and opts.output_filename):
+    parser.error("an input and output file are required, unless using --batch")
+if opts.resume and not opts.tmp_dir:
+    parser.error("--resume requires the --tmp-dir of the build to resume")
 
 # Make the temporary directory. Needs to be done now so there is somewhere
 # to save the vmd output
@@ -264,8 +310,22 @@ else:                  soutput = os.path.join(opts.tmp_dir, "vmd_output.txt")
 with VmdSilencer(output=soutput):
 
     signal.signal(signal.SIGINT, signal_handler)
-    from Dabble import DabbleBuilder
-    builder = DabbleBuilder(**vars(opts)) # pylint: disable=star-args
-    builder.write()
+    if opts.batch:
+        from Dabble import batch
+        systems = batch.read_manifest(opts.batch,
+                                      types=batch.option_types(parser))
+        defaults = dict((k, v) for k, v in vars(opts).items()
+                        if k not in ('batch', 'jobs', 'tmp_dir'))
+        results = batch.build_batch(systems, defaults, opts.tmp_dir,
+                                    processes=opts.jobs)
+        failed = [output for output, error in results if error is not None]
+        if failed:
+            print("\n%d of %d systems failed: %s" % (len(failed), len(results),
+                                                     ", ".join(failed)))
+            sys.exit(1)
+    else:
+        from Dabble import DabbleBuilder
+        builder = DabbleBuilder(**vars(opts)) # pylint: disable=star-args
+        builder.write()
     print("\nSuccess!")
 
@@ -0,0 +1,64 @@
+# Tests reading batch build manifests
+import pytest
+import os
+import json
+
+#==============================================================================
+
+def test_read_manifest(tmpdir):
+    """
+    Tests csv and json manifests give the same systems
+    """
+    from Dabble import batch
+
+    p = tmpdir.mkdir("manifest")
+    p.join("systems.csv").write("solute_filename,output_filename,salt_conc,hmassrepartition\n"
+                                "lig1.mae,lig1.prmtop,0.1,\n"
+                                "lig2.mae,lig2.prmtop,,true\n")
+    p.join("systems.json").write(json.dumps([
+        {"solute_filename": "lig1.mae", "output_filename": "lig1.prmtop",
+         "salt_conc": 0.1},
+        {"solute_filename": "lig2.mae", "output_filename": "lig2.prmtop",
+         "hmassrepartition": True}]))
+
+    types = {'salt_conc': float, 'hmassrepartition': batch._parse_bool}
+    from_csv = batch.read_manifest(str(p.join("systems.csv")), types=types)
+    from_json = batch.read_manifest(str(p.join("systems.json")))
+    assert from_csv == from_json
+
+#==============================================================================
+
+def test_manifest_missing_output(tmpdir):
+    """
+    Tests systems without an output file are rejected
+    """
+    from Dabble import batch
+
+    p = tmpdir.mkdir("manifest")
+    p.join("systems.csv").write("solute_filename,salt_conc\n"
+                                "lig1.mae,0.1\n")
+    with pytest.raises(ValueError):
+        batch.read_manifest(str(p.join("systems.csv")))
+
+#==============================================================================
+
+def test_cache_matchers(tmpdir, monkeypatch):
+    """
+    Tests topologies are parsed once for all builds that need them
+    """
+    from Dabble import batch
+
+    p = str(tmpdir.mkdir("matcher_cache"))
+    monkeypatch.setenv("DABBLE_CACHE_DIR", p)
+    batch._cache_matchers([{'solute_filename': "lig1.mae",
+                            'output_filename': "lig1.psf"},
+                           {'solute_filename': "lig2.mae",
+                            'output_filename': "lig2.psf",
+                            'forcefield': "charmm"},
+                           {'solute_filename': "lig3.mae",
+                            'output_filename': "lig3.mae"}])
+    cached = os.listdir(p)
+    assert len(cached) == 1
+    assert cached[0].startswith("charmmmatcher_")
+
+#==============================================================================
@@ -0,0 +1,129 @@
+# Tests saving and resuming build checkpoints
+import pytest
+import os
+
+dir = os.path.dirname(__file__) + "/"
+
+#==============================================================================
+
+def _opts(p, **kwargs):
+    """
+    Builder options with small input files that can be changed
+    """
+    solute = os.path.join(p, "solute.pdb")
+    if not os.path.isfile(solute):
+        with open(solute, 'w') as fileh:
+            fileh.write("END\n")
+    opts = {'solute_filename': solute,
+            'membrane_system': None,
+            'lipid_sel': "lipid",
+            'xy_buf': 17.5,
+            'wat_buffer': 20.0,
+            'salt_conc': 0.150,
+            'cation': "Na"}
+    opts.update(kwargs)
+    return opts
+
+#==============================================================================
+
+def test_keys_invalidated(tmpdir):
+    """
+    Tests changing an input changes the key of its stage and all later ones
+    """
+    from Dabble.checkpoint import Checkpointer, STAGES
+
+    p = str(tmpdir.mkdir("keys"))
+    keys = Checkpointer(p, _opts(p)).keys
+    assert len(set(keys.values())) == len(STAGES)
+    assert Checkpointer(p, _opts(p)).keys == keys
+
+    # An option of a middle stage leaves earlier stages valid
+    changed = Checkpointer(p, _opts(p, xy_buf=10.0)).keys
+    assert changed['oriented'] == keys['oriented']
+    assert all(changed[s] != keys[s] for s in STAGES[1:])
+
+    # So does one of the last stage
+    changed = Checkpointer(p, _opts(p, cation="K")).keys
+    assert all(changed[s] == keys[s] for s in STAGES[:-1])
+    assert changed['ionized'] != keys['ionized']
+
+    # Input file contents are hashed, not just the file name
+    with open(os.path.join(p, "solute.pdb"), 'w') as fileh:
+        fileh.write("REMARK changed\nEND\n")
+    changed = Checkpointer(p, _opts(p)).keys
+    assert all(changed[s] != keys[s] for s in STAGES)
+
+#==============================================================================
+
+def test_latest(tmpdir):
+    """
+    Tests finding the last checkpoint whose inputs are unchanged
+    """
+    from Dabble.checkpoint import Checkpointer
+
+    p = str(tmpdir.mkdir("latest"))
+    saver = Checkpointer(os.path.join(p, "checkpoints"), _opts(p))
+    saver.save('oriented', {}, state={'size': [1, 2, 3]})
+    saver.save('tiled', {}, state={'size': [4, 5, 6]})
+    saver.save('combined', {}, state={'size': [4, 5, 6]})
+
+    # Only loaded when resuming
+    assert saver.latest() is None
+    resumer = Checkpointer(os.path.join(p, "checkpoints"), _opts(p),
+                           resume=True)
+    assert resumer.latest() == 'combined'
+    assert resumer.load('tiled') == ({}, {'size': [4, 5, 6]})
+    with pytest.raises(ValueError):
+        resumer.load('trimmed')
+
+    # Changing a tiling option leaves only the oriented system valid
+    resumer = Checkpointer(os.path.join(p, "checkpoints"),
+                           _opts(p, wat_buffer=10.0), resume=True)
+    assert resumer.latest() == 'oriented'
+
+    # Changing the solute leaves nothing valid
+    with open(os.path.join(p, "solute.pdb"), 'w') as fileh:
+        fileh.write("REMARK changed\nEND\n")
+    resumer = Checkpointer(os.path.join(p, "checkpoints"), _opts(p),
+                           resume=True)
+    assert resumer.latest() is None
+
+#==============================================================================
+
+def test_save_load(tmpdir):
+    """
+    Tests molecules are restored from a checkpoint
+    """
+    from Dabble.checkpoint import Checkpointer
+    import vmd, molecule
+    from atomsel import atomsel
+
+    p = str(tmpdir.mkdir("save_load"))
+    water = molecule.load("mae", dir + "../../Dabble/lipid_membranes/tip3pbox.mae")
+    atomsel("residue < 10", molid=water).set("beta", 1.0)
+    saver = Checkpointer(os.path.join(p, "checkpoints"), _opts(p))
+    saver.save('combined', {'membrane': water, 'combined': water},
+               state={'water_only': True})
+    assert len(os.listdir(os.path.join(p, "checkpoints"))) == 2
+
+    resumer = Checkpointer(os.path.join(p, "checkpoints"), _opts(p),
+                           resume=True)
+    assert resumer.latest() == 'combined'
+    molids, state = resumer.load('combined')
+    assert state == {'water_only': True}
+    assert molids['membrane'] == molids['combined']
+    assert molids['combined'] != water
+
+    loaded = molids['combined']
+    assert molecule.numatoms(loaded) == molecule.numatoms(water)
+    assert atomsel("all", molid=loaded).get("beta") == \
+            atomsel("all", molid=water).get("beta")
+    assert atomsel("all", molid=loaded).get("x") == \
+            pytest.approx(atomsel("all", molid=water).get("x"))
+    assert molecule.get_periodic(loaded) == molecule.get_periodic(water)
+
+    molecule.delete(loaded)
+    molecule.delete(water)
+
+#==============================================================================
+
@@ -0,0 +1,65 @@
+# Tests the periodic clash detector
+import pytest
+import numpy as np
+
+#==============================================================================
+
+def _brute_force(coords, box, query, target, dist):
+    """
+    Minimum image distance check between every pair of atoms
+    """
+    result = np.zeros(len(coords), dtype=bool)
+    for i in np.flatnonzero(query):
+        delta = coords[target] - coords[i]
+        delta -= box * np.round(delta / box)
+        result[i] = np.any(np.sum(delta**2, axis=1) <= dist**2)
+    return result
+
+#==============================================================================
+
+def test_atoms_near():
+    """
+    Tests the cell list matches a brute force periodic search
+    """
+    from Dabble.clashes import ClashDetector
+
+    rng = np.random.RandomState(2015)
+    box = np.array([30., 25., 40.])
+    coords = rng.rand(3000, 3) * box - box/2.
+    residues = np.arange(3000) // 5
+    query = rng.rand(3000) > 0.5
+
+    detector = ClashDetector(coords, residues, box, cutoff=1.75)
+    for dist in [1.0, 1.75]:
+        assert np.all(detector.atoms_near(query, ~query, dist) ==
+                      _brute_force(coords, box, query, ~query, dist))
+
+    with pytest.raises(ValueError):
+        detector.atoms_near(query, ~query, 2.0)
+
+#==============================================================================
+
+def test_residues_near():
+    """
+    Tests clashes across the periodic boundary remove whole residues,
+    and that hydrogens are ignored
+    """
+    from Dabble.clashes import ClashDetector
+
+    coords = np.array([[-9.8, 0., 0.], [-9.0, 0., 0.],
+                       [9.5, 0., 0.], [5.0, 0., 0.],
+                       [0., 0., 0.], [0., 1., 0.]])
+    residues = [0, 0, 1, 1, 2, 3]
+    heavy = np.array([True, True, True, True, True, False])
+    detector = ClashDetector(coords, residues, [20., 20., 20.],
+                             heavy=heavy)
+
+    query = np.array([True, True, False, False, False, True])
+    target = np.array([False, False, True, True, True, False])
+    assert list(detector.residues_near(query, target, 1.0)) == \
+            [True, True, False, False, False, False]
+    assert list(detector.residues_near(target, query, 1.0)) == \
+            [False, False, True, True, False, False]
+
+#==============================================================================
+
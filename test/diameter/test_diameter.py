@@ -0,0 +1,36 @@
+# Tests exact diameter calculations
+import pytest
+import numpy as np
+
+#==============================================================================
+
+def _brute_force(coords):
+    """
+    Largest distance between any two points
+    """
+    delta = coords[:, None, :] - coords[None, :, :]
+    return np.sqrt(np.max(np.sum(delta**2, axis=2)))
+
+#==============================================================================
+
+def test_diameter():
+    """
+    Tests the convex hull diameter matches comparing all pairs
+    """
+    from Dabble import molutils
+
+    rng = np.random.RandomState(2015)
+    for npoints in [1, 2, 3, 10, 500]:
+        coords = rng.randn(npoints, 2) * [20., 5.]
+        assert abs(molutils.diameter(coords) - _brute_force(coords)) < 1e-6
+
+        # Integer grids have duplicate and collinear points
+        coords = np.round(coords)
+        assert abs(molutils.diameter(coords) - _brute_force(coords)) < 1e-6
+
+    line = np.array([[0., 0.], [1., 1.], [2., 2.], [3., 3.]])
+    assert abs(molutils.diameter(line) - np.sqrt(18.)) < 1e-6
+    assert len(molutils.convex_hull_2d(line)) == 2
+
+#==============================================================================
+
@@ -56,6 +56,19 @@ def test_patches():
     assert(patch == "PSEP")
     assert(mdict=={5: '-C', 16: 'N', 17: 'CA', 18: 'CB', 19: 'OG', 20: 'C', 21: 'O', 22: 'P', 23: 'O1P', 24: 'O2P', 25: 'OT', 26: 'HN', 27: 'HA', 28: 'HB1', 29: 'HB2', 30: '+N'})
 
+def test_lazy_patches():
+    import vmd, molecule
+    from atomsel import atomsel
+    from Dabble.param import CharmmMatcher
+
+    molid = molecule.load("mae", dir+"phosphoserine.mae")
+    g = CharmmMatcher([dir+"phosphoserine.str"])
+    assert(not g.known_pres)
+    (name, patch, mdict) = g.get_patches(atomsel("resname SEP"))
+    assert(patch == "PSEP")
+    assert(g.known_pres[("SER", "PSEP")] is not None)
+    assert(all(k[0] == "SER" for k in g.known_pres))
+
 def test_protein(tmpdir):
     import vmd, molecule
     import networkx as nx
@@ -0,0 +1,59 @@
+# Tests and benchmarks module import times
+from __future__ import print_function
+import pytest
+import subprocess
+import sys
+
+# Modules only needed to write parameterized output formats
+PARAM_MODULES = ["Dabble.param", "parmed", "networkx"]
+
+# Modules to time, in the order they are usually loaded
+TIMED_MODULES = ["vmd", "numpy", "Dabble.molbuffer", "Dabble.fileutils",
+                 "Dabble.builder", "Dabble", "networkx", "parmed",
+                 "Dabble.param"]
+
+#==============================================================================
+
+def _run(code):
+    """
+    Runs python code in a fresh interpreter, so nothing is already imported
+    """
+    return subprocess.check_output([sys.executable, "-c", code]).decode()
+
+#==============================================================================
+
+def _import_time(module, repeats=3):
+    """
+    Best wall time to import a module into a fresh interpreter, in seconds
+    """
+    code = ("import time\n"
+            "start = time.time()\n"
+            "import %s\n"
+            "print(time.time() - start)\n" % module)
+    return min(float(_run(code).split()[-1]) for _ in range(repeats))
+
+#==============================================================================
+
+def test_lazy_param_imports():
+    """
+    Tests the parameterization stack isn't loaded just by importing Dabble
+    """
+    loaded = _run("import sys, Dabble\n"
+                  "print(' '.join(sys.modules))\n").split()
+    assert not [m for m in PARAM_MODULES if m in loaded]
+
+#==============================================================================
+
+def test_import_times():
+    """
+    Benchmarks the time taken to import each module. Run with -s to see
+    the times. Importing Dabble should cost much less than loading the
+    parameterization stack too.
+    """
+    times = dict((m, _import_time(m)) for m in TIMED_MODULES)
+    for module in TIMED_MODULES:
+        print("%-20s %8.1f ms" % (module, 1000*times[module]))
+    assert times["Dabble"] < times["Dabble.param"]
+
+#==============================================================================
+
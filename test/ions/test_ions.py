@@ -0,0 +1,94 @@
+# Tests placing salt ions in place of water molecules
+import pytest
+import os
+import numpy as np
+
+dir = os.path.dirname(__file__) + "/"
+
+#==============================================================================
+
+def _waters(nwaters, box, seed=2015):
+    """
+    Random water molecules as oxygen, hydrogen, hydrogen atoms
+    """
+    rng = np.random.RandomState(seed)
+    oxygens = rng.rand(nwaters, 3) * box
+    coords = np.repeat(oxygens, 3, axis=0)
+    coords[1::3, 0] += 0.96
+    coords[2::3, 1] += 0.96
+    residues = np.repeat(np.arange(nwaters), 3)
+    hydrogens = np.tile([False, True, True], nwaters)
+    return coords, residues, hydrogens
+
+#==============================================================================
+
+def test_place_ions():
+    """
+    Tests ions keep their minimum distance from each other
+    """
+    from Dabble import builder
+    from Dabble.clashes import ClashDetector
+
+    box = np.array([40., 40., 40.])
+    coords, residues, hydrogens = _waters(2000, box)
+    detector = ClashDetector(coords=coords, residues=residues, box=box,
+                             cutoff=5.0)
+
+    placed = builder._place_ions(detector, ~hydrogens, 30, 5.0)
+    assert len(set(placed)) == 30
+    assert not np.any(hydrogens[placed])
+    for i in placed:
+        delta = coords[placed] - coords[i]
+        delta -= box * np.round(delta / box)
+        dist = np.sqrt(np.sum(delta**2, axis=1))
+        assert np.all((dist >= 5.0) | (placed == i))
+
+    with pytest.raises(ValueError):
+        builder._place_ions(detector, ~hydrogens, 100000, 5.0)
+
+#==============================================================================
+
+def test_remove_ion_hydrogens():
+    """
+    Tests the hydrogens of each converted water are removed, and
+    nothing else
+    """
+    from Dabble import builder
+    from Dabble.removal import RemovalMask
+
+    coords, residues, hydrogens = _waters(100, np.array([20., 20., 20.]))
+    removal = RemovalMask(residues=residues, fragments=residues)
+    placed = np.array([0, 30, 150])
+
+    assert builder._remove_ion_hydrogens(removal, placed, hydrogens) == 6
+    converted = np.isin(residues, residues[placed])
+    assert not np.any(removal.remaining[converted & hydrogens])
+    assert np.all(removal.remaining[placed])
+    assert np.all(removal.remaining[~converted])
+
+#==============================================================================
+
+def test_add_salt_ions():
+    """
+    Tests converting waters to ions in a water box
+    """
+    from Dabble import builder
+    import vmd, molecule
+    from atomsel import atomsel
+
+    water = molecule.load("mae", dir + "../../Dabble/lipid_membranes/tip3pbox.mae")
+    atomsel("all", molid=water).set("beta", 1)
+    natoms = molecule.numatoms(water)
+
+    placed = builder.add_salt_ions(["Na", "Na", "Cl"], water)
+    assert len(placed) == 3
+    ions = atomsel("index %s" % " ".join(str(i) for i in placed), molid=water)
+    assert sorted(ions.get("resname")) == ["CLA", "SOD", "SOD"]
+    assert len(atomsel("beta 1", molid=water)) == natoms - 6
+    assert len(atomsel("beta 1 and element H and same residue as index %s"
+                       % " ".join(str(i) for i in placed), molid=water)) == 0
+
+    molecule.delete(water)
+
+#==============================================================================
+
@@ -0,0 +1,43 @@
+# Tests counting the lipids in each membrane leaflet from atom arrays
+import pytest
+import numpy as np
+
+#==============================================================================
+
+def test_count_leaflet_lipids():
+    """
+    Tests counts on a mixed membrane match counting fragments one leaflet
+    and resname at a time
+    """
+    from Dabble import molutils
+
+    # Lipids of several kinds, with a few straddling z=0 and a couple of
+    # fragments holding two resnames
+    rng = np.random.RandomState(2015)
+    kinds = np.array(["POPC", "POPE", "POPS", "CHL1"])
+    lipid = rng.randint(0, 4, size=200)
+    fragments = np.repeat(np.arange(200), 6)
+    resnames = np.repeat(kinds[lipid], 6).astype(object)
+    resnames[fragments == 7] = "POPG"
+    resnames[(fragments == 8) & (np.arange(1200) % 6 == 0)] = "POPG"
+    z = np.repeat(rng.choice([-20., 20.], size=200), 6) + \
+        rng.randn(1200) * [15. if f % 10 == 0 else 1. for f in fragments]
+
+    assert set(fragments[z < 0]) & set(fragments[z >= 0])
+
+    inner, outer = molutils.count_leaflet_lipids(resnames, fragments, z)
+
+    # Previous count, with a set of fragments per leaflet and resname
+    def leaflet(atoms):
+        return dict((s, len(set(fragments[atoms & (resnames == s)])))
+                    for s in set(resnames[atoms]))
+    assert inner == leaflet(z < 0)
+    assert outer == leaflet(~(z < 0))
+    assert sorted(set(inner) | set(outer)) == \
+            ["CHL1", "POPC", "POPE", "POPG", "POPS"]
+
+    # Nothing left
+    assert molutils.count_leaflet_lipids([], [], []) == ({}, {})
+
+#==============================================================================
+
@@ -0,0 +1,236 @@
+# Tests in-memory molecule assembly
+import pytest
+import os
+
+dir = os.path.dirname(__file__) + "/"
+
+#==============================================================================
+
+def _buffer(coords, bonds=None, bond_orders=None):
+    """
+    A buffer of unnamed atoms, with resids counting up from 1
+    """
+    import numpy as np
+    from Dabble.molbuffer import MoleculeBuffer, _FIELDS
+
+    fields = dict((field, np.zeros(len(coords), dtype=dtype))
+                  for field, dtype in _FIELDS)
+    fields['resid'] = np.arange(1, len(coords)+1)
+    fields['name'] = np.array(["A%d" % i for i in range(len(coords))],
+                              dtype=object)
+    return MoleculeBuffer(fields=fields, coords=coords, bonds=bonds,
+                          bond_orders=bond_orders, box=[10., 20., 30.])
+
+#==============================================================================
+
+def test_tile_and_combine():
+    """
+    Tests tiling and combining molecules without intermediate files
+    """
+    from Dabble import molutils
+    import vmd, molecule
+    from atomsel import atomsel
+
+    solute = molecule.load("mae", dir + "../rho_c_tail/rho_test.mae")
+    water = molecule.load("mae", dir + "../../Dabble/lipid_membranes/tip3pbox.mae")
+    nwat = molecule.numatoms(water)
+    nwatres = len(set(atomsel("all", molid=water).get("residue")))
+
+    tiled = molutils.tile_system(water, 2, 1, 1)
+    assert molecule.numatoms(tiled) == 2*nwat
+    assert len(set(atomsel("all", molid=tiled).get("residue"))) == 2*nwatres
+    assert sum(len(b) for b in atomsel("all", molid=tiled).bonds) == \
+            2*sum(len(b) for b in atomsel("all", molid=water).bonds)
+    assert set(atomsel("all", molid=tiled).get("user")) == set([2.0])
+
+    assert molutils.center_system(tiled, center_z=True) == tiled
+    center = atomsel("all", molid=tiled).center()
+    assert all(abs(c) < 1e-3 for c in center)
+
+    nsolute = molecule.numatoms(solute)
+    combined = molutils.combine_molecules([solute, tiled])
+    assert molecule.numatoms(combined) == nsolute + 2*nwat
+    assert len(atomsel("beta 1", molid=combined)) == nsolute + 2*nwat
+    assert solute not in molecule.listall()
+    assert tiled not in molecule.listall()
+
+    molecule.delete(combined)
+    molecule.delete(water)
+
+#==============================================================================
+
+def test_write_ct_blocks(tmpdir):
+    """
+    Tests writing one CT block per user value straight from the atoms
+    """
+    from Dabble import fileutils
+    import vmd, molecule
+    from atomsel import atomsel
+
+    p = str(tmpdir.mkdir("ct_blocks"))
+    water = molecule.load("mae", dir + "../../Dabble/lipid_membranes/tip3pbox.mae")
+    nwat = molecule.numatoms(water)
+    atomsel("all", molid=water).set("beta", 1.0)
+    atomsel("all", molid=water).set("user", 1.0)
+    atomsel("residue < 10", molid=water).set("user", 2.0)
+
+    assert fileutils.write_ct_blocks(water, "beta 1", p + "/ct.mae") == 2
+    with open(p + "/ct.mae") as fileh:
+        assert fileh.read().count("f_m_ct {") == 2
+
+    written = molecule.load("mae", p + "/ct.mae")
+    assert molecule.numatoms(written) == nwat
+    assert sum(len(b) for b in atomsel("all", molid=written).bonds) == \
+            sum(len(b) for b in atomsel("all", molid=water).bonds)
+    assert sorted(atomsel("all", molid=written).get("resname")) == \
+            sorted(atomsel("all", molid=water).get("resname"))
+
+    molecule.delete(written)
+    molecule.delete(water)
+
+#==============================================================================
+
+def test_solvent_slab():
+    """
+    Tests filling a slab with water leaves whole waters inside it
+    """
+    from Dabble import molutils
+    import numpy as np
+    import vmd, molecule
+
+    water = molecule.load("mae", dir + "../../Dabble/lipid_membranes/tip3pbox.mae")
+    slab, residues = molutils.solvent_slab(water, 60., 50., 10., 35.)
+    heavy = slab.fields['atomicnumber'] != 1
+    assert slab.coords[heavy, 2].min() >= 10.
+    assert slab.coords[heavy, 2].max() <= 35.
+    assert len(residues) == len(slab)
+    assert len(np.unique(residues)) == len(slab) // 3
+    assert np.all(np.abs(slab.coords[:, :2].mean(axis=0)) < 5.)
+
+    below, _ = molutils.solvent_slab(water, 60., 50., -35., -10.,
+                                     anchor_top=True)
+    assert abs(below.coords[:, 2].max() + 10.) < 1.
+    molecule.delete(water)
+
+#==============================================================================
+
+def test_adjacency():
+    """
+    Tests bonds are listed per atom the same way one at a time adding does
+    """
+    import numpy as np
+
+    rng = np.random.RandomState(2015)
+    natoms = 50
+    bonds = set()
+    while len(bonds) < 80:
+        i, j = sorted(rng.randint(0, natoms, 2))
+        if i != j:
+            bonds.add((i, j))
+    bonds = sorted(bonds, key=lambda b: rng.rand())
+    orders = rng.randint(1, 4, len(bonds)).astype(float)
+    buf = _buffer(np.zeros((natoms, 3)), bonds, orders)
+
+    # Adding each bond in turn, then sorting neighbors
+    expected = [dict() for _ in range(natoms)]
+    for (i, j), order in zip(bonds, orders):
+        expected[i][j] = order
+        expected[j][i] = order
+
+    neighbors, bondorders = buf._adjacency()
+    assert len(neighbors) == len(bondorders) == natoms
+    assert neighbors == [sorted(e) for e in expected]
+    assert bondorders == [[e[k] for k in sorted(e)] for e in expected]
+
+#==============================================================================
+
+def test_tile_matches_loop():
+    """
+    Tests tiling in one pass orders atoms and numbers resids the same
+    way as copying the patch once per tile
+    """
+    import numpy as np
+    from Dabble.molbuffer import MoleculeBuffer
+
+    rng = np.random.RandomState(2015)
+    patch = _buffer(rng.rand(12, 3) * [10., 20., 30.],
+                    bonds=[[0, 1], [0, 2], [3, 4], [6, 11]],
+                    bond_orders=[1., 2., 1., 3.])
+    times = (3, 2, 2)
+    spacing = (10., 20., 30.)
+    step = patch.fields['resid'].max()
+
+    # Previous nested loop, with z varying fastest
+    tiles = []
+    new_resid = patch.fields['resid'].copy()
+    for nx in range(times[0]):
+        for ny in range(times[1]):
+            for nz in range(times[2]):
+                tile = patch.copy()
+                tile.moveby((nx * spacing[0], ny * spacing[1],
+                             nz * spacing[2]))
+                tile.fields['resid'] = new_resid.copy()
+                new_resid += step
+                tiles.append(tile)
+    expected = MoleculeBuffer.concatenate(tiles, box=[30., 40., 60.])
+
+    tiled = patch.tile(times=times, spacing=spacing, resid_step=step)
+    assert len(tiled) == len(expected) == 12*len(patch)
+    assert np.allclose(tiled.coords, expected.coords)
+    assert np.all(tiled.fields['resid'] == expected.fields['resid'])
+    assert np.all(tiled.fields['name'] == expected.fields['name'])
+    assert np.all(tiled.bonds == expected.bonds)
+    assert np.all(tiled.bond_orders == expected.bond_orders)
+    assert np.allclose(tiled.box, expected.box)
+
+#==============================================================================
+
+
+def test_drop_overlapping_water():
+    """
+    Tests added water overlapping the system is left out as whole residues,
+    while its neighbours and waters only near a periodic image stay
+    """
+    import numpy as np
+    from Dabble.builder import _combine_without_overlaps
+
+    system = _buffer([[0., 0., 0.], [0., 0., 5.]])
+    system.fields['atomicnumber'][:] = 6
+
+    def _waters(oxygens):
+        coords = []
+        for oxygen in oxygens:
+            coords.extend([oxygen, np.add(oxygen, [0.96, 0., 0.]),
+                           np.add(oxygen, [-0.24, 0.93, 0.])])
+        slab = _buffer(coords, bonds=[[3*i, 3*i+k] for i in range(len(oxygens))
+                                      for k in (1, 2)])
+        slab.fields['atomicnumber'][:] = [8, 1, 1]*len(oxygens)
+        slab.fields['name'] = np.array(["OH2", "H1", "H2"]*len(oxygens),
+                                       dtype=object)
+        return slab, np.repeat(np.arange(len(oxygens)), 3)
+
+    # Second water of the slab above overlaps the second system atom, and
+    # the water of the slab below is only close across the box. Its
+    # hydrogen is near the first system atom, which doesn't count.
+    above, res_above = _waters([[0., 3., 5.], [0., 0., 6.], [0., -3., 5.]])
+    below, res_below = _waters([[9.5, -0.93, 0.]])
+    below.coords[2] = [0.5, 0.5, 0.]
+
+    combined = _combine_without_overlaps([system, above, below],
+                                         [np.array([0, 1]), res_above,
+                                          res_below])
+    assert len(combined) == 2 + 3*3
+    assert np.allclose(combined.coords[:2], system.coords)
+    assert np.allclose(combined.coords[2:5], above.coords[:3])
+    assert np.allclose(combined.coords[5:8], above.coords[6:])
+    assert np.allclose(combined.coords[8:], below.coords)
+    assert list(combined.fields['name'][2:]) == ["OH2", "H1", "H2"]*3
+    assert combined.bonds.tolist() == [[2, 3], [2, 4], [5, 6], [5, 7],
+                                       [8, 9], [8, 10]]
+
+    # Nothing left out when there are no overlaps
+    clear = _combine_without_overlaps([system, below],
+                                      [np.array([0, 1]), res_below])
+    assert len(clear) == 5
+
+#==============================================================================
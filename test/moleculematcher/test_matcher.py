@@ -87,3 +87,86 @@ def test_residue_renaming(tmpdir):
 
 
 
+
+def test_cached_matcher(tmpdir):
+    """
+    Checks parsed topologies are loaded from the cache, and reparsed
+    if any file read while parsing them changes
+    """
+    from Dabble.param import AmberMatcher
+    tmpdir = str(tmpdir)
+    cache_dir = os.path.join(tmpdir, "cache")
+
+    leaprc = create_leaprc(tmpdir, "ala.lib")
+    a = AmberMatcher.cached([leaprc], cache_dir=cache_dir)
+    assert(len(os.listdir(cache_dir)) == 1)
+    b = AmberMatcher.cached([leaprc], cache_dir=cache_dir)
+    assert(isinstance(b, AmberMatcher))
+    assert(b.nodenames == a.nodenames)
+    assert(set(b.known_res.keys()) == set(a.known_res.keys()))
+
+    # Changing a sourced file invalidates the cache
+    fh = open(leaprc, 'a')
+    fh.write("\nloadOff %s\n" % os.path.join(dir, "lsd.lib"))
+    fh.close()
+    c = AmberMatcher.cached([leaprc], cache_dir=cache_dir)
+    assert(len(c.known_res) == len(b.known_res) + 1)
+
+def test_candidate_index(tmpdir):
+    """
+    Checks only residues with the same graph invariant are candidates
+    for matching, and that the residue itself is always one of them
+    """
+    from Dabble.param import AmberMatcher
+    tmpdir = str(tmpdir)
+
+    filename = os.path.join(tmpdir, "leaprc.lsd")
+    fh = open(filename, 'w')
+    fh.write("source %s\n" % os.path.join(dir, "leaprc.gaff"))
+    fh.write("loadOff %s\n" % os.path.join(dir, "ala.lib"))
+    fh.write("loadOff %s\n" % os.path.join(dir, "lsd.lib"))
+    fh.close()
+
+    g = AmberMatcher([filename])
+    for name, graph in g.known_res.items():
+        candidates = g._get_candidates(graph)
+        assert(name in candidates)
+        assert(len(candidates) < len(g.known_res))
+
+def test_match_memoized(tmpdir):
+    """
+    Checks a residue matched a second time is named from the cache
+    """
+    import vmd, molecule
+    from atomsel import atomsel
+    from Dabble.param import AmberMatcher
+
+    tmpdir = str(tmpdir)
+    filename = os.path.join(tmpdir, "leaprc.lsd")
+    fh = open(filename, 'w')
+    fh.write("source %s\n" % os.path.join(dir, "leaprc.gaff"))
+    fh.write("loadOff %s\n" % os.path.join(dir, "lsd.lib"))
+    fh.close()
+
+    molid = molecule.load("mae", os.path.join(dir, "lsd_prot.mae"))
+    g = AmberMatcher([filename])
+    first = g.get_names(atomsel(molid=molid))
+    assert(len(g._matches) == 1)
+    assert(g.get_names(atomsel(molid=molid)) == first)
+    assert(len(g._matches) == 1)
+
+def test_iter_vmd_graphs():
+    """
+    Checks residue graphs built for a whole selection at once are the
+    same as those built one residue at a time
+    """
+    import vmd, molecule
+    from atomsel import atomsel
+    from Dabble.param import MoleculeMatcher
+
+    molid = molecule.load("mae", os.path.join(dir, "lsd_prot.mae"))
+    for residue, graph in MoleculeMatcher.iter_vmd_graphs(atomsel(molid=molid)):
+        single = MoleculeMatcher.parse_vmd_graph(atomsel("residue %d" % residue,
+                                                         molid=molid))[0]
+        assert(sorted(graph.nodes(data=True)) == sorted(single.nodes(data=True)))
+        assert(sorted(graph.edges()) == sorted(single.edges()))
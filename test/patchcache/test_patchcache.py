@@ -0,0 +1,111 @@
+# Tests caching of tiled solvent patches
+import pytest
+import os
+import numpy as np
+
+dir = os.path.dirname(__file__) + "/"
+
+#==============================================================================
+
+def _patch(shift=0.0):
+    """
+    A small water patch, moved along x
+    """
+    from Dabble.molbuffer import MoleculeBuffer, _FIELDS
+
+    natoms = 30
+    fields = dict((field, np.zeros(natoms, dtype=dtype))
+                  for field, dtype in _FIELDS)
+    fields['name'] = np.array(["OH2", "H1", "H2"]*10, dtype=object)
+    fields['resname'] = np.array(["TIP3"]*natoms, dtype=object)
+    fields['resid'] = np.repeat(np.arange(1, 11), 3)
+    coords = np.arange(3*natoms, dtype=float).reshape(-1, 3) + [shift, 0, 0]
+    return MoleculeBuffer(fields=fields, coords=coords,
+                          bonds=[[i, i+1] for i in range(0, natoms, 3)],
+                          box=[10., 10., 10.])
+
+#==============================================================================
+
+def _age(cache, key, seconds):
+    """
+    Marks a cached patch as last used some time ago
+    """
+    filename = cache._filename(key)
+    os.utime(filename, (seconds, seconds))
+
+#==============================================================================
+
+def test_key():
+    """
+    Tests keys change with the patch and how it is tiled
+    """
+    from Dabble.patchcache import PatchCache
+
+    key = PatchCache.key(_patch(), (2, 2, 1), False)
+    assert PatchCache.key(_patch(), (2, 2, 1), False) == key
+    assert PatchCache.key(_patch(1.0), (2, 2, 1), False) != key
+    assert PatchCache.key(_patch(), (2, 1, 2), False) != key
+    assert PatchCache.key(_patch(), (2, 2, 1), True) != key
+
+#==============================================================================
+
+def test_hit_miss(tmpdir):
+    """
+    Tests patches are only found once saved
+    """
+    from Dabble.patchcache import PatchCache
+
+    cache = PatchCache(str(tmpdir.join("cache")))
+    key = PatchCache.key(_patch(), (2, 2, 1), False)
+    assert cache.get(key) is None
+
+    cache.put(key, _patch(5.0))
+    cached = cache.get(key)
+    assert cached is not None
+    assert np.allclose(cached.coords, _patch(5.0).coords)
+    assert np.all(cached.bonds == _patch().bonds)
+    assert list(cached.fields['resname']) == ["TIP3"]*30
+    assert cache.get(PatchCache.key(_patch(), (2, 2, 2), False)) is None
+
+    # Truncated files are misses too
+    with open(cache._filename(key), 'w') as fileh:
+        fileh.write("not a patch")
+    assert cache.get(key) is None
+
+#==============================================================================
+
+def test_eviction(tmpdir):
+    """
+    Tests least recently used patches are deleted past the maximum size
+    """
+    from Dabble.patchcache import PatchCache
+
+    p = str(tmpdir.join("cache"))
+    keys = [PatchCache.key(_patch(), (i, 1, 1), False) for i in range(1, 5)]
+    cache = PatchCache(p)
+    cache.put(keys[0], _patch())
+    size = os.path.getsize(cache._filename(keys[0]))
+
+    # Room for two patches
+    cache = PatchCache(p, max_size=int(2.5*size))
+    cache.put(keys[1], _patch())
+    _age(cache, keys[0], 1000)
+    _age(cache, keys[1], 2000)
+
+    # Using the older patch makes the other one least recently used
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[2], _patch())
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[2]) is not None
+    total = sum(os.path.getsize(os.path.join(p, f)) for f in os.listdir(p))
+    assert total <= cache.max_size
+
+    # The newest patch is kept even if it alone is too large
+    cache = PatchCache(p, max_size=1)
+    cache.put(keys[3], _patch())
+    assert os.listdir(p) == [os.path.basename(cache._filename(keys[3]))]
+    assert cache.get(keys[3]) is not None
+
+#==============================================================================
+
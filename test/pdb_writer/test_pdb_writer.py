@@ -0,0 +1,134 @@
+# Tests the shared array based pdb writer
+import pytest
+import os
+import numpy as np
+
+dir = os.path.dirname(__file__) + "/"
+
+#==============================================================================
+
+def _columns():
+    """
+    Atom columns of a small system with residues out of index order,
+    repeated resids in different chains, and long names. The expected
+    pdb files were written from these by the previous per-atom writers.
+    """
+    atoms = [(0, "ALA", "P", 5, "N"), (0, "ALA", "P", 5, "CA"),
+             (1, "ACE", "P", 4, "CH3"), (2, "GLY", "P", 6, "N"),
+             (1, "ACE", "P", 4, "C"), (2, "GLY", "P", 6, "HA12"),
+             (3, "POPC", "L", 5, "C218"), (3, "POPC", "L", 5, "H16S"),
+             (0, "ALA", "P", 5, "C"), (4, "TIP3", "W", 1, "OH2")]
+    return {'index': np.arange(len(atoms)),
+            'residue': np.array([a[0] for a in atoms]),
+            'resname': np.array([a[1] for a in atoms], dtype=object),
+            'chain': np.array([a[2] for a in atoms], dtype=object),
+            'resid': np.array([a[3] for a in atoms]),
+            'name': np.array([a[4] for a in atoms], dtype=object),
+            'segname': np.array([a[2] + "1" for a in atoms], dtype=object),
+            'element': np.array([a[4][0] for a in atoms], dtype=object),
+            'coords': np.array([[-998.5, 12.25, 0.], [1.0005, -2.0004, 3.],
+                                [999.999, 0., -0.0004], [10., 20., 30.],
+                                [-10.125, -20.5, -30.75], [0.5, 0.25, 0.125],
+                                [123.456, -654.321, 7.89],
+                                [-1., 1., -1.], [42., 42., 42.],
+                                [3.14159, 2.71828, -1.41421]])}
+
+#==============================================================================
+
+def _expected(filename):
+    """
+    Contents of an expected pdb file
+    """
+    with open(dir + filename) as fileh:
+        return fileh.read()
+
+#==============================================================================
+
+def test_residue_block(tmpdir):
+    """
+    Tests writing atoms partway through a file, as amber residues are
+    """
+    from Dabble import fileutils
+
+    p = str(tmpdir.mkdir("residue_block"))
+    columns = _columns()
+    with open(p + "/new.pdb", 'w') as fileh:
+        idx = fileutils.write_pdb_block(fileh, columns, serial=40)
+        assert idx == 50
+        assert fileutils.write_pdb_block(fileh, columns, serial=idx,
+                                         hetatm=True) == 60
+    with open(p + "/new.pdb") as fileh:
+        assert fileh.read() == _expected("block.pdb")
+
+#==============================================================================
+
+def test_unordered_waters(tmpdir):
+    """
+    Tests writing whole residues in a given order, numbered by that order
+    """
+    from Dabble import fileutils
+
+    p = str(tmpdir.mkdir("unordered"))
+    columns = _columns()
+    residues = [2, 0, 4]
+
+    keep = np.isin(columns['residue'], residues)
+    columns = dict((k, v[keep]) for k, v in columns.items())
+    position = np.zeros(max(residues) + 1, dtype=int)
+    position[residues] = np.arange(len(residues))
+    waternum = position[columns['residue']]
+    order = np.argsort(waternum, kind='mergesort')
+    assert fileutils.write_pdb(p + "/new.pdb", columns, order=order,
+                               resids=waternum[order] + 1) == 6
+    with open(p + "/new.pdb") as fileh:
+        assert fileh.read() == _expected("unordered.pdb")
+
+#==============================================================================
+
+def test_ordered_pdb(tmpdir):
+    """
+    Tests writing residues sorted by resid for psfgen, taking the residue
+    of the first atom with each resid
+    """
+    from Dabble import fileutils
+    from Dabble.param import charmm
+
+    p = str(tmpdir.mkdir("ordered"))
+    columns = _columns()
+    fileutils.write_pdb(p + "/new.pdb", columns,
+                        order=charmm._get_residue_order(columns))
+    with open(p + "/new.pdb") as fileh:
+        assert fileh.read() == _expected("ordered.pdb")
+
+#==============================================================================
+
+def test_selection_matches(tmpdir):
+    """
+    Tests reading a selection's columns all at once gives the same records
+    as reading each atom with its own selection
+    """
+    from Dabble import fileutils
+    import vmd, molecule
+    from atomsel import atomsel
+
+    p = str(tmpdir.mkdir("selection"))
+    molid = molecule.load("mae", dir + "../rho_c_tail/rho_test.mae")
+    sel = atomsel("protein and resid 30 to 35", molid=molid)
+
+    atoms = [atomsel('index %d' % i, molid=molid) for i in sel.get('index')]
+    columns = dict((field, np.array([a.get(field)[0] for a in atoms],
+                                    dtype=object))
+                   for field in ('name', 'resname', 'chain', 'segname',
+                                 'element'))
+    columns['resid'] = np.array([a.get('resid')[0] for a in atoms])
+    columns['coords'] = np.array([[a.get('x')[0], a.get('y')[0],
+                                   a.get('z')[0]] for a in atoms])
+    fileutils.write_pdb(p + "/old.pdb", columns)
+
+    assert fileutils.write_pdb(p + "/new.pdb",
+                               fileutils.get_pdb_columns(sel)) == len(sel)
+    with open(p + "/old.pdb") as old, open(p + "/new.pdb") as fileh:
+        assert fileh.read() == old.read()
+    molecule.delete(molid)
+
+#==============================================================================
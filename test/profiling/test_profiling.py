@@ -0,0 +1,64 @@
+# Tests timing of build stages
+import pytest
+import os
+import json
+import pstats
+
+dir = os.path.dirname(__file__) + "/"
+
+#==============================================================================
+
+def test_stage_report(tmpdir):
+    """
+    Tests the JSON report and cProfile statistics of two stages
+    """
+    from Dabble.profiling import StageProfiler
+
+    p = str(tmpdir.mkdir("profile"))
+    system = []
+    profiler = StageProfiler(enabled=True, pstats_dir=p)
+    with profiler.stage('load', atoms=lambda: len(system)):
+        system.extend(range(100))
+    with profiler.stage('solvate', atoms=lambda: len(system)):
+        system.extend(sorted(range(50), reverse=True))
+
+    assert profiler.write(p + "/report.json") == p + "/report.json"
+    with open(p + "/report.json") as fileh:
+        report = json.load(fileh)
+
+    stages = report['stages']
+    assert [s['stage'] for s in stages] == ['load', 'solvate']
+    assert [s['depth'] for s in stages] == [0, 0]
+    assert [(s['atoms_before'], s['atoms_after']) for s in stages] == \
+            [(0, 100), (100, 150)]
+    for stage in stages:
+        assert stage['wall_time'] >= 0.
+        assert stage['cpu_time'] >= 0.
+    assert report['total_wall_time'] == \
+            pytest.approx(sum(s['wall_time'] for s in stages))
+
+    # Each stage has its own loadable statistics
+    assert [os.path.basename(s['pstats']) for s in stages] == \
+            ['load_0.pstats', 'solvate_1.pstats']
+    for stage in stages:
+        assert os.path.isfile(stage['pstats'])
+        assert pstats.Stats(stage['pstats']).total_calls > 0
+
+#==============================================================================
+
+def test_disabled(tmpdir):
+    """
+    Tests nothing is recorded or written when profiling is off
+    """
+    from Dabble.profiling import StageProfiler
+
+    p = str(tmpdir.mkdir("disabled"))
+    profiler = StageProfiler(enabled=False, pstats_dir=p)
+    with profiler.stage('load', atoms=lambda: 1/0):
+        pass
+    assert profiler.stages == []
+    assert profiler.write(p + "/report.json") is None
+    assert os.listdir(p) == []
+
+#==============================================================================
+
@@ -0,0 +1,44 @@
+# Tests tracking of removed atoms
+import pytest
+import numpy as np
+
+#==============================================================================
+
+def test_remove_residues():
+    """
+    Tests removing whole residues and counting what is left
+    """
+    from Dabble.removal import RemovalMask
+
+    # Three waters and a two residue lipid fragment
+    residues = [0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 4, 4]
+    fragments = [0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 3]
+    mask = RemovalMask(residues, fragments)
+    assert len(mask) == 13
+    assert mask.count() == 13
+    assert mask.count_residues() == 5
+    assert mask.count_fragments() == 4
+
+    atoms = np.zeros(13, dtype=bool)
+    atoms[[1, 7]] = True
+    assert mask.remove_residues(atoms) == 6
+    assert mask.count() == 7
+    assert mask.count_residues() == 3
+
+    # Removing already removed atoms does nothing
+    assert mask.remove_residues(atoms) == 0
+
+    # Removing one residue of the lipid leaves the fragment
+    atoms = np.zeros(13, dtype=bool)
+    atoms[10] = True
+    assert mask.remove_residues(atoms) == 2
+    assert mask.count_fragments() == 2
+
+    lipid = np.array([False]*9 + [True]*4)
+    assert mask.count_fragments(lipid) == 1
+    assert mask.remove_fragments(lipid) == 2
+    assert mask.count_fragments(lipid) == 0
+    assert list(np.flatnonzero(mask.remaining)) == [3, 4, 5]
+
+#==============================================================================
+
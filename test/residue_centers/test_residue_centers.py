@@ -0,0 +1,35 @@
+# Tests computing residue centers from atom arrays
+import pytest
+import numpy as np
+
+#==============================================================================
+
+def test_residue_centers():
+    """
+    Tests residue centers and the XY box mask match a per-residue loop
+    """
+    from Dabble import molutils
+
+    rng = np.random.RandomState(2015)
+    residues = rng.randint(0, 50, size=1000)
+    coords = rng.randn(1000, 3) * [30., 30., 10.]
+    heavy = rng.rand(1000) > 0.5
+
+    resnums, centers = molutils.residue_centers(residues, coords, heavy)
+    assert list(resnums) == sorted(set(residues[heavy]))
+    for resnum, center in zip(resnums, centers):
+        expected = coords[heavy & (residues == resnum)].mean(axis=0)
+        assert np.allclose(center, expected)
+
+    outside = molutils.residues_centered_outside(residues, coords, heavy,
+                                                 10., 20.)
+    for resnum in set(residues):
+        if resnum in resnums:
+            center = centers[list(resnums).index(resnum)]
+            expected = abs(center[0]) > 10. or abs(center[1]) > 20.
+        else:
+            expected = False
+        assert np.all(outside[residues == resnum] == expected)
+
+#==============================================================================
+
@@ -44,3 +44,70 @@ def test_hmr_param(tmpdir):
 
 #==============================================================================
 
+
+def test_native_psf(tmpdir):
+    """
+    Tests building the psf directly gives the same structure as psfgen
+    """
+    from Dabble.param import CharmmWriter
+    import vmd, molecule
+
+    p = str(tmpdir.mkdir("native_psf"))
+    molid = molecule.load("mae", dir + "test_rho_correct.mae")
+    w = CharmmWriter(tmp_dir=p, molid=molid, native=True)
+    w.write(p+"/test")
+    assert read_psf(p+"/test.psf") == read_psf(dir + "test_rho_correct.psf")
+
+#==============================================================================
+
+def test_parallel_matching(tmpdir):
+    """
+    Tests matching residues in worker processes gives the same psf
+    """
+    from Dabble.param import CharmmWriter
+    import vmd, molecule
+
+    p = str(tmpdir.mkdir("parallel_matching"))
+    molid = molecule.load("mae", dir + "test_rho_correct.mae")
+    w = CharmmWriter(tmp_dir=p, molid=molid, processes=2)
+    w.write(p+"/test")
+    subprocess.check_call(["diff", "-q",
+                           "--ignore-matching-lines=VERSION",
+                           "--ignore-matching-lines=REMARKS",
+                           "--ignore-matching-lines=NTITLE",
+                           dir + "test_rho_correct.psf",
+                           p+"/test.psf"])
+
+#==============================================================================
+
+def read_psf(filename):
+    """
+    Reads the atoms and bonded terms in a psf file, keyed by atom
+    segment, resid and name so the order atoms are written doesn't matter
+    """
+    lines = open(filename).read().splitlines()
+    start = [i for i, l in enumerate(lines) if "!NATOM" in l][0]
+    natoms = int(lines[start].split()[0])
+    atoms = {}
+    keys = [None]
+    for line in lines[start+1:start+1+natoms]:
+        words = line.split()
+        keys.append(tuple(words[1:3] + words[4:5]))
+        atoms[keys[-1]] = (words[3], words[5], float(words[6]), float(words[7]))
+
+    terms = {"atoms": atoms}
+    for header, size in [("!NBOND", 2), ("!NTHETA", 3), ("!NPHI", 4),
+                         ("!NIMPHI", 4), ("!NCRTERM", 8)]:
+        i = [i for i, l in enumerate(lines) if header in l][0]
+        count = int(lines[i].split()[0])
+        values = []
+        while len(values) < count*size:
+            i += 1
+            values.extend(keys[int(v)] for v in lines[i].split())
+        found = [tuple(values[j:j+size]) for j in range(0, len(values), size)]
+        if header in ("!NBOND", "!NTHETA", "!NPHI"):
+            found = [min(t, t[::-1]) for t in found]
+        terms[header] = sorted(found)
+    return terms
+
+#==============================================================================
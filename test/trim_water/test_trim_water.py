@@ -0,0 +1,56 @@
+# Tests trimming water against all box boundaries in one pass
+import pytest
+import numpy as np
+
+#==============================================================================
+
+def test_remove_in_turn():
+    """
+    Tests one update removes and counts the same atoms as trimming each
+    boundary after another
+    """
+    from Dabble import builder
+    from Dabble.removal import RemovalMask
+
+    # Waters, some already removed, with a solute in the middle and
+    # residues that cross several boundaries
+    rng = np.random.RandomState(2015)
+    residues = np.repeat(np.arange(2000), 3)
+    coords = np.repeat(rng.rand(2000, 3) * [60., 60., 80.] - [30., 30., 40.],
+                       3, axis=0) + rng.randn(6000, 3)
+    heavy = np.tile([True, False, False], 2000)
+    solute = np.zeros(6000, dtype=bool)
+    solute[np.all(np.abs(coords) < 5., axis=1)] = True
+    remaining = rng.rand(6000) > 0.05
+
+    # Boundaries, in the order _trim_water checks them
+    solvent = heavy & ~solute
+    boundaries = [solvent & (coords[:, 2] > 30.),
+                  solvent & (coords[:, 2] < -25.)]
+    for dim, size in enumerate([50., 45.]):
+        buf = (size - max(coords[solute, dim]) + min(coords[solute, dim]))/2.
+        boundaries.append(solvent &
+                          (coords[:, dim] > max(coords[solute, dim]) + buf))
+        boundaries.append(solvent &
+                          (coords[:, dim] < min(coords[solute, dim]) - buf))
+
+    # Some residues are past more than one boundary
+    assert np.any(np.sum(boundaries, axis=0) > 1)
+
+    # Previous trimming, one boundary after another
+    expected = RemovalMask(residues=residues, fragments=residues,
+                           remaining=remaining)
+    counts = [expected.remove_residues(b) for b in boundaries]
+    assert all(counts)
+
+    removal = RemovalMask(residues=residues, fragments=residues,
+                          remaining=remaining)
+    assert builder._remove_residues_in_turn(removal, boundaries) == sum(counts)
+    assert np.all(removal.remaining == expected.remaining)
+
+    # Nothing to trim
+    assert builder._remove_residues_in_turn(removal, []) == 0
+    assert np.all(removal.remaining == expected.remaining)
+
+#==============================================================================
+
@@ -0,0 +1,110 @@
+# Tests writing psfgen water blocks from atom arrays
+import pytest
+import os
+import numpy as np
+
+dir = os.path.dirname(__file__) + "/"
+
+#==============================================================================
+
+def _water_columns(nwaters, moved=(), missing=()):
+    """
+    Atom columns of waters in index order, as VMD would return them.
+    Waters in moved have their last hydrogen at the end of the system,
+    and waters in missing have no second hydrogen.
+    """
+    rng = np.random.RandomState(2015)
+    atoms = []
+    for water in range(nwaters):
+        for name, element in [("OH2", "O"), ("H1", "H"), ("H2", "H")]:
+            if name == "H2" and water in missing:
+                continue
+            atoms.append((water, name, element))
+    for water in moved:
+        atom = [a for a in atoms if a[0] == water][-1]
+        atoms.remove(atom)
+        atoms.append(atom)
+
+    columns = {'index': np.arange(len(atoms)),
+               'residue': np.array([a[0] for a in atoms]),
+               'name': np.array([a[1] for a in atoms], dtype=object),
+               'resname': np.array(["TIP3"]*len(atoms), dtype=object),
+               'chain': np.array(["W"]*len(atoms), dtype=object),
+               'resid': np.array([a[0] % 5000 + 1 for a in atoms]),
+               'segname': np.array(["W"]*len(atoms), dtype=object),
+               'element': np.array([a[2] for a in atoms], dtype=object),
+               'coords': rng.rand(len(atoms), 3) * 200. - 100.}
+    return columns
+
+#==============================================================================
+
+def test_water_order():
+    """
+    Tests problem waters are found as when checking each water's indices
+    """
+    from Dabble.param import charmm
+
+    columns = _water_columns(50, moved=[3, 17], missing=[30])
+    order, problems = charmm._get_water_order(columns)
+    assert problems == [3, 17, 30]
+    assert len(order) == 3*47
+    assert not np.any(np.isin(columns['residue'][order], problems))
+
+    # Previous check, one water at a time, for waters with all their atoms
+    columns = _water_columns(50, moved=[3, 17])
+    old = []
+    for r in sorted(set(columns['residue'].tolist())):
+        widx = columns['index'][columns['residue'] == r]
+        if max(widx) - min(widx) != 2:
+            old.append(r)
+    assert charmm._get_water_order(columns)[1] == old
+
+    empty = dict((k, v[:0]) for k, v in columns.items())
+    order, problems = charmm._get_water_order(empty)
+    assert len(order) == 0 and problems == []
+
+#==============================================================================
+
+def test_water_files_match(tmpdir):
+    """
+    Tests the water files are split and numbered as by the previous writer,
+    which took 9999 waters at a time in residue order. The record format
+    itself is checked against expected files in the pdb_writer tests.
+    """
+    from Dabble import fileutils
+    from Dabble.param import charmm
+
+    p = str(tmpdir.mkdir("water_files"))
+    columns = _water_columns(10005, moved=[12])
+    order, problems = charmm._get_water_order(columns)
+    resid = columns['resid'].copy()
+    resid[order] = np.arange(len(order))//3 % 9999 + 1
+
+    # Previous batching, by residue, numbering waters from 1 in each file
+    remaining = sorted(set(columns['residue'].tolist()) - set(problems))
+    batches = []
+    while remaining:
+        residues = set(remaining[:9999])
+        remaining = remaining[9999:]
+        atoms = [i for i in range(len(columns['index']))
+                 if columns['residue'][i] in residues]
+        batches.append((atoms, [k for k in range(1, len(atoms)//3+1)
+                                for _ in range(3)]))
+    assert len(batches) == (len(order) + 9999*3 - 1)//(9999*3) == 2
+
+    for i, (atoms, resids) in enumerate(batches):
+        new = order[i*9999*3:(i+1)*9999*3]
+        assert list(new) == atoms
+        assert list(resid[new]) == resids
+
+        fileutils.write_pdb(p + "/old_%d.pdb" % i, columns, order=atoms,
+                            resids=resids)
+        charmm._write_water_pdb((p + "/new_%d.pdb" % i,
+                                 dict((k, v[new]) for k, v in columns.items()),
+                                 resid[new]))
+        with open(p + "/old_%d.pdb" % i, 'rb') as old, \
+             open(p + "/new_%d.pdb" % i, 'rb') as fileh:
+            assert fileh.read() == old.read()
+
+#==============================================================================
+